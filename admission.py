@@ -0,0 +1,306 @@
+import asyncio
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+
+import redis
+
+logger = logging.getLogger('DeepSeekChat')
+
+# 所有worker共用的准入控制，全部在一个Lua脚本里原子完成，时间取Redis服务器时钟，避免两台主机的时钟偏差：
+#   1. 清理过期的并发租约（持有者崩溃时自动回收）
+#   2. 并发数已满则拒绝
+#   3. 令牌桶按速率补充，不足一个令牌则拒绝并返回还需等待的毫秒数
+#   4. 扣一个令牌，登记租约
+_ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+if redis.call('ZCARD', KEYS[2]) >= tonumber(ARGV[3]) then
+    return {0, 0}
+end
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(now - ts, 0) * rate / 1000)
+
+if tokens < 1 then
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+    return {0, math.ceil((1 - tokens) * 1000 / rate)}
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens - 1), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[5]), ARGV[4])
+return {1, 0}
+"""
+
+# 有界等待队列：同样用带过期时间的zset，等待者崩溃后自动出队
+_ENQUEUE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[2])
+return 1
+"""
+
+
+class AdmissionRejected(Exception):
+    """排队已满或等待超时，调用方应返回429并带上Retry-After"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"上游繁忙，请{retry_after}秒后重试")
+        self.retry_after = retry_after
+
+
+class Lease:
+    """一次被准入的上游调用占用的并发名额，结束时释放（可重复调用）"""
+
+    def __init__(self, controller, lease_id):
+        self._controller = controller
+        self.lease_id = lease_id
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self._controller._release(self.lease_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class AdmissionController:
+    """分布式令牌桶 + 并发信号量，挡在上游调用前面；放不进来的请求排队等待或快速拒绝"""
+
+    def __init__(self, client, rate=20.0, burst=40, max_concurrency=100, max_queue=100,
+                 max_wait=5.0, lease_ttl=300, prefix='admission:'):
+        self.client = client
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.lease_ttl = lease_ttl
+        self._keys = [prefix + 'bucket', prefix + 'leases']
+        self._queue_key = prefix + 'queue'
+        self._acquire_script = client.register_script(_ACQUIRE_SCRIPT)
+        self._enqueue_script = client.register_script(_ENQUEUE_SCRIPT)
+
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def acquire(self):
+        lease_id = uuid.uuid4().hex
+        try:
+            admitted, retry_ms = self._try_acquire(lease_id)
+            if admitted:
+                self._count_admitted()
+                return Lease(self, lease_id)
+
+            if self.max_wait <= 0 or not self._enqueue_script(
+                    keys=[self._queue_key],
+                    args=[self.max_queue, lease_id, int(self.max_wait * 1000)]):
+                raise self._reject(retry_ms)
+        except redis.RedisError as e:
+            # Redis不可用时放行，只靠本worker的连接池限制
+            logger.warning(f"准入控制不可用，直接放行: {str(e)}")
+            with self._lock:
+                self.errors += 1
+            return Lease(self, None)
+
+        start = time.monotonic()
+        deadline = start + self.max_wait
+        with self._lock:
+            self.waiting += 1
+            self.queued += 1
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self._reject(retry_ms)
+                # 令牌桶给出了确切的等待时间；并发满时短轮询，加抖动错开各worker
+                delay = retry_ms / 1000 if retry_ms else 0.05
+                time.sleep(min(delay * random.uniform(1.0, 1.5), remaining))
+                admitted, retry_ms = self._try_acquire(lease_id)
+                if admitted:
+                    self._count_admitted()
+                    return Lease(self, lease_id)
+        except redis.RedisError as e:
+            logger.warning(f"准入控制不可用，直接放行: {str(e)}")
+            with self._lock:
+                self.errors += 1
+            return Lease(self, None)
+        finally:
+            waited = time.monotonic() - start
+            with self._lock:
+                self.waiting -= 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+            try:
+                self.client.zrem(self._queue_key, lease_id)
+            except redis.RedisError:
+                pass
+
+    def _try_acquire(self, lease_id):
+        admitted, retry_ms = self._acquire_script(
+            keys=self._keys,
+            args=[self.rate, self.burst, self.max_concurrency, lease_id, int(self.lease_ttl * 1000)]
+        )
+        return admitted == 1, retry_ms
+
+    def _release(self, lease_id):
+        if lease_id is None:
+            return
+        try:
+            self.client.zrem(self._keys[1], lease_id)
+        except redis.RedisError as e:
+            # 释放失败时租约会在lease_ttl后自动过期
+            logger.warning(f"释放并发名额失败: {str(e)}")
+
+    def _reject(self, retry_ms):
+        with self._lock:
+            self.shed += 1
+        return AdmissionRejected(max(1, math.ceil(retry_ms / 1000)))
+
+    def _count_admitted(self):
+        with self._lock:
+            self.admitted += 1
+
+    def _stats(self, queue_depth, in_flight):
+        return {
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'shed': self.shed,
+            'errors': self.errors,
+            'waiting': self.waiting,
+            'queue_depth': queue_depth,
+            'in_flight': in_flight,
+            'wait_ms_avg': round(self.wait_total * 1000 / self.queued, 1) if self.queued else 0.0,
+            'wait_ms_max': round(self.wait_max * 1000, 1),
+        }
+
+    def stats(self):
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.zcard(self._queue_key)
+            pipe.zcard(self._keys[1])
+            queue_depth, in_flight = pipe.execute()
+        except redis.RedisError:
+            queue_depth, in_flight = None, None
+        return self._stats(queue_depth, in_flight)
+
+
+class AsyncLease(Lease):
+    """AsyncAdmissionController的并发名额，release()需要await"""
+
+    async def release(self):
+        if self._released:
+            return
+        self._released = True
+        await self._controller._release(self.lease_id)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.release()
+
+
+class AsyncAdmissionController(AdmissionController):
+    """给async_app用的同一个准入控制：相同的Lua脚本和键，与线程版的worker共用令牌桶和并发名额"""
+
+    async def acquire(self):
+        lease_id = uuid.uuid4().hex
+        try:
+            admitted, retry_ms = await self._try_acquire(lease_id)
+            if admitted:
+                self._count_admitted()
+                return AsyncLease(self, lease_id)
+
+            if self.max_wait <= 0 or not await self._enqueue_script(
+                    keys=[self._queue_key],
+                    args=[self.max_queue, lease_id, int(self.max_wait * 1000)]):
+                raise self._reject(retry_ms)
+        except redis.RedisError as e:
+            logger.warning(f"准入控制不可用，直接放行: {str(e)}")
+            with self._lock:
+                self.errors += 1
+            return AsyncLease(self, None)
+
+        start = time.monotonic()
+        deadline = start + self.max_wait
+        with self._lock:
+            self.waiting += 1
+            self.queued += 1
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self._reject(retry_ms)
+                delay = retry_ms / 1000 if retry_ms else 0.05
+                await asyncio.sleep(min(delay * random.uniform(1.0, 1.5), remaining))
+                admitted, retry_ms = await self._try_acquire(lease_id)
+                if admitted:
+                    self._count_admitted()
+                    return AsyncLease(self, lease_id)
+        except redis.RedisError as e:
+            logger.warning(f"准入控制不可用，直接放行: {str(e)}")
+            with self._lock:
+                self.errors += 1
+            return AsyncLease(self, None)
+        finally:
+            waited = time.monotonic() - start
+            with self._lock:
+                self.waiting -= 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+            try:
+                await self.client.zrem(self._queue_key, lease_id)
+            except redis.RedisError:
+                pass
+
+    async def _try_acquire(self, lease_id):
+        admitted, retry_ms = await self._acquire_script(
+            keys=self._keys,
+            args=[self.rate, self.burst, self.max_concurrency, lease_id, int(self.lease_ttl * 1000)]
+        )
+        return admitted == 1, retry_ms
+
+    async def _release(self, lease_id):
+        if lease_id is None:
+            return
+        try:
+            await self.client.zrem(self._keys[1], lease_id)
+        except redis.RedisError as e:
+            logger.warning(f"释放并发名额失败: {str(e)}")
+
+    async def stats(self):
+        try:
+            async with self.client.pipeline(transaction=False) as pipe:
+                pipe.zcard(self._queue_key)
+                pipe.zcard(self._keys[1])
+                queue_depth, in_flight = await pipe.execute()
+        except redis.RedisError:
+            queue_depth, in_flight = None, None
+        return self._stats(queue_depth, in_flight)
@@ -1,11 +1,36 @@
-from flask import Flask, render_template, request, jsonify, session, Response, stream_with_context
+from flask import (
+    Flask, render_template, request, jsonify, session, Response, stream_with_context, g, copy_current_request_context
+)
 import requests
 import os
 import redis
 import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from datetime import timedelta
 
+from admission import AdmissionController, AdmissionRejected
+from codec import CompressedSerializer, PayloadCodec
+from compaction import Compactor
+from conversation import INVALIDATE_CHANNEL, MAX_HISTORY_TOKENS, ConversationStore, PromptCacheStats
+from fallback import LocalFallback
+from generation import GenerationQueue
+from l1_cache import VersionedCache
+from metrics import (
+    REDIS_BUCKETS, SIZE_BUCKETS, TOKEN_GAP_BUCKETS, TOKEN_RATE_BUCKETS, MetricsRegistry, StreamTimings
+)
+from redis_access import RequestTimer, WriteBatch, create_client
+from response_cache import ResponseCache, payload_hash, replay_chunks
+from resumable import ResumableStreams, ResumeError
+from sessions import LazySessionInterface
+from sharding import ShardedRedis
+from singleflight import FlightError, SingleFlight
+from sse import CoalesceStats, DeltaCoalescer, DisconnectStats, SSEParser
+from tokenizer import load_counter
+from upstream import CircuitBreaker, CircuitOpenError, PoolTimeout, UpstreamClient
+
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('DeepSeekChat')
@@ -15,97 +40,642 @@ app = Flask(__name__)
 # 使用环境变量设置密钥
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "your_fixed_secret_key_here")
 
+# 指标：/metrics 按Prometheus文本格式输出。配置METRICS_DIR时各进程定期把自己的值写进这个目录，
+# 输出时合并同一台机器上的所有gunicorn worker和generation worker（gunicorn.conf.py里默认开启）
+metrics = MetricsRegistry(
+    os.getenv("METRICS_DIR") or None,
+    flush_interval=float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+)
+request_latency = metrics.histogram(
+    'http_request_duration_seconds', '请求耗时，流式请求到流结束为止', ('endpoint', 'status')
+)
+request_redis = metrics.histogram('http_request_redis_seconds', '每个聊天请求花在Redis上的总时间', buckets=REDIS_BUCKETS)
+request_codec = metrics.histogram(
+    'http_request_codec_seconds', '每个聊天请求花在session和对话压缩解压上的总时间', buckets=REDIS_BUCKETS
+)
+redis_latency = metrics.histogram(
+    'redis_command_duration_seconds', 'Redis命令从发出到收到回复的时间', ('command',), REDIS_BUCKETS
+)
+upstream_connect = metrics.histogram('upstream_connect_seconds', '上游从发出请求到收到响应头的时间，包括建连和TLS握手')
+upstream_ttft = metrics.histogram('upstream_ttft_seconds', '上游从发出请求到收到第一个token的时间，包括重试')
+upstream_duration = metrics.histogram('upstream_stream_duration_seconds', '上游流式调用从发出请求到流结束的时间')
+token_gap = metrics.histogram('upstream_inter_token_seconds', '上游相邻两个token之间的间隔', buckets=TOKEN_GAP_BUCKETS)
+token_rate = metrics.histogram('upstream_tokens_per_second', '第一个token之后的生成速度', buckets=TOKEN_RATE_BUCKETS)
+session_size = metrics.histogram('session_size_bytes', '读到的session序列化并压缩后的大小', buckets=SIZE_BUCKETS)
+errors = metrics.counter('errors_total', '按接口和类型统计的错误', ('endpoint', 'kind'))
+
+# Redis熔断：连续超时或连不上后所有命令立即失败，不再每个请求等满socket超时
+redis_breaker = CircuitBreaker(
+    failure_threshold=int(os.getenv("REDIS_BREAKER_FAILURE_THRESHOLD", "3")),
+    reset_timeout=float(os.getenv("REDIS_BREAKER_RESET_TIMEOUT", "5")),
+    name='Redis'
+)
+
+
+def connect_redis(host, port):
+    """所有Redis节点共用的连接配置：连接池大小固定，池满时等待而不是无限新建连接"""
+    return create_client(
+        host,
+        port,
+        max_connections=int(os.getenv("REDIS_POOL_SIZE", "50")),
+        pool_timeout=float(os.getenv("REDIS_POOL_TIMEOUT", "5")),
+        breaker=redis_breaker,
+        latency=redis_latency,
+        db=0,
+        socket_connect_timeout=float(os.getenv("REDIS_CONNECT_TIMEOUT", "3")),
+        socket_timeout=float(os.getenv("REDIS_SOCKET_TIMEOUT", "5"))
+    )
+
+
+# 所有组件共用一个连接池
+redis_client = connect_redis(os.getenv("REDIS_HOST", "localhost"), int(os.getenv("REDIS_PORT", "6379")))
+redis_timer = RequestTimer(request_redis)
+
+
+def session_shards(spec):
+    """SESSION_REDIS_NODES="host:port,host:port"：session和对话按id一致性哈希到这些节点"""
+    clients = {}
+    for node in spec.split(','):
+        host, port = node.strip().rsplit(':', 1)
+        clients[f'{host}:{port}'] = connect_redis(host, int(port))
+    return ShardedRedis(clients, vnodes=int(os.getenv("SESSION_REDIS_VNODES", "160")))
+
+
+# 不配置时session和对话与缓存、限流等共用redis_client
+if os.getenv("SESSION_REDIS_NODES"):
+    session_redis = session_shards(os.environ["SESSION_REDIS_NODES"])
+    session_redis_clients = session_redis.clients
+else:
+    session_redis = redis_client
+    session_redis_clients = [redis_client]
+
 # 配置Redis存储session（已修复弃用警告）
 app.config.update({
     'SESSION_TYPE': 'redis',
-    'SESSION_REDIS': redis.Redis(
-        host='localhost',
-        port=6379,
-        db=0,
-        socket_connect_timeout=3,
-        socket_timeout=5
-    ),
+    'SESSION_REDIS': redis_client,
     'SESSION_PERMANENT': True,
+    'SESSION_REFRESH_EACH_REQUEST': False,
     'PERMANENT_SESSION_LIFETIME': timedelta(days=1)
 })
 
-# 初始化Redis session
-from flask_session import Session
-
-Session(app)
+# 初始化Redis session：只在第一次聊天时创建，没有修改时不写回，有效期过半才续期
+app.session_interface = LazySessionInterface(
+    app,
+    session_redis,
+    refresh_threshold=app.config['PERMANENT_SESSION_LIFETIME'].total_seconds() * float(
+        os.getenv("SESSION_REFRESH_RATIO", "0.5")
+    ),
+    permanent=app.config['SESSION_PERMANENT']
+)
+
+# session和对话消息写入Redis前的压缩：超过阈值的值压缩，带版本字节，未压缩的旧值照常读取
+payload_codec = PayloadCodec(
+    os.getenv("COMPRESSION", "zlib"),
+    threshold=int(os.getenv("COMPRESSION_THRESHOLD", "512")),
+    level=int(os.environ["COMPRESSION_LEVEL"]) if os.getenv("COMPRESSION_LEVEL") else None
+)
+payload_codec.request_metric = request_codec
+app.session_interface.serializer = CompressedSerializer(app.session_interface.serializer, payload_codec)
 
 # API配置
-api_url = "https://api.deepseek.com/v1/chat/completions"
+api_url = os.getenv("DEEPSEEK_API_URL", "https://api.deepseek.com/v1/chat/completions")
+
+# 透传模式：上游SSE字节原样转发给浏览器，只在旁路解析出文本写入历史
+stream_passthrough = os.getenv("STREAM_PASSTHROUGH", "0") == "1"
+
+# 输出帧合并：攒够字节数或超过时间窗口才发一帧，减少小写入和前端重复渲染
+# 每读到一个上游数据块（包括keep-alive等不含内容的块）检查一次窗口，
+# 缓冲内容的延迟上界是"窗口或下一个上游数据块，以较晚者为准"
+coalesce_bytes = int(os.getenv("STREAM_COALESCE_BYTES", "256"))
+coalesce_window = float(os.getenv("STREAM_COALESCE_MS", "20")) / 1000
+coalesce_stats = CoalesceStats()
+disconnect_stats = DisconnectStats()
+
+# 响应缓存：相同的首轮问题等完全一致的请求不再走上游，TTL为0时关闭
+response_cache = ResponseCache(
+    redis_client,
+    ttl=int(os.getenv("RESPONSE_CACHE_TTL", "3600")),
+    max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000"))
+)
+
+# 历史窗口：stable模式按轮次大块裁剪，让发给上游的前缀保持不变以命中DeepSeek上下文缓存
+history_stable = os.getenv("HISTORY_WINDOW_MODE", "stable") != "legacy"
+history_trim_target = float(os.getenv("HISTORY_TRIM_TARGET", "0.5"))
+prompt_cache_stats = PromptCacheStats(redis_client)
+
+# token计数：TOKENIZER_PATH指向本地词表（DeepSeek的tokenizer.json，见tokenizer.BPECounter）时精确计数，
+# 否则按文字种类近似并用上游usage校准
+token_counter = load_counter(
+    os.getenv("TOKENIZER_PATH"),
+    cache_size=int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+)
+
+# 进程内缓存保存后的对话窗口，按版本号校验，其他worker写入时通过pub/sub失效
+window_cache = VersionedCache(
+    session_redis_clients,
+    INVALIDATE_CHANNEL,
+    max_entries=int(os.getenv("L1_CACHE_SIZE", "1000"))
+) if os.getenv("L1_CACHE", "1") == "1" else None
+
+# 对话历史存放在每个对话独立的Redis列表里，session只保存对话id，每轮只追加新消息
+conversation_store = ConversationStore(
+    session_redis,
+    token_counter,
+    ttl=int(app.config['PERMANENT_SESSION_LIFETIME'].total_seconds()),
+    codec=payload_codec,
+    cache=window_cache
+)
+# 对话id就是创建它的session id，读取session的同一次往返里顺带取回对话
+app.session_interface.prefetch = conversation_store.queue_load
+
+# Redis不可用时session和对话切到本进程的有界存储，照常聊天，恢复后写回Redis
+local_fallback = LocalFallback(
+    app.session_interface,
+    conversation_store,
+    redis_breaker,
+    max_sessions=int(os.getenv("FALLBACK_MAX_SESSIONS", "10000")),
+    max_conversations=int(os.getenv("FALLBACK_MAX_CONVERSATIONS", "1000"))
+) if os.getenv("REDIS_FALLBACK", "1") == "1" else None
+app.session_interface.fallback = local_fallback
+app.session_interface.size_metric = session_size
+conversation_store.fallback = local_fallback
+
+# 后台压缩：窗口超过阈值时把最早的若干轮总结成一条摘要，请求路径上只应用现成的结果
+compactor = Compactor(
+    conversation_store,
+    lambda data: summarize(data),
+    threshold=MAX_HISTORY_TOKENS * float(os.getenv("COMPACT_THRESHOLD", "0.6")),
+    keep_turns=int(os.getenv("COMPACT_KEEP_TURNS", "2")),
+    summary_max_tokens=int(os.getenv("COMPACT_SUMMARY_MAX_TOKENS", "300"))
+) if os.getenv("COMPACTION", "1") == "1" else None
+
+# 相同请求合并：同时到达的完全相同请求只调用一次上游（worker内存 + 跨worker的Redis）
+singleflight = SingleFlight(redis_client) if os.getenv("SINGLEFLIGHT", "1") == "1" else None
+
+# 可续传的流：断线重连的浏览器带Last-Event-ID补齐缺失的帧。透传模式下转发的是上游的原始字节块，
+# 和帧边界不对齐，无法逐帧编号，不启用
+resumable = ResumableStreams(
+    redis_client,
+    ttl=int(os.getenv("RESUME_TTL", "60")),
+    grace=float(os.getenv("RESUME_GRACE", "10"))
+) if os.getenv("RESUMABLE_STREAMS", "1") == "1" and not stream_passthrough else None
+
+# 独立的generation worker（worker.py）：web只提交任务并转发worker写进续传缓冲的输出，依赖可续传的流
+generation_queue = GenerationQueue(
+    redis_client,
+    wait_timeout=float(os.getenv("GENERATION_WAIT_TIMEOUT", "60"))
+) if os.getenv("GENERATION_WORKERS", "0") == "1" and resumable is not None else None
+
+# 准入控制：所有worker共享的令牌桶和并发上限，避免突发流量触发DeepSeek限流
+admission = AdmissionController(
+    redis_client,
+    rate=float(os.getenv("ADMISSION_RATE", "20")),
+    burst=int(os.getenv("ADMISSION_BURST", "40")),
+    max_concurrency=int(os.getenv("ADMISSION_MAX_CONCURRENCY", "100")),
+    max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", "100")),
+    max_wait=float(os.getenv("ADMISSION_MAX_WAIT", "5"))
+) if os.getenv("ADMISSION", "1") == "1" else None
+
+
+def sse_frame(content, event_id=None):
+    frame = f"data: {json.dumps({'content': content})}\n\n"
+    return f"id: {event_id}\n{frame}" if event_id else frame
+
+
+def stream_timings():
+    return StreamTimings(upstream_duration, upstream_ttft, token_gap, token_rate)
+
+
+def count_error(kind, endpoint=None):
+    """endpoint为空时取当前请求的接口（不在请求上下文里的生成器要显式传入）"""
+    errors.inc(endpoint or request.endpoint, kind)
+
+
+@app.before_request
+def start_request_timers():
+    g.request_start = time.perf_counter()
+    redis_timer.begin()
+
+
+@app.after_request
+def stop_request_timers(response):
+    # 在响应发完时记录（流式响应是流结束、包含了流结束时的写入）；stream_with_context的生成器会再次推入
+    # 请求上下文，teardown_request在返回响应和流结束时各调用一次，所以不放在teardown里
+    start = g.get('request_start')
+    if start is None:
+        return response
+    endpoint = request.endpoint or 'none'
+    status = str(response.status_code)
+
+    def finish():
+        # 其他接口的编解码耗时（比如读session）只清零，不计入聊天请求
+        payload_codec.end_request(record=endpoint in ('chat', 'stream_chat'))
+        if endpoint in ('chat', 'stream_chat'):
+            redis_timer.end()
+        request_latency.observe(time.perf_counter() - start, endpoint, status)
+
+    response.call_on_close(finish)
+    return response
+
+
+def request_writes():
+    """本次请求结束时一次性发出的写入批次"""
+    if 'redis_writes' not in g:
+        g.redis_writes = WriteBatch(redis_client)
+    return g.redis_writes
+
+
+def lookup(cache_key, flight_key):
+    """缓存查询和跨worker请求合并的抢锁放在同一次往返里；返回 (缓存的回答, 是否leader, flight)"""
+    pipe = redis_client.pipeline(transaction=False)
+    if cache_key:
+        response_cache.queue_get(pipe, cache_key)
+    if singleflight is not None:
+        singleflight.queue_claim(pipe, flight_key)
+    if not len(pipe):
+        return None, False, None
+    try:
+        results = pipe.execute(raise_on_error=False)
+    except redis.RedisError as e:
+        results = [e] * len(pipe)
+
+    cached = response_cache.get_done(results) if cache_key else None
+    if singleflight is None:
+        return cached, False, None
+    claimed = results[-1]
+    if cached is not None:
+        if claimed is True or claimed == 1:
+            singleflight.release(flight_key)
+        return cached, False, None
+    is_leader, flight = singleflight.join(flight_key, claimed)
+    return None, is_leader, flight
+
+
+def open_conversation(user_message):
+    """返回 (对话id, 窗口)：加载对话窗口，追加本轮用户消息并按token预算裁剪。
+
+    首次聊天时创建对话，旧版本session里整块保存的history作为新消息随本轮一起写入对话列表。
+    """
+    conversation_id = session.get('conv_id')
+    if conversation_id is None:
+        conversation_id = session.sid
+        session['conv_id'] = conversation_id
+        if session.degraded:
+            # Redis读不到session时sid不变，对话id通常就是它：接着用本地保存的短期历史
+            window = conversation_store.load_local(conversation_id)
+        else:
+            window = conversation_store.new_window()
+        for msg in session.pop('history', None) or []:
+            window.append(msg["role"], msg["content"])
+    elif conversation_id == session.sid and session.prefetched is not None:
+        window = conversation_store.decode(conversation_id, session.prefetched)
+    else:
+        window = conversation_store.load(conversation_id)
+
+    if compactor is not None:
+        compactor.observe(window)
+    window.append("user", user_message)
+    current_tokens = window.trim(MAX_HISTORY_TOKENS, history_stable, history_trim_target)
+    logger.debug(f"当前token数: {current_tokens}/{MAX_HISTORY_TOKENS}")
+    return conversation_id, window
+
+
+def close_window(conversation_id, window, reply):
+    """追加回答，二次检查token数后把本轮改动连同缓存和统计的写入一次发出"""
+    window.append("assistant", reply)
+    window.trim_after_reply(MAX_HISTORY_TOKENS, history_stable)
+    writes = request_writes()
+    if conversation_store.is_local(conversation_id):
+        # 降级期间写过本地的对话继续写本地，直到恢复后统一写回
+        conversation_store.save_local(conversation_id, window)
+    else:
+        writes.add(
+            conversation_store.queue_window, conversation_id, window,
+            callback=lambda results: conversation_store.saved(conversation_id, window, results),
+            client=conversation_store.client
+        )
+    try:
+        writes.execute()
+    except redis.RedisError as e:
+        if local_fallback is None:
+            raise
+        logger.warning(f"Redis写入失败，本轮对话暂存在本地: {str(e)}")
+        # 对话所在节点写入成功时窗口已经标记为保存过，没有待写的消息
+        _, unsaved = window.pending()
+        if unsaved and not conversation_store.is_local(conversation_id):
+            conversation_store.save_local(conversation_id, window)
+    if compactor is not None:
+        compactor.maybe_submit(conversation_id, window)
+
+
+def record_usage(conversation_id, window, usage):
+    """上游返回的usage：统计上下文缓存命中，并用prompt_tokens校准token估算"""
+    if usage is None:
+        return
+    request_writes().add(prompt_cache_stats.queue_record, conversation_id, usage)
+    prompt_tokens = usage.get('prompt_tokens', 0) if isinstance(usage, dict) else usage.prompt_tokens
+    token_counter.calibrate([msg["content"] for msg in window.messages()], prompt_tokens)
+
+
+def admission_rejected(e):
+    logger.warning(f"准入被拒绝，{e.retry_after}秒后重试")
+    count_error('admission')
+    response = jsonify({'error': '请求过于频繁，请稍后再试'})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+def post_completion(data):
+    """经过准入控制的非流式上游调用，返回解析后的响应"""
+    lease = admission.acquire() if admission is not None else None
+    try:
+        logger.info("发送API请求...")
+        response = upstream.post(data)
+    finally:
+        if lease is not None:
+            lease.release()
+    response.raise_for_status()
+
+    response_data = response.json()
+    logger.debug(f"API响应: {response_data}")
+    return response_data
+
+
+def summarize(data):
+    return post_completion(data)['choices'][0]['message']['content']
+
+
+def fetch_completion(data, cache_key, conversation_id, window):
+    response_data = post_completion(data)
+    record_usage(conversation_id, window, response_data.get('usage'))
+
+    ai_response = response_data['choices'][0]['message']['content']
+    if cache_key:
+        request_writes().add(response_cache.queue_set, cache_key, ai_response, callback=response_cache.set_done)
+    return ai_response
+
+
+def upstream_frames(response, parser, coalescer, received, timings, flight=None, buffer=None):
+    """把上游的原始字节转成发给浏览器的帧，收到的文本追加到received并记入timings；buffer不为空时帧写入续传缓冲并带上id"""
+    if stream_passthrough:
+        # 不重新编码，前端直接解析DeepSeek的原始帧
+        for chunk in response.iter_chunks():
+            frames = parser.frames
+            text = parser.text(chunk)
+            if text:
+                received.append(text)
+                timings.token()
+                if flight is not None:
+                    flight.publish(text)
+            pending = coalescer.add(chunk, parser.frames - frames)
+            if pending:
+                yield pending
+            if parser.done:
+                break
+        pending = coalescer.flush()
+        if pending:
+            yield pending
+    else:
+        for chunk in response.iter_chunks():
+            for payload in parser.feed(chunk):
+                content = parser.decode(payload)
+                if not content:
+                    continue
+                received.append(content)
+                timings.token()
+                pending = coalescer.add(content)
+                if pending:
+                    if flight is not None:
+                        flight.publish(pending)
+                    yield sse_frame(pending, buffer.append(pending) if buffer is not None else None)
+            # 不含内容的数据块（比如上游思考时的keep-alive）也要把窗口到期的内容发出去
+            pending = coalescer.poll()
+            if pending:
+                if flight is not None:
+                    flight.publish(pending)
+                yield sse_frame(pending, buffer.append(pending) if buffer is not None else None)
+            if parser.done:
+                break
+        pending = coalescer.flush()
+        if pending:
+            if flight is not None:
+                flight.publish(pending)
+            yield sse_frame(pending, buffer.append(pending) if buffer is not None else None)
+
+
+def relay_upstream(data, parser, coalescer, received, flight=None, buffer=None, detach=None):
+    """调用上游并产出发给浏览器的帧；flight不为空时把输出共享给follower，buffer不为空时写入续传缓冲。
+
+    浏览器断开时生成器被close：有follower在等或者可续传时，把上游连接和剩下的读取交给后台线程
+    （drain_upstream），用detach(future)通知调用方后立即返回，不占着处理请求的线程；
+    否则随with退出关闭上游连接，不再为没人看的token付费。
+    """
+    timings = stream_timings()
+    with ExitStack() as stack:
+        response = stack.enter_context(upstream.stream(data))
+        frames = upstream_frames(response, parser, coalescer, received, timings, flight, buffer)
+        for frame in frames:
+            try:
+                yield frame
+            except GeneratorExit:
+                followed = flight is not None and singleflight.followed(flight)
+                if detach is None or not (followed or buffer is not None):
+                    raise
+                detach(drain_executor.submit(drain_upstream, stack.pop_all(), frames, followed, buffer))
+                return
+
+    timings.finish(parser.usage.completion_tokens if parser.usage is not None else None)
+    if parser.errors:
+        logger.warning(f"JSON解析错误: {parser.errors}帧")
+
+
+def drain_upstream(stack, frames, followed, buffer):
+    """后台线程：浏览器断开后继续读上游。有follower在等就读完；否则等resumable.grace秒，
+    期间有客户端来续传也读完，没有就关闭上游连接（退出stack时关闭）"""
+    with stack:
+        deadline = None
+        if followed:
+            logger.info("客户端已断开，仍有相同请求在等待输出，后台继续读完上游")
+            disconnect_stats.record_drained()
+        else:
+            logger.info(f"客户端已断开，{resumable.grace}秒内重连可以续传")
+            deadline = time.monotonic() + resumable.grace
+        try:
+            for _ in frames:
+                if deadline is not None and time.monotonic() >= deadline:
+                    if not buffer.resumed():
+                        logger.info("没有客户端续传，关闭上游连接")
+                        return
+                    disconnect_stats.record_drained()
+                    deadline = None
+        except Exception as e:
+            logger.warning(f"断开后读取上游失败: {str(e)}")
+        finally:
+            frames.close()
+
+
+def submit_generation(data, conversation_id, window):
+    """把本轮用户消息和生成任务一起写入，返回任务id；降级到本地的对话或任务没能写入时返回None，由本进程调用上游"""
+    if conversation_store.is_local(conversation_id):
+        return None
+    job_id = generation_queue.new_job_id()
+    submitted = []
+    writes = request_writes()
+    writes.add(
+        conversation_store.queue_window, conversation_id, window,
+        callback=lambda results: conversation_store.saved(conversation_id, window, results),
+        client=conversation_store.client
+    )
+    writes.add(
+        generation_queue.queue_submit, job_id, conversation_id, data,
+        callback=lambda results: submitted.append(not isinstance(results[0], Exception))
+    )
+    try:
+        writes.execute()
+    except redis.RedisError as e:
+        # 分片时对话和任务在不同节点上，任务已经写入的话仍由worker生成
+        if not (submitted and submitted[0]):
+            logger.warning(f"提交生成任务失败，由本进程调用上游: {str(e)}")
+            return None
+    return job_id
+
+
+def relay_generation(job_id, received, flight=None, drained=None):
+    """转发generation worker写进续传缓冲的输出。
+
+    浏览器断开时有follower在等就继续转发给它们，全部转发完后调用drained()；
+    否则通知worker，grace秒内没有客户端续传就停止生成。等不到worker的输出（排队或中途停顿超过
+    wait_timeout秒）时也通知worker取消，免得这轮回答在用户发了后面的消息之后才写进对话。
+    """
+    frames = resumable.follow(job_id, timeout=generation_queue.wait_timeout)
+    try:
+        for event_id, content in frames:
+            received.append(content)
+            if flight is not None:
+                flight.publish(content)
+            try:
+                yield sse_frame(content, event_id)
+            except GeneratorExit:
+                if flight is None or not singleflight.followed(flight):
+                    resumable.cancel(job_id)
+                    raise
+                logger.info("客户端已断开，仍有相同请求在等待输出，继续转发")
+                disconnect_stats.record_drained()
+                try:
+                    for _, content in frames:
+                        received.append(content)
+                        flight.publish(content)
+                except ResumeError as e:
+                    logger.warning(f"断开后读取生成输出失败: {str(e)}")
+                    raise GeneratorExit
+                if drained is not None:
+                    drained()
+                return
+    except ResumeError:
+        resumable.cancel(job_id)
+        raise
+
+
+def relay_flight(flight, coalescer, received):
+    """作为follower转发leader的输出"""
+    for content in flight.follow(upstream.timeout[1]):
+        received.append(content)
+        pending = coalescer.add(content)
+        if pending:
+            yield sse_frame(pending)
+    pending = coalescer.flush()
+    if pending:
+        yield sse_frame(pending)
+
+
+def save_partial(conversation_id, window, received, aborted):
+    """浏览器中途断开：保存已经生成的部分回答，并记录断开统计"""
+    partial = ''.join(received)
+    disconnect_stats.record_disconnect(aborted, token_counter.count(partial) if aborted else 0)
+    logger.info(f"客户端中途断开，已生成{len(partial)}字{'，已关闭上游连接' if aborted else ''}")
+    if not partial:
+        return
+    try:
+        close_window(conversation_id, window, partial)
+    except Exception as e:
+        logger.error(f"保存部分回答失败: {str(e)}")
 
 # 确保API密钥已设置
 if not os.getenv("DEEPSEEK_API_KEY"):
     logger.error("DeepSeek API密钥未配置！请设置DEEPSEEK_API_KEY环境变量")
     raise ValueError("DeepSeek API密钥未配置！请设置DEEPSEEK_API_KEY环境变量")
 
+# 浏览器断开后继续读上游（为follower或等待续传）的后台线程；每个线程占着一个上游连接，
+# 所以默认和上游连接池一样大
+drain_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("DRAIN_THREADS", os.getenv("UPSTREAM_POOL_SIZE", "10"))),
+    thread_name_prefix='drain'
+)
+
+# 上游客户端：每个worker共享一个持久连接池，避免每条消息都重新做TCP+TLS握手
+upstream = UpstreamClient(
+    api_url,
+    os.getenv("DEEPSEEK_API_KEY"),
+    pool_size=int(os.getenv("UPSTREAM_POOL_SIZE", "10")),
+    pool_timeout=float(os.getenv("UPSTREAM_POOL_TIMEOUT", "5")),
+    connect_timeout=float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "3.05")),
+    read_timeout=float(os.getenv("UPSTREAM_READ_TIMEOUT", "30")),
+    max_retries=int(os.getenv("UPSTREAM_MAX_RETRIES", "2")),
+    retry_budget=float(os.getenv("UPSTREAM_RETRY_BUDGET", "10")),
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5")),
+        reset_timeout=float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+    ),
+    connect_metric=upstream_connect
+)
+
 @app.route('/')
 def index():
-    session.permanent = True
-    if 'history' not in session:
-        session['history'] = []
     return render_template('index.html')
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
-    if 'history' not in session:
-        session['history'] = []
-
     user_message = request.json.get('message')
     logger.info(f"收到用户消息: {user_message}")
-    session['history'].append({"role": "user", "content": user_message})
-
     # 智能历史管理
-    max_tokens = 3000
-    current_tokens = sum(len(msg["content"]) for msg in session['history']) // 4
-    logger.debug(f"当前token数: {current_tokens}/{max_tokens}")
-
-    # 如果token超限，移除最旧的消息
-    while current_tokens > max_tokens and len(session['history']) > 1:
-        removed = session['history'].pop(0)
-        removed_tokens = len(removed["content"]) // 4
-        current_tokens -= removed_tokens
-        logger.debug(f"移除旧消息: {removed['content'][:20]}... (节省{removed_tokens} tokens)")
-
-    headers = {
-        'Authorization': f'Bearer {os.getenv("DEEPSEEK_API_KEY")}',
-        'Content-Type': 'application/json',
-        'Accept': 'application/json'
-    }
+    conversation_id, window = open_conversation(user_message)
+
     data = {
         "model": "deepseek-chat",
-        "messages": session['history'],
+        "messages": window.messages(),
         "stream": False,
         "max_tokens": 1000
     }
+    cache_key = response_cache.make_key(data) if response_cache.enabled else None
 
     try:
-        logger.info("发送API请求...")
-        response = requests.post(api_url, json=data, headers=headers, timeout=30)
-        response.raise_for_status()
-
-        response_data = response.json()
-        logger.debug(f"API响应: {response_data}")
-
-        ai_response = response_data['choices'][0]['message']['content']
+        ai_response, is_leader, flight = lookup(cache_key, payload_hash(data))
+        if ai_response is not None:
+            logger.info("命中响应缓存")
+        elif flight is None:
+            ai_response = fetch_completion(data, cache_key, conversation_id, window)
+        else:
+            if is_leader:
+                try:
+                    ai_response = fetch_completion(data, cache_key, conversation_id, window)
+                except Exception:
+                    singleflight.done(flight, 'API请求失败')
+                    raise
+                flight.publish(ai_response)
+                singleflight.done(flight)
+            else:
+                logger.info("合并到进行中的相同请求")
+                ai_response = ''.join(flight.follow(upstream.timeout[1]))
         logger.info(f"AI响应: {ai_response[:50]}...")
 
-        session['history'].append({"role": "assistant", "content": ai_response})
-
-        # 再次检查token数量
-        ai_tokens = len(ai_response) // 4
-        if current_tokens + ai_tokens > max_tokens * 1.1:
-            if len(session['history']) > 2:
-                logger.debug("清理历史记录")
-                session['history'] = session['history'][2:]
+        close_window(conversation_id, window, ai_response)
 
         return jsonify({'response': ai_response})
 
     except requests.exceptions.HTTPError as e:
         logger.error(f"HTTP错误: {e.response.status_code} - {e.response.text}")
+        count_error('upstream_http')
         error_msg = "API请求失败"
         if e.response.status_code == 401:
             error_msg = "API密钥无效"
@@ -115,116 +685,273 @@ def chat():
 
     except requests.exceptions.Timeout:
         logger.error("API请求超时")
+        count_error('upstream_timeout')
         return jsonify({'error': 'API请求超时，请稍后重试'}), 504
 
+    except CircuitOpenError:
+        logger.error("上游熔断中，快速失败")
+        count_error('circuit_open')
+        return jsonify({'error': '服务暂时不可用，请稍后再试'}), 503
+
+    except PoolTimeout:
+        logger.error("上游连接池已满，等待空闲连接超时")
+        count_error('upstream_pool')
+        return jsonify({'error': '服务繁忙，请稍后再试'}), 503
+
+    except AdmissionRejected as e:
+        return admission_rejected(e)
+
+    except FlightError as e:
+        logger.error(f"合并请求失败: {str(e)}")
+        count_error('flight')
+        return jsonify({'error': 'API请求失败'}), 502
+
     except requests.exceptions.RequestException as e:
         logger.error(f"网络错误: {str(e)}")
+        count_error('network')
         return jsonify({'error': '网络连接失败，请检查网络设置'}), 503
 
     except Exception as e:
         logger.error(f"未知错误: {str(e)}")
+        count_error('internal')
         return jsonify({'error': '系统内部错误'}), 500
 
 @app.route('/api/stream-chat', methods=['POST'])
 def stream_chat():
-    if 'history' not in session:
-        session['history'] = []
+    last_event_id = request.headers.get('Last-Event-ID')
+    if last_event_id and resumable is not None:
+        return resume_stream(last_event_id)
 
     user_message = request.json.get('message')
     logger.info(f"收到流式请求: {user_message}")
-    session['history'].append({"role": "user", "content": user_message})
-
-    max_tokens = 3000
-    current_tokens = sum(len(msg["content"]) for msg in session['history']) // 4
+    conversation_id, window = open_conversation(user_message)
 
-    # 如果token超限，移除最旧的消息
-    while current_tokens > max_tokens and len(session['history']) > 1:
-        removed = session['history'].pop(0)
-        removed_tokens = len(removed["content"]) // 4
-        current_tokens -= removed_tokens
+    data = {
+        "model": "deepseek-chat",
+        "messages": window.messages(),
+        "stream": True,
+        "stream_options": {"include_usage": True},
+        "max_tokens": 1000
+    }
+    cache_key = response_cache.make_key(data) if response_cache.enabled else None
+
+    # 缓存查询、请求合并和准入都在开始流式响应之前完成，被拒绝时还能返回429状态码
+    cached, is_leader, flight = lookup(cache_key, payload_hash(data))
+    lease = None
+    if cached is None:
+        if flight is None or is_leader:
+            try:
+                lease = admission.acquire() if admission is not None else None
+            except AdmissionRejected as e:
+                if is_leader:
+                    singleflight.done(flight, 'API请求失败')
+                return admission_rejected(e)
 
     # 使用stream_with_context包装生成器函数，保持请求上下文
     @stream_with_context
     def generate():
-        headers = {
-            'Authorization': f'Bearer {os.getenv("DEEPSEEK_API_KEY")}',
-            'Content-Type': 'application/json',
-            'Accept': 'text/event-stream'
-        }
-        data = {
-            "model": "deepseek-chat",
-            "messages": session['history'],  # 现在可以安全访问session
-            "stream": True,
-            "max_tokens": 1000
-        }
-
-        full_response = ""
+        received = []
+        parser = SSEParser()
+        coalescer = DeltaCoalescer(coalesce_bytes, coalesce_window, coalesce_stats)
+        buffer = None
+        job_id = None
+        completed = False
+        disconnected = False
+        detached = []
+        drained = []
+        started.append(True)
+
+        def finish(completed):
+            coalescer.flush()
+            if lease is not None:
+                lease.release()
+            if is_leader:
+                singleflight.done(flight, None if completed else 'API请求失败')
+            if buffer is not None:
+                buffer.finish(None if completed else 'API请求失败')
+
+        def finish_disconnected(future=None):
+            # 浏览器断开：上游已经关闭，或者由后台线程读完/放弃之后调用
+            upstream_call = cached is None and (flight is None or is_leader)
+            completed = upstream_call and bool(parser.done or parser.finish_reason)
+            save_partial(conversation_id, window, received, upstream_call and not completed)
+            finish(completed)
 
         try:
-            logger.info("发送流式API请求...")
-            with requests.post(api_url, json=data, headers=headers, stream=True, timeout=30) as response:
-                response.raise_for_status()
-
-                for line in response.iter_lines():
-                    if line:
-                        line_text = line.decode('utf-8')
-                        if line_text.startswith('data:'):
-                            try:
-                                json_data = json.loads(line_text[5:])
-                                if (json_data.get('choices') and
-                                        len(json_data['choices']) > 0 and
-                                        'delta' in json_data['choices'][0] and
-                                        'content' in json_data['choices'][0]['delta']):
-                                    content = json_data['choices'][0]['delta']['content']
-                                    full_response += content
-                                    logger.debug(f"发送内容块: {content}")
-                                    yield f"data: {json.dumps({'content': content})}\n\n"
-
-                            except json.JSONDecodeError:
-                                logger.warning("JSON解析错误")
-                                continue
+            if cached is not None:
+                # 命中缓存时按流式格式回放，前端无感知
+                logger.info("命中响应缓存")
+                for piece in replay_chunks(cached, coalesce_bytes or 64):
+                    received.append(piece)
+                    yield sse_frame(piece)
+            elif flight is not None and not is_leader:
+                logger.info("合并到进行中的相同流式请求")
+                yield from relay_flight(flight, coalescer, received)
+            else:
+                job_id = submit_generation(data, conversation_id, window) if generation_queue is not None else None
+                if job_id is not None:
+                    # worker负责保存回答、统计usage和写响应缓存
+                    logger.info("交给generation worker生成...")
+                    yield from relay_generation(job_id, received, flight, lambda: drained.append(True))
+                else:
+                    logger.info("发送流式API请求...")
+                    buffer = resumable.start() if resumable is not None else None
+                    yield from relay_upstream(data, parser, coalescer, received, flight, buffer, detached.append)
+                    record_usage(conversation_id, window, parser.usage)
+                    if parser.usage is not None:
+                        disconnect_stats.record_completion(parser.usage.completion_tokens)
+
+                    # 只缓存完整收到的回答
+                    if cache_key and received and (parser.done or parser.finish_reason):
+                        request_writes().add(
+                            response_cache.queue_set, cache_key, ''.join(received), callback=response_cache.set_done
+                        )
+            full_response = ''.join(received)
+            completed = True
 
             logger.info(f"完整响应: {full_response[:50]}...")
-            # 在请求上下文中更新session
-            session['history'].append({"role": "assistant", "content": full_response})
-
-            # 再次检查token数量
-            ai_tokens = len(full_response) // 4
-            if current_tokens + ai_tokens > max_tokens * 1.1:
-                if len(session['history']) > 2:
-                    session['history'] = session['history'][2:]
+            if job_id is None:
+                # 流结束时session早已写回，回答直接追加到对话列表
+                close_window(conversation_id, window, full_response)
+
+        except GeneratorExit:
+            disconnected = True
+            if job_id is not None:
+                # 是否停止生成、保存哪些内容由worker决定；为follower转发完了全部输出时按正常结束通知它们
+                disconnect_stats.record_disconnect()
+                finish(bool(drained))
+                return
+            if detached:
+                # 上游交给了后台线程，读完或放弃之后再保存回答、结束缓冲和请求合并、释放名额
+                detached[0].add_done_callback(copy_current_request_context(finish_disconnected))
+                return
+            finish_disconnected()
 
         except requests.exceptions.HTTPError as e:
             logger.error(f"流式HTTP错误: {e.response.status_code} - {e.response.text}")
+            count_error('upstream_http')
             yield f"data: {json.dumps({'error': 'API请求失败'})}\n\n"
 
         except requests.exceptions.Timeout:
             logger.error("流式请求超时")
+            count_error('upstream_timeout')
             yield f"data: {json.dumps({'error': '请求超时'})}\n\n"
 
+        except CircuitOpenError:
+            logger.error("上游熔断中，流式请求快速失败")
+            count_error('circuit_open')
+            yield f"data: {json.dumps({'error': '服务暂时不可用，请稍后再试'})}\n\n"
+
+        except PoolTimeout:
+            logger.error("上游连接池已满，等待空闲连接超时")
+            count_error('upstream_pool')
+            yield f"data: {json.dumps({'error': '服务繁忙，请稍后再试'})}\n\n"
+
         except requests.exceptions.RequestException as e:
             logger.error(f"流式网络错误: {str(e)}")
+            count_error('network')
             yield f"data: {json.dumps({'error': '网络连接失败'})}\n\n"
 
+        except FlightError as e:
+            logger.error(f"合并流式请求失败: {str(e)}")
+            count_error('flight')
+            yield f"data: {json.dumps({'error': 'API请求失败'})}\n\n"
+
+        except ResumeError as e:
+            logger.error(f"generation worker生成失败: {str(e)}")
+            count_error('generation')
+            yield f"data: {json.dumps({'error': 'API请求失败'})}\n\n"
+
         except Exception as e:
             logger.error(f"流式未知错误: {str(e)}")
+            count_error('internal')
             yield f"data: {json.dumps({'error': '系统内部错误'})}\n\n"
 
         finally:
-            # 确保关闭流
-            yield "data: [DONE]\n\n"
+            if not disconnected:
+                finish(completed)
+            # 确保关闭流（透传模式下上游的[DONE]已经转发过；浏览器已断开时不能再产出）
+            if not disconnected and not (stream_passthrough and parser.done):
+                yield "data: [DONE]\n\n"
+
+    def release_unstarted():
+        # 客户端在流开始前断开时生成器不会执行，这里兜底释放并发名额；开始了的流由生成器或后台线程释放
+        if not started:
+            lease.release()
+
+    started = []
+    response = Response(generate(), mimetype='text/event-stream')
+    if lease is not None:
+        response.call_on_close(release_unstarted)
+    return response
+
+def resume_stream(last_event_id):
+    """断线重连：从续传缓冲补发Last-Event-ID之后的帧，再接着转发后续的帧，不调用上游"""
+    logger.info(f"续传流式响应: {last_event_id}")
+
+    def generate():
+        try:
+            for event_id, content in resumable.resume(last_event_id, upstream.timeout[1]):
+                yield sse_frame(content, event_id)
+        except ResumeError as e:
+            logger.warning(f"续传失败: {str(e)}")
+            count_error('resume', 'stream_chat')
+            yield f"data: {json.dumps({'error': '生成已中断，请重新提问'})}\n\n"
+        yield "data: [DONE]\n\n"
 
     return Response(generate(), mimetype='text/event-stream')
 
 @app.route('/api/clear_history', methods=['POST'])
 def clear_history():
     logger.info("清除历史记录")
-    session['history'] = []
+    conversation_id = session.get('conv_id')
+    if conversation_id is not None:
+        conversation_store.clear(conversation_id)
+    session.pop('history', None)
     return jsonify({'status': '历史记录已清除'})
 
+@app.route('/api/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        'upstream': upstream.stats(),
+        'stream': dict(coalesce_stats.stats(), **disconnect_stats.stats()),
+        'response_cache': response_cache.stats(),
+        'singleflight': singleflight.stats() if singleflight is not None else None,
+        'resumable': resumable.stats() if resumable is not None else None,
+        'generation': generation_queue.stats() if generation_queue is not None else None,
+        'admission': admission.stats() if admission is not None else None,
+        'prompt_cache': {
+            'global': prompt_cache_stats.stats(),
+            'conversation': prompt_cache_stats.conversation_stats(session.get('conv_id', ''))
+        },
+        'tokenizer': token_counter.stats(),
+        'compaction': compactor.stats() if compactor is not None else None,
+        'compression': payload_codec.stats(),
+        'session': app.session_interface.stats(),
+        'l1_cache': window_cache.stats() if window_cache is not None else None,
+        'fallback': local_fallback.stats() if local_fallback is not None else None,
+        'redis': dict(redis_timer.stats(), breaker=redis_breaker.stats())
+    })
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def create_app():
+    """生产环境入口：gunicorn -c gunicorn.conf.py 'app:create_app()'。
+
+    这不是真正的工厂，只是给preload用的入口，每次调用都返回同一个模块级的app：组件在导入时按环境变量
+    创建（preload时只在master里做一次），不能在同一进程里创建多个配置不同的实例。Redis连接池和后台线程
+    都在第一次使用时按进程建立，fork之后各worker互不共享连接。
+    """
+    return app
+
+
 if __name__ == '__main__':
-    # 设置详细日志级别
+    # 开发服务器：单进程、带重载器，只用于本地调试
     logger.setLevel(logging.DEBUG)
 
     # 启动应用
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=int(os.getenv("PORT", "5000")), debug=True)
\ No newline at end of file
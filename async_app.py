@@ -0,0 +1,377 @@
+import asyncio
+import json
+import logging
+import os
+import secrets
+from datetime import timedelta
+
+import aiohttp
+import msgspec
+import redis.asyncio as aioredis
+from aiohttp import web
+
+from admission import AdmissionRejected, AsyncAdmissionController
+from codec import PayloadCodec
+from conversation import (
+    MAX_HISTORY_TOKENS, ConversationWindow, queue_load, queue_save
+)
+from sharding import HashRing
+from sse import DeltaCoalescer, SSEParser
+from tokenizer import load_counter
+
+# 异步流式接口：与app.py共用同一个Redis session和SSE协议（data: {...} / data: [DONE]），
+# 单进程靠事件循环同时挂起成千上万条生成中的流，而不是每条流占一个线程。
+# 部署时由反向代理把 /api/stream-chat 转发到这里：
+#   gunicorn 'async_app:create_app()' --worker-class aiohttp.GunicornWebWorker
+# 与app.py共用准入控制（admission.py的同一组键和Lua脚本，ADMISSION*环境变量）。
+# app.py流式接口的以下功能这里还没有：上游重试和熔断、响应缓存、请求合并（singleflight）、
+# 上下文缓存统计、可续传的流、generation worker和 /metrics；需要这些功能的流量仍转发给app.py。
+logger = logging.getLogger('DeepSeekChat')
+
+api_url = os.getenv("DEEPSEEK_API_URL", "https://api.deepseek.com/v1/chat/completions")
+
+# 与app.py中flask_session的默认配置保持一致
+SESSION_COOKIE_NAME = 'session'
+SESSION_KEY_PREFIX = 'session:'
+SESSION_LIFETIME = timedelta(days=1)
+SESSION_PERMANENT = True
+SESSION_REFRESH_THRESHOLD = SESSION_LIFETIME.total_seconds() * float(os.getenv("SESSION_REFRESH_RATIO", "0.5"))
+CONVERSATION_KEY_PREFIX = 'conv:'
+
+history_stable = os.getenv("HISTORY_WINDOW_MODE", "stable") != "legacy"
+history_trim_target = float(os.getenv("HISTORY_TRIM_TARGET", "0.5"))
+
+# 与app.py相同的透传模式开关
+stream_passthrough = os.getenv("STREAM_PASSTHROUGH", "0") == "1"
+coalesce_bytes = int(os.getenv("STREAM_COALESCE_BYTES", "256"))
+coalesce_window = float(os.getenv("STREAM_COALESCE_MS", "20")) / 1000
+
+token_counter = load_counter(
+    os.getenv("TOKENIZER_PATH"),
+    cache_size=int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+)
+
+# 与app.py相同的压缩设置，两边写入的值互相可读
+payload_codec = PayloadCodec(
+    os.getenv("COMPRESSION", "zlib"),
+    threshold=int(os.getenv("COMPRESSION_THRESHOLD", "512")),
+    level=int(os.environ["COMPRESSION_LEVEL"]) if os.getenv("COMPRESSION_LEVEL") else None
+)
+
+_encoder = msgspec.msgpack.Encoder()
+_decoder = msgspec.msgpack.Decoder()
+
+
+class ClientDisconnected(Exception):
+    """浏览器已断开，写不回去了"""
+
+
+async def send(response, data):
+    """写给浏览器。aiohttp 3.10起写已断开的连接抛出的ClientConnectionResetError同时是aiohttp.ClientError的子类，
+    这里换成ClientDisconnected，和上游的网络错误分开处理"""
+    try:
+        await response.write(data)
+    except ConnectionResetError as e:
+        raise ClientDisconnected(str(e)) from e
+
+
+def encode_frame(pending):
+    """合并后的内容转成发给浏览器的字节：透传模式下已经是上游的原始帧"""
+    if stream_passthrough:
+        return pending
+    return f"data: {json.dumps({'content': pending})}\n\n".encode('utf-8')
+
+
+def new_session():
+    """和flask_session新建的session一样：带_permanent标记"""
+    return secrets.token_urlsafe(32), {'_permanent': SESSION_PERMANENT}, None
+
+
+async def load_session(shards, sid):
+    """返回 (sid, session数据, 剩余有效期秒数)；新建的session剩余有效期为None"""
+    if not sid:
+        return new_session()
+    async with shards.get(sid).pipeline(transaction=False) as pipe:
+        pipe.get(SESSION_KEY_PREFIX + sid)
+        pipe.ttl(SESSION_KEY_PREFIX + sid)
+        raw, ttl = await pipe.execute()
+    if raw is None:
+        # 与flask_session一样，过期或不存在的sid不复用
+        return new_session()
+    try:
+        return sid, _decoder.decode(payload_codec.decode(raw)), ttl
+    except msgspec.DecodeError:
+        logger.warning("session解码失败，重新创建")
+        return new_session()
+
+
+async def save_session(shards, sid, data):
+    await shards.get(sid).set(
+        SESSION_KEY_PREFIX + sid,
+        payload_codec.encode(_encoder.encode(data)),
+        ex=int(SESSION_LIFETIME.total_seconds())
+    )
+
+
+async def load_conversation(shards, sid, session_data):
+    """与ConversationStore相同的列表格式；返回 (对话id, 对话窗口, session是否需要写回)。
+
+    与app.open_conversation一样，新对话的id就是session的sid，app.py读session时能顺带预取对话。
+    """
+    conversation_id = session_data.get('conv_id')
+    if conversation_id is not None:
+        async with shards.get(conversation_id).pipeline(transaction=False) as pipe:
+            queue_load(pipe, CONVERSATION_KEY_PREFIX + conversation_id)
+            results = await pipe.execute()
+        return conversation_id, ConversationWindow.decode(token_counter, *results, codec=payload_codec), False
+
+    conversation_id = sid
+    session_data['conv_id'] = conversation_id
+    window = ConversationWindow(token_counter)
+    # 旧版本session里的history作为新消息随本轮一起写入列表
+    for msg in session_data.pop('history', None) or []:
+        window.append(msg["role"], msg["content"])
+    return conversation_id, window, True
+
+
+async def save_conversation(shards, conversation_id, window):
+    async with shards.get(conversation_id).pipeline(transaction=True) as pipe:
+        queue_save(
+            pipe, CONVERSATION_KEY_PREFIX + conversation_id, window,
+            int(SESSION_LIFETIME.total_seconds()), payload_codec
+        )
+        await pipe.execute()
+    window.mark_saved()
+
+
+async def stream_chat(request):
+    shards = request.app['redis']
+    http = request.app['http']
+
+    body = await request.json()
+    user_message = body.get('message')
+    logger.info(f"收到异步流式请求: {user_message}")
+
+    sid, session_data, remaining = await load_session(shards, request.cookies.get(SESSION_COOKIE_NAME))
+    conversation_id, window, session_changed = await load_conversation(shards, sid, session_data)
+    if session_changed:
+        # session里只有对话id，只在新建对话时写一次
+        await save_session(shards, sid, session_data)
+    elif remaining is not None and 0 <= remaining < SESSION_REFRESH_THRESHOLD:
+        # 与app.py相同的滑动过期：有效期过半才续期
+        await shards.get(sid).expire(SESSION_KEY_PREFIX + sid, int(SESSION_LIFETIME.total_seconds()))
+    window.append("user", user_message)
+    window.trim(MAX_HISTORY_TOKENS, history_stable, history_trim_target)
+
+    data = {
+        "model": "deepseek-chat",
+        "messages": window.messages(),
+        "stream": True,
+        "stream_options": {"include_usage": True},
+        "max_tokens": 1000
+    }
+
+    # 与app.py一样在读完session和对话之后、开始流式响应之前准入，被拒绝时还能返回429；
+    # 拿到名额之后的所有操作都在下面的try里，任何失败都会释放名额
+    lease = None
+    if request.app['admission'] is not None:
+        try:
+            lease = await request.app['admission'].acquire()
+        except AdmissionRejected as e:
+            logger.warning(f"准入被拒绝，{e.retry_after}秒后重试")
+            return web.json_response(
+                {'error': '请求过于频繁，请稍后再试'}, status=429, headers={'Retry-After': str(e.retry_after)}
+            )
+
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+    response.set_cookie(
+        SESSION_COOKIE_NAME, sid,
+        max_age=int(SESSION_LIFETIME.total_seconds()),
+        httponly=True
+    )
+    full_response = ""
+    error = None
+    parser = SSEParser()
+    coalescer = DeltaCoalescer(coalesce_bytes, coalesce_window)
+
+    try:
+        try:
+            await response.prepare(request)
+        except ConnectionResetError as e:
+            raise ClientDisconnected(str(e)) from e
+
+        logger.info("发送异步流式API请求...")
+        async with http.post(api_url, json=data) as upstream_response:
+            upstream_response.raise_for_status()
+
+            chunks = upstream_response.content.iter_any()
+            while True:
+                # 缓冲里有内容时最多等到合并窗口结束，上游停顿（比如长时间推理）时先把已有的内容发出去
+                remaining = coalescer.remaining()
+                try:
+                    if remaining is None:
+                        chunk = await chunks.__anext__()
+                    else:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), remaining)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError as e:
+                    # 上游读超时（aiohttp.ServerTimeoutError）也是TimeoutError的子类，交给外层处理
+                    if isinstance(e, aiohttp.ClientError):
+                        raise
+                    await send(response, encode_frame(coalescer.expire()))
+                    continue
+
+                if stream_passthrough:
+                    frames = parser.frames
+                    full_response += parser.text(chunk)
+                    pending = coalescer.add(chunk, parser.frames - frames)
+                    if pending:
+                        await send(response, pending)
+                else:
+                    for payload in parser.feed(chunk):
+                        content = parser.decode(payload)
+                        if content:
+                            full_response += content
+                            pending = coalescer.add(content)
+                            if pending:
+                                await send(response, encode_frame(pending))
+                if parser.done:
+                    break
+
+            pending = coalescer.flush()
+            if pending:
+                await send(response, encode_frame(pending))
+
+        logger.info(f"完整异步响应: {full_response[:50]}...")
+        if parser.usage is not None:
+            token_counter.calibrate([msg["content"] for msg in data["messages"]], parser.usage.prompt_tokens)
+        window.append("assistant", full_response)
+        window.trim_after_reply(MAX_HISTORY_TOKENS, history_stable)
+
+        await save_conversation(shards, conversation_id, window)
+
+    except (ClientDisconnected, asyncio.CancelledError) as e:
+        # 浏览器已断开（aiohttp 3.9起断开不再取消处理函数，在下一次写回时发现），不再写回；
+        # 退出async with时已关闭上游连接，只保存已经生成的部分
+        logger.info(f"客户端断开异步流，已生成{len(full_response)}字")
+        cancelled = isinstance(e, asyncio.CancelledError)
+        if full_response:
+            window.append("assistant", full_response)
+            window.trim_after_reply(MAX_HISTORY_TOKENS, history_stable)
+            try:
+                await asyncio.shield(save_conversation(shards, conversation_id, window))
+            except Exception as e:
+                logger.error(f"保存部分回答失败: {str(e)}")
+        if cancelled:
+            raise
+        return response
+
+    except aiohttp.ClientResponseError as e:
+        logger.error(f"异步流式HTTP错误: {e.status} - {e.message}")
+        error = 'API请求失败'
+
+    except asyncio.TimeoutError:
+        logger.error("异步流式请求超时")
+        error = '请求超时'
+
+    except aiohttp.ClientError as e:
+        logger.error(f"异步流式网络错误: {str(e)}")
+        error = '网络连接失败'
+
+    except Exception as e:
+        logger.error(f"异步流式未知错误: {str(e)}")
+        error = '系统内部错误'
+
+    finally:
+        if lease is not None:
+            await lease.release()
+
+    try:
+        if error is not None:
+            await send(response, f"data: {json.dumps({'error': error})}\n\n".encode('utf-8'))
+        if not (stream_passthrough and parser.done):
+            await send(response, b"data: [DONE]\n\n")
+        await response.write_eof()
+    except (ClientDisconnected, ConnectionResetError):
+        logger.info("客户端已断开，没有发送结束帧")
+    return response
+
+
+async def on_startup(app):
+    # 连接池在事件循环内创建，每个worker一份
+    connector = aiohttp.TCPConnector(
+        limit=int(os.getenv("UPSTREAM_POOL_SIZE", "100")),
+        keepalive_timeout=60
+    )
+    app['http'] = aiohttp.ClientSession(
+        connector=connector,
+        headers={
+            'Authorization': f'Bearer {os.getenv("DEEPSEEK_API_KEY")}',
+            'Content-Type': 'application/json',
+            'Accept': 'text/event-stream'
+        },
+        timeout=aiohttp.ClientTimeout(
+            sock_connect=float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "3.05")),
+            sock_read=float(os.getenv("UPSTREAM_READ_TIMEOUT", "30"))
+        )
+    )
+
+
+async def on_cleanup(app):
+    await app['http'].close()
+    for client in app['redis'].nodes.values():
+        await client.aclose()
+    admission = app['admission']
+    if admission is not None and admission.client not in app['redis'].nodes.values():
+        await admission.client.aclose()
+
+
+def create_app():
+    if not os.getenv("DEEPSEEK_API_KEY"):
+        logger.error("DeepSeek API密钥未配置！请设置DEEPSEEK_API_KEY环境变量")
+        raise ValueError("DeepSeek API密钥未配置！请设置DEEPSEEK_API_KEY环境变量")
+
+    app = web.Application()
+    # 与app.py相同的分片方式：配置了SESSION_REDIS_NODES时session和对话按id分布到这些节点
+    nodes = os.getenv("SESSION_REDIS_NODES") or f'{os.getenv("REDIS_HOST", "localhost")}:{os.getenv("REDIS_PORT", "6379")}'
+    clients = {}
+    for node in nodes.split(','):
+        host, port = node.strip().rsplit(':', 1)
+        clients[f'{host}:{port}'] = aioredis.Redis(
+            host=host,
+            port=int(port),
+            db=0,
+            socket_connect_timeout=3,
+            socket_timeout=5
+        )
+    app['redis'] = HashRing(clients, vnodes=int(os.getenv("SESSION_REDIS_VNODES", "160")))
+    # 准入控制的键在REDIS_HOST上（与app.py相同），这个节点也在分片里时共用连接
+    primary = f'{os.getenv("REDIS_HOST", "localhost")}:{os.getenv("REDIS_PORT", "6379")}'
+    admission_client = clients.get(primary)
+    if admission_client is None:
+        host, port = primary.rsplit(':', 1)
+        admission_client = aioredis.Redis(
+            host=host,
+            port=int(port),
+            db=0,
+            socket_connect_timeout=3,
+            socket_timeout=5
+        )
+    app['admission'] = AsyncAdmissionController(
+        admission_client,
+        rate=float(os.getenv("ADMISSION_RATE", "20")),
+        burst=int(os.getenv("ADMISSION_BURST", "40")),
+        max_concurrency=int(os.getenv("ADMISSION_MAX_CONCURRENCY", "100")),
+        max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", "100")),
+        max_wait=float(os.getenv("ADMISSION_MAX_WAIT", "5"))
+    ) if os.getenv("ADMISSION", "1") == "1" else None
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.router.add_post('/api/stream-chat', stream_chat)
+    return app
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    web.run_app(create_app(), host='0.0.0.0', port=int(os.getenv("ASYNC_PORT", "5001")))
@@ -0,0 +1,127 @@
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 开发服务器（python app.py）和gunicorn（gunicorn.conf.py）的流式接口对比：
+# 启动mock_upstream.py模拟DeepSeek，再分别起两种服务，用并发客户端压 /api/stream-chat，
+# 统计首帧延迟、完整响应时间、吞吐和错误数。需要本机有Redis（REDIS_HOST/REDIS_PORT）。
+# 用法: python bench/bench_serving.py [--clients 200] [--requests 5] [--token-ms 20]
+
+SERVERS = {
+    'dev': [sys.executable, 'app.py'],
+    'gunicorn': [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:create_app()'],
+}
+
+
+def start(cmd, env, url):
+    process = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               start_new_session=True)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    stop(process)
+    raise RuntimeError(f"启动失败: {' '.join(cmd)}")
+
+
+def stop(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=30)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        os.killpg(process.pid, signal.SIGKILL)
+
+
+def client(base, index, n_requests, results):
+    http = requests.Session()
+    for i in range(n_requests):
+        start = time.perf_counter()
+        first = None
+        try:
+            response = http.post(f'{base}/api/stream-chat', json={'message': f'压测{index}-{i}'},
+                                 stream=True, timeout=(5, 120))
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if first is None and line.startswith(b'data:'):
+                    first = time.perf_counter() - start
+                if line == b'data: [DONE]':
+                    break
+            response.close()
+            results.append((first, time.perf_counter() - start, None))
+        except requests.RequestException as e:
+            results.append((None, time.perf_counter() - start, type(e).__name__))
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(name, base, clients, n_requests):
+    results = []
+    threads = [threading.Thread(target=client, args=(base, i, n_requests, results)) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    ok = [r for r in results if r[2] is None]
+    ttfb = [r[0] * 1000 for r in ok if r[0] is not None]
+    total = [r[1] * 1000 for r in ok]
+    errors = len(results) - len(ok)
+    print(f"{name:<9} {len(ok) / elapsed:8.1f} req/s  首帧p50 {percentile(ttfb, 0.5):7.1f} ms  "
+          f"p99 {percentile(ttfb, 0.99):7.1f} ms  完整p99 {percentile(total, 0.99):8.1f} ms  错误 {errors}")
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('--clients', type=int, default=200)
+    args.add_argument('--requests', type=int, default=5)
+    args.add_argument('--token-ms', default='20')
+    args.add_argument('--reply-chars', default='100')
+    args.add_argument('--port', type=int, default=5080)
+    args.add_argument('--servers', default='dev,gunicorn')
+    args = args.parse_args()
+
+    env = dict(os.environ)
+    env.update({
+        'MOCK_UPSTREAM_PORT': '5055',
+        'MOCK_TOKEN_MS': args.token_ms,
+        'MOCK_REPLY_CHARS': args.reply_chars,
+        'DEEPSEEK_API_URL': 'http://127.0.0.1:5055/v1/chat/completions',
+        'DEEPSEEK_API_KEY': env.get('DEEPSEEK_API_KEY', 'bench'),
+        'PORT': str(args.port),
+        'BIND': f'127.0.0.1:{args.port}',
+        'GUNICORN_ACCESS_LOG': '/dev/null',
+        # 压测关注服务本身：不限流，也不让相同请求被合并或命中缓存
+        'ADMISSION': '0',
+        'SINGLEFLIGHT': '0',
+        'RESPONSE_CACHE_TTL': '0',
+    })
+    upstream = start([sys.executable, 'mock_upstream.py'], env, 'http://127.0.0.1:5055/')
+    try:
+        base = f'http://127.0.0.1:{args.port}'
+        print(f"{args.clients}个并发客户端 x {args.requests}个流式请求，上游每token {args.token_ms} ms")
+        for name in args.servers.split(','):
+            server = start(SERVERS[name], env, base + '/')
+            try:
+                run(name, base, args.clients, args.requests)
+            finally:
+                stop(server)
+    finally:
+        stop(upstream)
@@ -0,0 +1,124 @@
+import argparse
+import os
+import secrets
+import statistics
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conversation import ConversationStore
+from redis_access import create_client
+from sharding import HashRing, ShardedRedis, rebalance
+from tokenizer import load_counter
+
+# session分片的压测：
+# 1. 只算哈希环：各节点分到的id比例，以及加一个节点时换节点的id比例（对比取模分片）
+# 2. 指定--nodes时连真实的Redis（可以用 bench/redis_nodes.sh 在本机起多个实例）：
+#    写入一批session和对话，测每个请求预取session+对话的往返延迟；再加入--add的节点，测重新分片
+# 用法: python bench/bench_sharding.py [--ids 100000] [--nodes host:port,...] [--add host:port]
+
+
+def ring_only(n_nodes, n_ids, vnodes):
+    ids = [secrets.token_urlsafe(32) for _ in range(n_ids)]
+    names = [f'127.0.0.1:{6380 + i}' for i in range(n_nodes + 1)]
+    before = HashRing({name: name for name in names[:-1]}, vnodes)
+    after = HashRing({name: name for name in names}, vnodes)
+
+    counts = {name: 0 for name in names[:-1]}
+    moved = 0
+    moved_modulo = 0
+    for shard_id in ids:
+        owner = before.name_for(shard_id)
+        counts[owner] += 1
+        if after.name_for(shard_id) != owner:
+            moved += 1
+        h = zlib.crc32(shard_id.encode())
+        if h % n_nodes != h % (n_nodes + 1):
+            moved_modulo += 1
+
+    shares = [count / n_ids for count in counts.values()]
+    print(f"{n_nodes}个节点, {vnodes}个虚拟点/节点, {n_ids}个id")
+    print(f"  每个节点的份额: 最小{min(shares):.3f} 最大{max(shares):.3f} 标准差{statistics.pstdev(shares):.4f}")
+    print(f"  加入第{n_nodes + 1}个节点: 一致性哈希迁移{moved / n_ids:.1%} (理想{1 / (n_nodes + 1):.1%})，"
+          f"取模分片迁移{moved_modulo / n_ids:.1%}")
+
+
+def connect(spec):
+    host, port = spec.rsplit(':', 1)
+    return create_client(host, int(port), max_connections=20)
+
+
+def populate(sharded, n_sessions, turns):
+    store = ConversationStore(sharded, load_counter())
+    sids = [secrets.token_urlsafe(32) for _ in range(n_sessions)]
+    start = time.perf_counter()
+    for sid in sids:
+        window = store.new_window()
+        for i in range(turns):
+            window.append("user", f"第{i}个问题：请详细解释一下这个概念")
+            window.append("assistant", "这是一个模拟的回答。" * 10)
+        pipe = sharded.pipeline(transaction=True)
+        pipe.set('session:' + sid, b'{"conv_id": "%s"}' % sid.encode(), ex=86400)
+        store.queue_window(pipe, sid, window)
+        pipe.execute()
+    elapsed = time.perf_counter() - start
+    print(f"写入{n_sessions}个session和对话: {elapsed:.2f}s ({n_sessions / elapsed:,.0f}/s)")
+    return store, sids
+
+
+def read_latency(sharded, store, sids):
+    # 与LazySessionInterface相同的请求前读取：session和对话在同一个节点，一次往返
+    samples = []
+    for sid in sids:
+        start = time.perf_counter()
+        pipe = sharded.pipeline(transaction=False)
+        pipe.get('session:' + sid)
+        pipe.ttl('session:' + sid)
+        store.queue_load(pipe, sid)
+        results = pipe.execute()
+        samples.append(time.perf_counter() - start)
+        assert results[0] is not None, sid
+    samples.sort()
+    print(f"  预取session+对话: p50 {samples[len(samples) // 2] * 1000:.3f} ms  "
+          f"p99 {samples[int(len(samples) * 0.99)] * 1000:.3f} ms")
+
+
+def live(nodes, add, n_sessions, turns, vnodes):
+    clients = {spec: connect(spec) for spec in nodes}
+    for client in clients.values():
+        client.flushdb()
+    sharded = ShardedRedis(clients, vnodes)
+    store, sids = populate(sharded, n_sessions, turns)
+    per_node = {spec: client.dbsize() for spec, client in clients.items()}
+    print(f"  各节点键数: {per_node}")
+    read_latency(sharded, store, sids)
+
+    if add:
+        new_client = connect(add)
+        new_client.flushdb()
+        sharded.add_node(add, new_client)
+        start = time.perf_counter()
+        moved = rebalance(sharded)
+        elapsed = time.perf_counter() - start
+        total = sum(per_node.values())
+        print(f"加入{add}后重新分片: 迁移{moved}/{total}个键 ({moved / total:.1%}) 用时{elapsed:.2f}s")
+        print(f"  各节点键数: {dict((spec, client.dbsize()) for spec, client in sharded.ring.nodes.items())}")
+        read_latency(sharded, store, sids)
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('--ids', type=int, default=100000)
+    args.add_argument('--vnodes', type=int, default=160)
+    args.add_argument('--nodes', default='')
+    args.add_argument('--add', default='')
+    args.add_argument('--sessions', type=int, default=2000)
+    args.add_argument('--turns', type=int, default=5)
+    args = args.parse_args()
+
+    for n in (2, 3, 4):
+        ring_only(n, args.ids, args.vnodes)
+    if args.nodes:
+        live(args.nodes.split(','), args.add, args.sessions, args.turns, args.vnodes)
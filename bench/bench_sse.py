@@ -0,0 +1,93 @@
+import io
+import json
+import os
+import random
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sse import SSEParser
+
+# 单核解析吞吐对比：旧的 iter_lines + decode + json.loads 逐行解析 vs SSEParser
+# 两边读同一种模拟响应（requests.Response + 按read_size读取的BufferedReader），读取开销相同，差别只在解析
+# 用法: python bench/bench_sse.py [token数]
+
+TEXT = "迷你豆包正在认真思考你的问题，下面给出一个详细的回答。Here is some code: print('hello')\n"
+
+
+def build_stream(n_tokens):
+    # 模拟DeepSeek：每个delta一到两个字符，带id/object等真实字段
+    frames = []
+    pos = 0
+    for i in range(n_tokens):
+        size = random.choice((1, 2))
+        content = TEXT[pos % len(TEXT):pos % len(TEXT) + size] or TEXT[:size]
+        pos += size
+        frames.append('data: ' + json.dumps({
+            "id": "bench", "object": "chat.completion.chunk", "created": 1700000000,
+            "model": "deepseek-chat",
+            "choices": [{"index": 0, "delta": {"content": content}, "logprobs": None, "finish_reason": None}]
+        }) + '\n\n')
+    frames.append('data: [DONE]\n\n')
+    return ''.join(frames).encode('utf-8')
+
+
+def fake_response(payload, read_size):
+    response = requests.Response()
+    response.raw = io.BufferedReader(io.BytesIO(payload), buffer_size=read_size)
+    response.status_code = 200
+    return response
+
+
+def legacy(payload, read_size):
+    count = 0
+    for line in fake_response(payload, read_size).iter_lines():
+        if line:
+            line_text = line.decode('utf-8')
+            if line_text.startswith('data:'):
+                try:
+                    json_data = json.loads(line_text[5:])
+                    if (json_data.get('choices') and
+                            len(json_data['choices']) > 0 and
+                            'delta' in json_data['choices'][0] and
+                            'content' in json_data['choices'][0]['delta']):
+                        json_data['choices'][0]['delta']['content']
+                        count += 1
+                except json.JSONDecodeError:
+                    continue
+    return count
+
+
+def parser(payload, read_size):
+    count = 0
+    # 按read_size读取，帧会在read边界被拆开
+    for _ in SSEParser().deltas(fake_response(payload, read_size).iter_content(read_size)):
+        count += 1
+    return count
+
+
+def run(name, fn, *args, repeat=5):
+    best = None
+    count = 0
+    for _ in range(repeat):
+        start = time.process_time()
+        count = fn(*args)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{name:<10} {count:>8} tokens  {best * 1000:8.1f} ms CPU  {count / best:>12,.0f} tokens/s/core")
+    return count / best
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    n_tokens = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    payload = build_stream(n_tokens)
+    read_size = 1024
+
+    print(f"{n_tokens} tokens, {len(payload) / 1024:.0f} KiB, read size {read_size}")
+    before = run('legacy', legacy, payload, read_size)
+    after = run('SSEParser', parser, payload, read_size)
+    print(f"speedup: {after / before:.2f}x")
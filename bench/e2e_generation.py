@@ -0,0 +1,246 @@
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import redis
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from codec import PayloadCodec
+from conversation import ConversationStore
+from tokenizer import load_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 独立generation worker的端到端测试：mock_upstream.py + worker.py + web（GENERATION_WORKERS=1），
+# 需要本机有Redis（REDIS_HOST/REDIS_PORT，会清空当前库）。依次验证：
+# 1. 正常生成：回答完整，worker把用户消息和回答写进对话
+# 2. 生成中途杀掉web进程再起一个：浏览器带Last-Event-ID连到新进程，拿到完整回答
+# 3. 生成中途给worker发SIGTERM：worker处理完手上的任务再退出，回答完整
+# 4. 浏览器断开且不续传：worker在RESUME_GRACE秒后关闭上游连接，对话里保存已生成的部分
+# 5. 收到[DONE]后立即发下一条（不等待保存）：两轮的回答都在对话里，顺序正确
+# 6. 合并到同一任务的相同请求（SINGLEFLIGHT）：leader的浏览器中途断开，follower照样拿到完整回答并保存
+# 用法: python bench/e2e_generation.py
+
+
+def start(cmd, env, url=None):
+    process = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               start_new_session=True)
+    if url is None:
+        time.sleep(2)
+        return process
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    stop(process)
+    raise RuntimeError(f"启动失败: {' '.join(cmd)}")
+
+
+def stop(process, sig=signal.SIGTERM, timeout=30):
+    try:
+        os.killpg(process.pid, sig)
+        process.wait(timeout=timeout)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        os.killpg(process.pid, signal.SIGKILL)
+
+
+def expected_reply(message, chars):
+    # 与mock_upstream.make_reply相同
+    text = f"这是对“{message[:20]}”的模拟回答。"
+    return (text * (chars // len(text) + 1))[:chars]
+
+
+class StreamReader:
+    """逐帧读取 /api/stream-chat，记录最后一帧的id"""
+
+    def __init__(self, http, base, message, last_event_id=None):
+        headers = {'Last-Event-ID': last_event_id} if last_event_id else {}
+        self.response = http.post(f'{base}/api/stream-chat', json={'message': message}, headers=headers,
+                                  stream=True, timeout=(5, 120))
+        self.response.raise_for_status()
+        self.lines = self.response.iter_lines(decode_unicode=True)
+        self.content = ''
+        self.last_event_id = last_event_id
+        self.done = False
+        self.error = None
+
+    def read(self, frames=None):
+        """读frames帧内容（None为读到结束）；连接断开时停止"""
+        event_id = None
+        try:
+            for line in self.lines:
+                if line.startswith('id: '):
+                    event_id = line[4:]
+                elif line == 'data: [DONE]':
+                    self.done = True
+                    return
+                elif line.startswith('data: '):
+                    data = json.loads(line[6:])
+                    if 'error' in data:
+                        self.error = data['error']
+                        continue
+                    self.content += data.get('content', '')
+                    if event_id:
+                        self.last_event_id = event_id
+                    if frames is not None:
+                        frames -= 1
+                        if frames <= 0:
+                            return
+        except requests.RequestException:
+            return
+
+    def close(self):
+        self.response.close()
+
+
+def saved_messages(client, conversation_id):
+    store = ConversationStore(client, load_counter(), codec=PayloadCodec('zlib'))
+    return [(msg['role'], msg['content']) for msg in store.load(conversation_id).messages()]
+
+
+def wait_saved(client, conversation_id, count, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        messages = saved_messages(client, conversation_id)
+        if len(messages) >= count:
+            return messages
+        time.sleep(0.2)
+    return saved_messages(client, conversation_id)
+
+
+def generation_stats(web_base):
+    return requests.get(f'{web_base}/api/stats', timeout=5).json()['generation']
+
+
+def main(args):
+    client = redis.Redis(host=os.getenv("REDIS_HOST", "localhost"), port=int(os.getenv("REDIS_PORT", "6379")))
+    client.flushdb()
+
+    env = dict(os.environ)
+    env.update({
+        'MOCK_UPSTREAM_PORT': str(args.upstream_port),
+        'MOCK_FIRST_TOKEN_MS': '100',
+        'MOCK_TOKEN_MS': '30',
+        'MOCK_REPLY_CHARS': str(args.reply_chars),
+        'DEEPSEEK_API_URL': f'http://127.0.0.1:{args.upstream_port}/v1/chat/completions',
+        'DEEPSEEK_API_KEY': env.get('DEEPSEEK_API_KEY', 'e2e'),
+        'GENERATION_WORKERS': '1',
+        'GENERATION_CONCURRENCY': '4',
+        'RESUME_GRACE': '1',
+        'STREAM_COALESCE_BYTES': '0',
+        'ADMISSION': '0',
+        'SINGLEFLIGHT': '1',
+        'RESPONSE_CACHE_TTL': '0',
+        'COMPACTION': '0',
+    })
+    web_env = dict(env, PORT=str(args.port))
+    base = f'http://127.0.0.1:{args.port}'
+    # 不带重载器启动开发服务器，杀掉的就是处理请求的进程
+    web_cmd = [
+        sys.executable, '-c', f'from app import app; app.run(host="127.0.0.1", port={args.port}, threaded=True)'
+    ]
+
+    processes = []
+    upstream = start([sys.executable, 'mock_upstream.py'], env, f'http://127.0.0.1:{args.upstream_port}/')
+    processes.append(upstream)
+    worker = start([sys.executable, 'worker.py'], env)
+    processes.append(worker)
+    web = start(web_cmd, web_env, base + '/')
+    processes.append(web)
+    try:
+        # 1. 正常生成
+        http = requests.Session()
+        reader = StreamReader(http, base, '第一个问题')
+        reader.read()
+        assert reader.done and reader.content == expected_reply('第一个问题', args.reply_chars), reader.content
+        conversation_id = http.cookies['session']
+        messages = wait_saved(client, conversation_id, 2)
+        assert messages == [('user', '第一个问题'), ('assistant', reader.content)], messages
+        print("1. 正常生成: 通过")
+
+        # 2. 生成中途重启web
+        reader = StreamReader(http, base, '第二个问题')
+        reader.read(frames=10)
+        partial, last_event_id = reader.content, reader.last_event_id
+        assert last_event_id, "帧没有id"
+        stop(web, signal.SIGKILL)
+        processes.remove(web)
+        web = start(web_cmd, web_env, base + '/')
+        processes.append(web)
+        resumed = StreamReader(http, base, '第二个问题', last_event_id)
+        resumed.read()
+        full = partial + resumed.content
+        assert resumed.done and full == expected_reply('第二个问题', args.reply_chars), full
+        messages = wait_saved(client, conversation_id, 4)
+        assert messages[2:] == [('user', '第二个问题'), ('assistant', full)], messages
+        assert generation_stats(base)['queued'] == 0
+        print(f"2. 重启web后续传: 通过（重启前{len(partial)}字，续传{len(resumed.content)}字）")
+
+        # 3. 生成中途停止worker
+        reader = StreamReader(http, base, '第三个问题')
+        reader.read(frames=5)
+        stop(worker, signal.SIGTERM, timeout=60)
+        processes.remove(worker)
+        reader.read()
+        assert reader.done and reader.content == expected_reply('第三个问题', args.reply_chars), reader.content
+        assert worker.returncode == 0, worker.returncode
+        worker = start([sys.executable, 'worker.py'], env)
+        processes.append(worker)
+        print("3. 停止worker时处理完进行中的任务: 通过")
+
+        # 4. 浏览器断开且不续传
+        reader = StreamReader(http, base, '第四个问题')
+        reader.read(frames=5)
+        reader.close()
+        messages = wait_saved(client, conversation_id, 8, timeout=args.reply_chars * 0.03 + 10)
+        saved = messages[-1][1]
+        assert messages[-2] == ('user', '第四个问题'), messages
+        assert 5 <= len(saved) < args.reply_chars, len(saved)
+        print(f"4. 断开后停止生成: 通过（保存了{len(saved)}/{args.reply_chars}字）")
+
+        # 5. 连续两轮：worker在写结束标记之前已经保存了回答，这里不轮询
+        http = requests.Session()
+        turns = []
+        for message in ('连续第一问', '连续第二问'):
+            reader = StreamReader(http, base, message)
+            reader.read()
+            assert reader.done and reader.content == expected_reply(message, args.reply_chars), reader.content
+            turns += [('user', message), ('assistant', reader.content)]
+        messages = saved_messages(client, http.cookies['session'])
+        assert messages == turns, messages
+        print("5. 连续两轮不等待保存: 通过")
+
+        # 6. leader断开，follower不受影响
+        leader = StreamReader(requests.Session(), base, '相同的问题')
+        leader.read(frames=3)
+        http = requests.Session()
+        follower = StreamReader(http, base, '相同的问题')
+        follower.read(frames=1)
+        leader.close()
+        follower.read()
+        expected = expected_reply('相同的问题', args.reply_chars)
+        assert follower.error is None, follower.error
+        assert follower.done and follower.content == expected, follower.content
+        messages = wait_saved(client, http.cookies['session'], 2)
+        assert messages == [('user', '相同的问题'), ('assistant', expected)], messages
+        print("6. leader断开后follower拿到完整回答: 通过")
+    finally:
+        for process in reversed(processes):
+            stop(process)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=5083)
+    parser.add_argument('--upstream-port', type=int, default=5057)
+    parser.add_argument('--reply-chars', type=int, default=200)
+    main(parser.parse_args())
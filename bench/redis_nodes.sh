@@ -0,0 +1,32 @@
+#!/bin/bash
+# 在本机起多个Redis实例，用于测试session分片和重新分片：
+#   bench/redis_nodes.sh start 3        # 端口6380-6382
+#   SESSION_REDIS_NODES=127.0.0.1:6380,127.0.0.1:6381,127.0.0.1:6382 python app.py
+#   python bench/bench_sharding.py --nodes 127.0.0.1:6380,127.0.0.1:6381 --add 127.0.0.1:6382
+#   bench/redis_nodes.sh stop 3
+# 实例不落盘，数据目录在 /tmp/minidoubao-redis-<端口>
+
+ACTION=${1:-start}
+COUNT=${2:-3}
+BASE_PORT=${BASE_PORT:-6380}
+
+for ((i = 0; i < COUNT; i++)); do
+    PORT=$((BASE_PORT + i))
+    DIR=/tmp/minidoubao-redis-$PORT
+    case "$ACTION" in
+        start)
+            mkdir -p "$DIR"
+            redis-server --port "$PORT" --dir "$DIR" --save "" --appendonly no \
+                --daemonize yes --pidfile "$DIR/redis.pid" --logfile "$DIR/redis.log"
+            echo "127.0.0.1:$PORT"
+            ;;
+        stop)
+            redis-cli -p "$PORT" shutdown nosave >/dev/null 2>&1
+            rm -rf "$DIR"
+            ;;
+        *)
+            echo "用法: $0 start|stop [实例数]"
+            exit 1
+            ;;
+    esac
+done
@@ -0,0 +1,149 @@
+import logging
+import threading
+import time
+import zlib
+
+logger = logging.getLogger('DeepSeekChat')
+
+# 压缩后的值以版本字节0xC1开头：msgpack从不使用0xC1，JSON也不会以它开头，
+# 所以没有这个前缀的旧值（以及低于阈值没压缩的值）原样读取。
+# 第二个字节是压缩算法编号，之后是压缩数据。
+FORMAT_VERSION = 0xC1
+_HEADER = bytes([FORMAT_VERSION])
+
+ZLIB = 1
+ZSTD = 2
+
+# 每个线程（一个请求）累计的编解码耗时，请求结束时由end_request()取出
+_local = threading.local()
+
+
+class PayloadCodec:
+    """Redis里session和对话消息的可选压缩层：超过阈值的值才压缩，压缩后更大时保留原值。
+
+    除了每个值的平均耗时，还按请求汇总：请求结束时调用end_request()，配置了request_metric
+    （metrics.Histogram）时同时记录每个请求的编解码总耗时分布。
+    """
+
+    def __init__(self, algorithm='zlib', threshold=512, level=None):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._zstd = None
+        self.algorithm = algorithm
+        if algorithm == 'zstd':
+            try:
+                import zstandard
+                self._zstd_compressor = zstandard.ZstdCompressor(level=level or 3)
+                self._zstd = zstandard.ZstdDecompressor()
+            except ImportError:
+                logger.warning("未安装zstandard，改用zlib压缩")
+                self.algorithm = 'zlib'
+        self.level = level if level is not None else (3 if self.algorithm == 'zstd' else 6)
+
+        self.encoded = 0
+        self.compressed = 0
+        self.decoded = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.encode_seconds = 0.0
+        self.decode_seconds = 0.0
+        self.request_metric = None
+        self.requests = 0
+        self.request_seconds = 0.0
+        self.request_max_seconds = 0.0
+
+    @property
+    def enabled(self):
+        return self.algorithm in ('zlib', 'zstd')
+
+    def encode(self, data):
+        if not self.enabled:
+            return data
+        start = time.perf_counter()
+        result = data
+        if len(data) >= self.threshold:
+            if self.algorithm == 'zstd':
+                body = _HEADER + bytes([ZSTD]) + self._zstd_compressor.compress(data)
+            else:
+                body = _HEADER + bytes([ZLIB]) + zlib.compress(data, self.level)
+            if len(body) < len(data):
+                result = body
+        elapsed = time.perf_counter() - start
+        _local.seconds = getattr(_local, 'seconds', 0.0) + elapsed
+        with self._lock:
+            self.encoded += 1
+            if result is not data:
+                self.compressed += 1
+            self.bytes_in += len(data)
+            self.bytes_out += len(result)
+            self.encode_seconds += elapsed
+        return result
+
+    def decode(self, data):
+        # 关闭压缩后仍然能读出之前压缩过的值
+        if not data or data[0] != FORMAT_VERSION:
+            return data
+        start = time.perf_counter()
+        if data[1] == ZLIB:
+            result = zlib.decompress(data[2:])
+        elif data[1] == ZSTD:
+            if self._zstd is None:
+                import zstandard
+                self._zstd = zstandard.ZstdDecompressor()
+            result = self._zstd.decompress(data[2:])
+        else:
+            raise ValueError(f"未知的压缩格式: {data[1]}")
+        elapsed = time.perf_counter() - start
+        _local.seconds = getattr(_local, 'seconds', 0.0) + elapsed
+        with self._lock:
+            self.decoded += 1
+            self.decode_seconds += elapsed
+        return result
+
+    def end_request(self, record=True):
+        """取出当前线程上次调用以来的编解码总耗时并清零；record为False时只清零，不计入按请求的统计。
+
+        session在before_request之前就已解码，所以在请求结束时取出而不是在开始时清零。
+        """
+        seconds = getattr(_local, 'seconds', 0.0)
+        _local.seconds = 0.0
+        if not record:
+            return seconds
+        with self._lock:
+            self.requests += 1
+            self.request_seconds += seconds
+            self.request_max_seconds = max(self.request_max_seconds, seconds)
+        if self.request_metric is not None:
+            self.request_metric.observe(seconds)
+        return seconds
+
+    def stats(self):
+        return {
+            'algorithm': self.algorithm,
+            'threshold': self.threshold,
+            'encoded': self.encoded,
+            'compressed': self.compressed,
+            'decoded': self.decoded,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'ratio': round(self.bytes_out / self.bytes_in, 4) if self.bytes_in else 1.0,
+            'encode_us_avg': round(self.encode_seconds * 1e6 / self.encoded, 1) if self.encoded else 0.0,
+            'decode_us_avg': round(self.decode_seconds * 1e6 / self.decoded, 1) if self.decoded else 0.0,
+            'requests': self.requests,
+            'request_us_avg': round(self.request_seconds * 1e6 / self.requests, 1) if self.requests else 0.0,
+            'request_us_max': round(self.request_max_seconds * 1e6, 1),
+        }
+
+
+class CompressedSerializer:
+    """包在flask_session的序列化器外面，session值也走同一套压缩格式"""
+
+    def __init__(self, serializer, codec):
+        self.serializer = serializer
+        self.codec = codec
+
+    def encode(self, session):
+        return self.codec.encode(self.serializer.encode(session))
+
+    def decode(self, serialized_data):
+        return self.serializer.decode(self.codec.decode(serialized_data))
@@ -0,0 +1,166 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import msgspec
+
+from conversation import CANDIDATE_SUFFIX, ConversationWindow, head_digest, queue_bump, queue_load, summary_message
+
+logger = logging.getLogger('DeepSeekChat')
+
+# 后台压缩：对话窗口超过阈值后，把最早的若干轮交给上游总结成一条摘要。
+# 压缩在后台线程里完成，结果先作为候选写入 conv:<id>:compact，由该对话的下一次请求
+# 在自己的写回事务里应用（LTRIM掉被覆盖的消息、写入摘要），避免和请求并发改同一个列表。
+
+SUMMARY_PROMPT = (
+    "你是对话摘要助手。请把下面的对话压缩成一段简短的摘要，保留用户的身份信息、偏好、"
+    "已经确定的结论和尚未解决的问题，省略寒暄和重复内容。只输出摘要本身。"
+)
+
+_encoder = msgspec.json.Encoder()
+
+
+def compaction_span(messages, keep_turns):
+    """保留最近keep_turns轮原文，返回可以压缩的头部条数（在轮次边界上）"""
+    seen = 0
+    for index in range(len(messages) - 1, -1, -1):
+        if messages[index]["role"] == "user":
+            seen += 1
+            if seen == keep_turns:
+                return index
+    return 0
+
+
+def build_summary_request(previous, messages, max_tokens):
+    lines = []
+    if previous:
+        lines.append(f"此前的摘要：{previous}")
+    for msg in messages:
+        lines.append(f"{'用户' if msg['role'] == 'user' else '助手'}：{msg['content']}")
+    return {
+        "model": "deepseek-chat",
+        "messages": [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": "\n".join(lines)}
+        ],
+        "stream": False,
+        "max_tokens": max_tokens
+    }
+
+
+class Compactor:
+    """检查每轮结束后的窗口大小，超过阈值就提交后台压缩；同一对话同时只压缩一次"""
+
+    def __init__(self, store, summarize, threshold, keep_turns=2, summary_max_tokens=300, lock_ttl=120):
+        self.store = store
+        self.summarize = summarize
+        self.threshold = threshold
+        self.keep_turns = keep_turns
+        self.summary_max_tokens = summary_max_tokens
+        self.lock_ttl = lock_ttl
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='compaction')
+        self._lock = threading.Lock()
+        self._pending = set()
+        self.submitted = 0
+        self.compactions = 0
+        self.applied = 0
+        self.failures = 0
+        self.requests_compacted = 0
+        self.tokens_saved = 0
+
+    def observe(self, window):
+        """每次请求加载窗口后调用，统计摘要替代原文省下的token"""
+        with self._lock:
+            if window.compacted:
+                self.applied += 1
+            if window.summary:
+                self.requests_compacted += 1
+                self.tokens_saved += window.summary["covered_tokens"] - window.summary["tokens"]
+
+    def maybe_submit(self, conversation_id, window):
+        if window.total < self.threshold:
+            return
+        with self._lock:
+            if conversation_id in self._pending:
+                return
+            self._pending.add(conversation_id)
+            self.submitted += 1
+        self._executor.submit(self._run, conversation_id)
+
+    def _run(self, conversation_id):
+        client = self.store.client
+        key = self.store.key(conversation_id)
+        lock_key = key + ':compacting'
+        try:
+            # 其他worker正在压缩同一个对话
+            if not client.set(lock_key, '1', nx=True, ex=self.lock_ttl):
+                return
+            try:
+                self._compact(client, key)
+            finally:
+                client.delete(lock_key)
+        except Exception as e:
+            logger.warning(f"对话压缩失败: {str(e)}")
+            with self._lock:
+                self.failures += 1
+        finally:
+            with self._lock:
+                self._pending.discard(conversation_id)
+
+    def _compact(self, client, key):
+        pipe = client.pipeline(transaction=False)
+        queue_load(pipe, key)
+        raw_items, summary_raw, candidate_raw, _ = pipe.execute()
+        if candidate_raw:
+            # 上一次的结果还没被请求应用
+            return
+
+        window = ConversationWindow.decode(self.store.counter, raw_items, summary_raw, codec=self.store.codec)
+        turns = window.turns()
+        covers = compaction_span([msg for msg, _ in turns], self.keep_turns)
+        if covers == 0:
+            return
+
+        previous = window.summary["content"] if window.summary else None
+        covered_tokens = sum(tokens for _, tokens in turns[:covers])
+        if window.summary:
+            covered_tokens += window.summary["covered_tokens"]
+
+        content = self.summarize(build_summary_request(
+            previous, [msg for msg, _ in turns[:covers]], self.summary_max_tokens
+        ))
+        tokens = self.store.counter.count(summary_message(content)["content"])
+        if tokens >= covered_tokens:
+            logger.info("摘要没有比原文更短，放弃本次压缩")
+            return
+
+        candidate = {
+            "content": content,
+            "tokens": tokens,
+            "covered_tokens": covered_tokens,
+            "covers": covers,
+            "digest": head_digest(raw_items[:covers]),
+        }
+        # 版本号随候选一起递增：各worker缓存的窗口失效，下一次请求完整加载并应用候选
+        pipe = client.pipeline(transaction=True)
+        pipe.set(key + CANDIDATE_SUFFIX, _encoder.encode(candidate), ex=self.store.ttl)
+        queue_bump(pipe, key, self.store.ttl)
+        pipe.execute()
+        with self._lock:
+            self.compactions += 1
+        logger.info(f"对话压缩完成: {covers}条消息约{covered_tokens} tokens -> 摘要{tokens} tokens")
+
+    def stats(self):
+        return {
+            'submitted': self.submitted,
+            'compactions': self.compactions,
+            'applied': self.applied,
+            'failures': self.failures,
+            'in_progress': len(self._pending),
+            'requests_compacted': self.requests_compacted,
+            'tokens_saved': self.tokens_saved,
+            'tokens_saved_per_request': (
+                round(self.tokens_saved / self.requests_compacted, 1) if self.requests_compacted else 0.0
+            ),
+        }
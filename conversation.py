@@ -0,0 +1,425 @@
+import hashlib
+import logging
+import threading
+from collections import deque
+from itertools import islice
+
+import msgspec
+import redis
+
+logger = logging.getLogger('DeepSeekChat')
+
+MAX_HISTORY_TOKENS = 3000
+
+# 压缩后的早期对话以一条system消息放在窗口最前面
+SUMMARY_PREFIX = "以下是此前对话的摘要：\n"
+SUMMARY_SUFFIX = ':summary'
+CANDIDATE_SUFFIX = ':compact'
+
+# 对话每次写入都把版本号加一并广播，各worker据此淘汰进程内缓存（L1）的旧窗口
+VERSION_SUFFIX = ':ver'
+INVALIDATE_CHANNEL = 'conv:invalidate'
+_BUMP_SCRIPT = """
+local version = redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('PUBLISH', ARGV[2], ARGV[3] .. ' ' .. version)
+return version
+"""
+
+
+class PromptCacheStats:
+    """解析上游usage中的prompt_cache_hit_tokens/prompt_cache_miss_tokens，统计全局和每个对话的命中率。
+
+    全局计数也放在Redis里（<prefix>global），所有worker和generation worker累加到同一个hash，
+    /api/stats不管落到哪个worker上都是同一个数；Redis读不到时退回本进程的计数。
+    """
+
+    def __init__(self, client, ttl=86400, prefix='pcache:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.global_key = prefix + 'global'
+        self._lock = threading.Lock()
+        self.hit_tokens = 0
+        self.miss_tokens = 0
+
+    def record(self, conversation_id, usage):
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            if self.queue_record(pipe, conversation_id, usage):
+                pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"上下文缓存统计写入失败: {str(e)}")
+
+    def queue_record(self, pipe, conversation_id, usage):
+        """更新本地计数并把全局和对话计数排进pipeline；没有缓存数据时返回False"""
+        if usage is None:
+            return False
+        if isinstance(usage, dict):
+            hit = usage.get('prompt_cache_hit_tokens', 0)
+            miss = usage.get('prompt_cache_miss_tokens', 0)
+        else:
+            hit = usage.prompt_cache_hit_tokens
+            miss = usage.prompt_cache_miss_tokens
+        if not hit and not miss:
+            return False
+
+        with self._lock:
+            self.hit_tokens += hit
+            self.miss_tokens += miss
+
+        # 每个对话的计数放在Redis里：流式回答结束时session已经写回，不能再靠session保存
+        key = self.prefix + conversation_id
+        pipe.hincrby(key, 'hit', hit)
+        pipe.hincrby(key, 'miss', miss)
+        pipe.expire(key, self.ttl)
+        pipe.hincrby(self.global_key, 'hit', hit)
+        pipe.hincrby(self.global_key, 'miss', miss)
+        return True
+
+    def conversation_stats(self, conversation_id):
+        try:
+            values = self.client.hgetall(self.prefix + conversation_id)
+        except redis.RedisError:
+            values = {}
+        return self._ratio(int(values.get(b'hit', 0)), int(values.get(b'miss', 0)))
+
+    def stats(self):
+        try:
+            values = self.client.hgetall(self.global_key)
+        except redis.RedisError:
+            return self._ratio(self.hit_tokens, self.miss_tokens)
+        return self._ratio(int(values.get(b'hit', 0)), int(values.get(b'miss', 0)))
+
+    @staticmethod
+    def _ratio(hit, miss):
+        total = hit + miss
+        return {
+            'hit_tokens': hit,
+            'miss_tokens': miss,
+            'hit_ratio': round(hit / total, 4) if total else 0.0,
+        }
+
+
+_message_encoder = msgspec.json.Encoder()
+_message_decoder = msgspec.json.Decoder(dict)
+
+
+def encode_message(message, tokens, codec=None):
+    # token数随消息一起保存，加载时不用重新估算
+    raw = _message_encoder.encode({"role": message["role"], "content": message["content"], "tokens": tokens})
+    return codec.encode(raw) if codec is not None else raw
+
+
+def decode_message(raw, codec=None):
+    """返回 (消息, token数)；旧数据没有tokens字段时token数为None"""
+    if codec is not None:
+        raw = codec.decode(raw)
+    message = _message_decoder.decode(raw)
+    return message, message.pop("tokens", None)
+
+
+def head_digest(raw_items):
+    """列表头部若干条原始数据的摘要，用来确认压缩候选生成后头部没有变过"""
+    digest = hashlib.blake2b(digest_size=16)
+    for raw in raw_items:
+        digest.update(raw)
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def summary_message(content):
+    return {"role": "system", "content": SUMMARY_PREFIX + content}
+
+
+class ConversationWindow:
+    """对话的上下文窗口：消息和各自的token数并排放在deque里，并维护累计总数。
+
+    token数只在消息追加时估算一次，之后随消息持久化；裁剪从头部popleft，每条O(1)。
+    窗口同时记录自加载以来头部去掉和尾部追加的条数，保存时只写这部分改动。
+    早期对话被后台压缩后，摘要单独存放，发给上游时排在最前面。
+    """
+
+    __slots__ = ('_counter', '_messages', '_tokens', 'total', '_loaded', '_dropped',
+                 'summary', 'compacted', 'candidate_seen', 'version')
+
+    def __init__(self, counter, messages=(), tokens=None, summary=None, version=0):
+        self._counter = counter
+        self._messages = deque(messages)
+        if tokens is None:
+            tokens = [counter.count(msg["content"]) for msg in self._messages]
+        self._tokens = deque(tokens)
+        self.summary = summary
+        self.total = sum(self._tokens) + (summary["tokens"] if summary else 0)
+        self._loaded = len(self._messages)
+        self._dropped = 0
+        # compacted: 本次加载时应用了新的压缩结果，保存时要写摘要并LTRIM掉被覆盖的消息
+        self.compacted = False
+        self.candidate_seen = False
+        # 加载时Redis里的版本号，保存后更新为写入后的版本号
+        self.version = version
+
+    @classmethod
+    def decode(cls, counter, raw_items, summary_raw=None, candidate_raw=None, version=None, codec=None):
+        messages = []
+        tokens = []
+        for raw in raw_items:
+            message, count = decode_message(raw, codec)
+            messages.append(message)
+            tokens.append(counter.count(message["content"]) if count is None else count)
+        summary = _message_decoder.decode(summary_raw) if summary_raw else None
+        window = cls(counter, messages, tokens, summary, int(version or 0))
+        if candidate_raw:
+            window.candidate_seen = True
+            candidate = _message_decoder.decode(candidate_raw)
+            covers = candidate["covers"]
+            # 压缩期间列表头部被裁剪过的话，候选已经过时，丢弃
+            if covers <= len(raw_items) and head_digest(raw_items[:covers]) == candidate["digest"]:
+                window.apply_summary(candidate, covers)
+        return window
+
+    @classmethod
+    def from_snapshot(cls, counter, snapshot):
+        messages, tokens, summary, version = snapshot
+        return cls(counter, messages, tokens, summary, version)
+
+    def snapshot(self):
+        """保存后的窗口内容，不可变，放进进程内缓存供之后的请求复用"""
+        return tuple(self._messages), tuple(self._tokens), self.summary, self.version
+
+    def apply_summary(self, candidate, covers):
+        for _ in range(covers):
+            self._popleft()
+        if self.summary:
+            self.total -= self.summary["tokens"]
+        self.summary = {
+            "content": candidate["content"],
+            "tokens": candidate["tokens"],
+            "covered_tokens": candidate["covered_tokens"],
+        }
+        self.total += self.summary["tokens"]
+        self.compacted = True
+
+    def __len__(self):
+        return len(self._messages)
+
+    def append(self, role, content):
+        tokens = self._counter.count(content)
+        self._messages.append({"role": role, "content": content})
+        self._tokens.append(tokens)
+        self.total += tokens
+
+    def messages(self):
+        """发给上游的消息列表"""
+        messages = list(self._messages)
+        if self.summary:
+            messages.insert(0, summary_message(self.summary["content"]))
+        return messages
+
+    def turns(self):
+        """列表里的 (消息, token数)，不含摘要"""
+        return list(zip(self._messages, self._tokens))
+
+    def _popleft(self):
+        self._messages.popleft()
+        self.total -= self._tokens.popleft()
+        self._dropped += 1
+
+    def trim(self, max_tokens=MAX_HISTORY_TOKENS, stable=True, target_ratio=0.5):
+        """超限时从头部裁剪，返回裁剪后的token估算。
+
+        stable模式下超限时一次裁到 max_tokens * target_ratio 以下，并且只在轮次边界
+        （user消息开头）截断。之后若干轮只在末尾追加，发给上游的前缀逐字节不变，
+        DeepSeek的上下文缓存才能命中。legacy模式保持原来每次只弹出最旧一条的行为。
+        """
+        if self.total <= max_tokens:
+            return self.total
+
+        if not stable:
+            while self.total > max_tokens and len(self._messages) > 1:
+                self._popleft()
+            return self.total
+
+        target = max_tokens * target_ratio
+        dropped = self._dropped
+        # 最后一条（本轮的用户消息）总是保留
+        while len(self._messages) > 1 and (self.total > target or self._messages[0]["role"] != "user"):
+            self._popleft()
+        if self._dropped > dropped:
+            logger.debug(f"按轮次裁剪历史: 移除{self._dropped - dropped}条消息，剩余约{self.total} tokens")
+        return self.total
+
+    def trim_after_reply(self, max_tokens=MAX_HISTORY_TOKENS, stable=True):
+        """回答追加后的二次检查。stable模式下不做，避免每轮都把前缀挪动；超限留给下一轮按块裁剪"""
+        if stable:
+            return
+        if self.total > max_tokens * 1.1 and len(self._messages) > 2:
+            self._popleft()
+            self._popleft()
+
+    def pending(self):
+        """自加载以来的改动：(头部去掉的条数, 新追加的(消息, token数)列表)。
+
+        新追加的消息本身也被裁掉了一部分时，drop为None，表示需要整体重写。
+        """
+        kept = self._loaded - self._dropped
+        if kept < 0:
+            return None, list(zip(self._messages, self._tokens))
+        return self._dropped, list(islice(zip(self._messages, self._tokens), kept, None))
+
+    def mark_saved(self):
+        self._loaded = len(self._messages)
+        self._dropped = 0
+        self.compacted = False
+        self.candidate_seen = False
+
+
+def queue_load(pipe, key):
+    """一次往返取回消息列表、摘要、待应用的压缩候选和版本号，结果交给ConversationWindow.decode"""
+    pipe.lrange(key, 0, -1)
+    pipe.get(key + SUMMARY_SUFFIX)
+    pipe.get(key + CANDIDATE_SUFFIX)
+    pipe.get(key + VERSION_SUFFIX)
+
+
+def queue_bump(pipe, key, ttl):
+    """版本号加一并广播失效消息；结果是新的版本号"""
+    pipe.eval(_BUMP_SCRIPT, 1, key + VERSION_SUFFIX, ttl, INVALIDATE_CHANNEL, key)
+
+
+def queue_save(pipe, key, window, ttl, codec=None):
+    """把窗口的改动排进pipeline：头部LTRIM、尾部RPUSH、续期，最后递增版本号；同步和异步pipeline通用"""
+    drop, new_items = window.pending()
+    if drop is None:
+        pipe.delete(key)
+    elif drop:
+        pipe.ltrim(key, drop, -1)
+    if new_items:
+        pipe.rpush(key, *[encode_message(message, tokens, codec) for message, tokens in new_items])
+    pipe.expire(key, ttl)
+    if window.compacted:
+        pipe.set(key + SUMMARY_SUFFIX, _message_encoder.encode(window.summary), ex=ttl)
+    elif window.summary:
+        pipe.expire(key + SUMMARY_SUFFIX, ttl)
+    if window.candidate_seen:
+        pipe.delete(key + CANDIDATE_SUFFIX)
+    queue_bump(pipe, key, ttl)
+
+
+class ConversationStore:
+    """每个对话一个Redis列表，按消息追加和裁剪；session里只保存对话id。
+
+    配置了cache（l1_cache.VersionedCache）时，保存后的窗口留在进程内：下次加载只取版本号，
+    和缓存的一致就直接复用，省去读取整个列表和逐条解码。
+    配置了fallback（fallback.LocalFallback）时，Redis不可用期间的对话读写走本地，恢复后由fallback写回。
+    """
+
+    def __init__(self, client, counter, ttl=86400, prefix='conv:', codec=None, cache=None):
+        self.client = client
+        self.counter = counter
+        self.codec = codec
+        self.ttl = ttl
+        self.prefix = prefix
+        self.cache = cache
+        self.fallback = None
+
+    def key(self, conversation_id):
+        return self.prefix + conversation_id
+
+    def new_window(self):
+        return ConversationWindow(self.counter)
+
+    def queue_load(self, pipe, conversation_id):
+        key = self.key(conversation_id)
+        if self.cache is not None and self.cache.contains(key):
+            pipe.get(key + VERSION_SUFFIX)
+        else:
+            queue_load(pipe, key)
+
+    def decode(self, conversation_id, results):
+        """queue_load排进pipeline的命令的结果：只有版本号时从缓存取窗口，版本不一致就重新完整加载"""
+        if self.is_local(conversation_id):
+            return self.load_local(conversation_id)
+        if len(results) == 1:
+            snapshot = self.cache.get(self.key(conversation_id), results[0])
+            if snapshot is not None:
+                return ConversationWindow.from_snapshot(self.counter, snapshot)
+            pipe = self.client.pipeline(transaction=False)
+            queue_load(pipe, self.key(conversation_id))
+            try:
+                results = pipe.execute()
+            except redis.RedisError:
+                if self.fallback is None:
+                    raise
+                return self.load_local(conversation_id)
+        return ConversationWindow.decode(self.counter, *results, codec=self.codec)
+
+    def load(self, conversation_id):
+        # 列表在服务端已经裁剪过，整个列表就是当前窗口，和摘要一起一次取回
+        if self.is_local(conversation_id):
+            return self.load_local(conversation_id)
+        pipe = self.client.pipeline(transaction=False)
+        self.queue_load(pipe, conversation_id)
+        try:
+            results = pipe.execute()
+        except redis.RedisError as e:
+            if self.fallback is None:
+                raise
+            logger.warning(f"读取对话失败，使用本地降级数据: {str(e)}")
+            return self.load_local(conversation_id)
+        return self.decode(conversation_id, results)
+
+    def is_local(self, conversation_id):
+        """对话在降级期间写过本地、还没写回Redis"""
+        return self.fallback is not None and self.fallback.holds(conversation_id)
+
+    def load_local(self, conversation_id):
+        seed = self.cache.peek(self.key(conversation_id)) if self.cache is not None else None
+        return self.fallback.load_window(conversation_id, seed)
+
+    def save_local(self, conversation_id, window):
+        self.fallback.save_window(conversation_id, window)
+
+    def queue_window(self, pipe, conversation_id, window):
+        queue_save(pipe, self.key(conversation_id), window, self.ttl, self.codec)
+
+    def saved(self, conversation_id, window, results):
+        """queue_window的命令执行后调用：更新窗口的版本号并放进进程内缓存"""
+        window.mark_saved()
+        key = self.key(conversation_id)
+        if any(isinstance(result, Exception) for result in results):
+            if self.cache is not None:
+                self.cache.invalidate(key)
+            return
+        # 版本号正好加一说明加载之后没有其他写入，窗口和Redis里的内容一致，可以缓存
+        version, expected = results[-1], window.version + 1
+        window.version = version
+        if self.cache is not None:
+            if version == expected:
+                self.cache.put(key, version, window.snapshot())
+            else:
+                self.cache.invalidate(key)
+
+    def save(self, conversation_id, window):
+        """把本轮改动写回，一次往返内完成"""
+        pipe = self.client.pipeline(transaction=True)
+        self.queue_window(pipe, conversation_id, window)
+        self.saved(conversation_id, window, pipe.execute())
+
+    def clear(self, conversation_id):
+        key = self.key(conversation_id)
+        if self.cache is not None:
+            self.cache.invalidate(key)
+        if not self.is_local(conversation_id):
+            pipe = self.client.pipeline(transaction=True)
+            pipe.delete(key, key + SUMMARY_SUFFIX, key + CANDIDATE_SUFFIX)
+            # 版本号保留并递增，其他worker缓存的窗口随之失效
+            queue_bump(pipe, key, self.ttl)
+            try:
+                pipe.execute()
+                return
+            except redis.RedisError:
+                if self.fallback is None:
+                    raise
+        # 降级期间清空：回写时先删除Redis里的旧列表
+        self.fallback.save_window(conversation_id, self.new_window(), cleared=True)
@@ -0,0 +1,183 @@
+import logging
+import threading
+from collections import OrderedDict
+
+import redis
+
+from conversation import SUMMARY_SUFFIX, CANDIDATE_SUFFIX, ConversationWindow, encode_message, queue_bump
+
+logger = logging.getLogger('DeepSeekChat')
+
+
+class LocalFallback:
+    """Redis不可用时的进程内降级存储：session和对话窗口放在有界LRU里，保证聊天不中断。
+
+    降级期间写在本地的session和对话优先于Redis里的旧数据，直到Redis恢复后reconcile()把它们写回：
+    session只在Redis里不存在时写入（SET NX），降级期间新增的消息追加到对话列表末尾，
+    下次加载时照常按token预算裁剪。本地数据只在当前worker内可见。
+    """
+
+    def __init__(self, session_interface, store, breaker, max_sessions=10000, max_conversations=1000):
+        self.session_interface = session_interface
+        self.store = store
+        self.breaker = breaker
+        self.max_sessions = max_sessions
+        self.max_conversations = max_conversations
+        # sid -> (session数据, 有效期秒数)
+        self._sessions = OrderedDict()
+        # 对话id -> _LocalConversation
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+        self._reconcile_lock = threading.Lock()
+
+        self.session_reads = 0
+        self.session_writes = 0
+        self.window_reads = 0
+        self.window_writes = 0
+        self.evicted = 0
+        self.reconciled_sessions = 0
+        self.reconciled_conversations = 0
+        self.reconcile_failures = 0
+
+    @property
+    def pending(self):
+        return bool(self._sessions or self._conversations)
+
+    def get_session(self, sid):
+        with self._lock:
+            entry = self._sessions.get(sid)
+            if entry is None:
+                return None
+            self._sessions.move_to_end(sid)
+            self.session_reads += 1
+            return dict(entry[0])
+
+    def save_session(self, sid, data, ttl):
+        with self._lock:
+            self._sessions[sid] = (data, ttl)
+            self._sessions.move_to_end(sid)
+            self.session_writes += 1
+            self._evict(self._sessions, self.max_sessions)
+
+    def forget_session(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def holds(self, conversation_id):
+        return conversation_id in self._conversations
+
+    def load_window(self, conversation_id, seed=None):
+        """本地保存的窗口；没有时从seed（L1缓存里最后一次见到的窗口快照）开始，都没有就是空窗口"""
+        counter = self.store.counter
+        with self._lock:
+            entry = self._conversations.get(conversation_id)
+            self.window_reads += 1
+            if entry is not None:
+                self._conversations.move_to_end(conversation_id)
+                return ConversationWindow.from_snapshot(counter, entry.snapshot)
+        if seed is not None:
+            return ConversationWindow.from_snapshot(counter, seed)
+        return ConversationWindow(counter)
+
+    def save_window(self, conversation_id, window, cleared=False):
+        _, new_items = window.pending()
+        window.mark_saved()
+        with self._lock:
+            entry = self._conversations.get(conversation_id)
+            if entry is None:
+                entry = self._conversations[conversation_id] = _LocalConversation()
+            self._conversations.move_to_end(conversation_id)
+            entry.revision += 1
+            if cleared:
+                entry.cleared = entry.revision
+                entry.unsynced = []
+            entry.unsynced.extend(new_items)
+            entry.snapshot = window.snapshot()
+            self.window_writes += 1
+            self._evict(self._conversations, self.max_conversations)
+
+    def _evict(self, entries, limit):
+        while len(entries) > limit:
+            entries.popitem(last=False)
+            self.evicted += 1
+
+    def maybe_reconcile(self):
+        """熔断器放行时把本地数据写回Redis（冷却结束后这次回写本身就是试探）；同一时间只有一个线程在做"""
+        if not self.pending or not self.breaker.allow():
+            return
+        if not self._reconcile_lock.acquire(blocking=False):
+            return
+        try:
+            self._reconcile()
+        except redis.RedisError as e:
+            logger.warning(f"降级数据回写Redis失败: {str(e)}")
+            with self._lock:
+                self.reconcile_failures += 1
+        finally:
+            self._reconcile_lock.release()
+
+    def _reconcile(self):
+        with self._lock:
+            sessions = list(self._sessions.items())
+            conversations = [(cid, entry, entry.revision, list(entry.unsynced), entry.cleared)
+                             for cid, entry in self._conversations.items()]
+
+        interface = self.session_interface
+        store = self.store
+        pipe = store.client.pipeline(transaction=False)
+        for sid, (data, ttl) in sessions:
+            pipe.set(interface.key_prefix + sid, interface.serializer.encode(data), ex=ttl, nx=True)
+        for cid, _, _, unsynced, cleared in conversations:
+            key = store.key(cid)
+            if cleared:
+                pipe.delete(key, key + SUMMARY_SUFFIX, key + CANDIDATE_SUFFIX)
+            if unsynced:
+                pipe.rpush(key, *[encode_message(message, tokens, store.codec) for message, tokens in unsynced])
+            pipe.expire(key, store.ttl)
+            queue_bump(pipe, key, store.ttl)
+        pipe.execute()
+
+        with self._lock:
+            for sid, value in sessions:
+                if self._sessions.get(sid) is value:
+                    del self._sessions[sid]
+            for cid, entry, revision, unsynced, _ in conversations:
+                if store.cache is not None:
+                    store.cache.invalidate(store.key(cid))
+                if self._conversations.get(cid) is not entry:
+                    continue
+                if entry.revision == revision:
+                    del self._conversations[cid]
+                elif entry.cleared <= revision:
+                    # 回写期间又有新消息：只保留还没写回的部分；期间又被清空的话整条保留，下次连同清空一起写回
+                    del entry.unsynced[:len(unsynced)]
+                    entry.cleared = 0
+            self.reconciled_sessions += len(sessions)
+            self.reconciled_conversations += len(conversations)
+        logger.info(f"Redis已恢复，回写{len(sessions)}个session和{len(conversations)}个对话")
+
+    def stats(self):
+        return {
+            'degraded': self.breaker.state != self.breaker.CLOSED,
+            'local_sessions': len(self._sessions),
+            'local_conversations': len(self._conversations),
+            'session_reads': self.session_reads,
+            'session_writes': self.session_writes,
+            'window_reads': self.window_reads,
+            'window_writes': self.window_writes,
+            'evicted': self.evicted,
+            'reconciled_sessions': self.reconciled_sessions,
+            'reconciled_conversations': self.reconciled_conversations,
+            'reconcile_failures': self.reconcile_failures,
+        }
+
+
+class _LocalConversation:
+    __slots__ = ('snapshot', 'unsynced', 'cleared', 'revision')
+
+    def __init__(self):
+        self.snapshot = None
+        self.unsynced = []
+        # 降级期间清空历史时的revision，回写时先删除Redis里的旧列表
+        self.cleared = 0
+        self.revision = 0
@@ -0,0 +1,114 @@
+import json
+import logging
+import secrets
+import threading
+import time
+
+import redis
+
+from redis_access import BLOCK_MS
+
+logger = logging.getLogger('DeepSeekChat')
+
+# web和generation worker之间的任务队列。web把本轮用户消息和生成任务一起写入，然后转发worker
+# 写进续传缓冲（resumable.py）的输出；worker（worker.py）从消费组里领任务、调用上游、保存回答。
+# 两层各自扩容；web重启时浏览器带Last-Event-ID连到其他web进程接着读，生成不受影响。
+
+
+class GenerationQueue:
+    """Redis Stream + 消费组：任务交给某个worker后留在它的待确认列表里，直到处理完确认删除"""
+
+    def __init__(self, client, stream='gen:jobs', group='generators', claim_idle=300, wait_timeout=60,
+                 maxlen=10000):
+        self.client = client
+        self.stream = stream
+        self.group = group
+        # 待确认超过这个秒数的任务视为worker已经崩溃，由其他worker接手
+        self.claim_idle = claim_idle
+        # web等待worker开始输出的最长时间（包括排队）
+        self.wait_timeout = wait_timeout
+        self.maxlen = maxlen
+
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.reclaimed = 0
+
+    def new_job_id(self):
+        return secrets.token_urlsafe(12)
+
+    def queue_submit(self, pipe, job_id, conversation_id, payload):
+        """把任务排进调用方的pipeline（和本轮用户消息的写入一起发出）"""
+        fields = {
+            'id': job_id,
+            'conversation_id': conversation_id,
+            'payload': json.dumps(payload, ensure_ascii=False),
+            'created': str(time.time()),
+        }
+        pipe.xadd(self.stream, fields, maxlen=self.maxlen, approximate=True)
+        with self._lock:
+            self.submitted += 1
+
+    def ensure_group(self):
+        try:
+            self.client.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def read(self, consumer):
+        """领一个新任务，返回 (条目id, 任务)；BLOCK_MS内没有任务时返回None"""
+        result = self.client.xreadgroup(self.group, consumer, {self.stream: '>'}, count=1, block=BLOCK_MS)
+        if not result or not result[0][1]:
+            return None
+        entry_id, fields = result[0][1][0]
+        return entry_id, _decode(fields)
+
+    def reclaim(self, consumer, count=10):
+        """接手崩溃worker留下的任务，返回 [(条目id, 任务)]"""
+        result = self.client.xautoclaim(
+            self.stream, self.group, consumer, int(self.claim_idle * 1000), start_id='0-0', count=count
+        )
+        jobs = [(entry_id, _decode(fields)) for entry_id, fields in result[1] if fields]
+        if jobs:
+            with self._lock:
+                self.reclaimed += len(jobs)
+        return jobs
+
+    def ack(self, entry_id, failed=False):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.xack(self.stream, self.group, entry_id)
+        pipe.xdel(self.stream, entry_id)
+        pipe.execute()
+        with self._lock:
+            if failed:
+                self.failed += 1
+            else:
+                self.processed += 1
+
+    def stats(self):
+        stats = {
+            'submitted': self.submitted,
+            'processed': self.processed,
+            'failed': self.failed,
+            'reclaimed': self.reclaimed,
+        }
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.xlen(self.stream)
+            pipe.xpending(self.stream, self.group)
+            length, pending = pipe.execute()
+            # 处理完的任务会被删除，Stream里剩下的是排队中的和处理中的
+            stats['queued'] = length - pending['pending']
+            stats['in_progress'] = pending['pending']
+        except redis.RedisError:
+            pass
+        return stats
+
+
+def _decode(fields):
+    job = {key.decode(): value.decode('utf-8') for key, value in fields.items()}
+    job['payload'] = json.loads(job['payload'])
+    job['created'] = float(job['created'])
+    return job
@@ -0,0 +1,61 @@
+import gc
+import multiprocessing
+import os
+import tempfile
+
+# 生产环境入口：gunicorn -c gunicorn.conf.py 'app:create_app()'
+# 每条SSE流在生成期间占住一个线程，大部分时间在等上游的下一个token，所以用gthread：
+# 每个worker开几百个线程，空闲的流只占一个阻塞在socket上的线程，不占CPU。
+# 单机上万条并发流时，把 /api/stream-chat 转发给 async_app（aiohttp worker，启动命令见async_app.py开头）。
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count() * 2)))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "256"))
+# 超过 workers * threads 的连接在backlog里排队
+backlog = int(os.getenv("GUNICORN_BACKLOG", "2048"))
+
+# gthread的心跳由worker主线程负责，流再长也不会被timeout杀掉；timeout只处理真正卡死的worker
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+# 回收或重载worker时给进行中的流留出说完的时间
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "120"))
+# 放在反向代理后面时要比代理的空闲超时长（nginx默认60秒），避免代理复用一个刚被关掉的连接
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "75"))
+
+# 定期回收worker，缓解内存碎片和泄漏；加抖动避免所有worker同时重启
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "5000"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "500"))
+
+# 在master里导入一次应用（词表、配置、Lua脚本等），worker fork后共享这些内存页
+preload_app = True
+
+accesslog = os.getenv("GUNICORN_ACCESS_LOG", "-")
+errorlog = "-"
+
+# /metrics 要汇总所有worker：各worker定期把自己的指标写进这个目录（配置文件在导入应用之前加载）。
+# 同一台机器上的generation worker设置相同的METRICS_DIR，它们的指标也会出现在 /metrics 里
+# 连接池按线程数配置（配置文件在导入应用之前加载，显式设置的环境变量优先）：每个线程同时最多一次上游调用；
+# 转发generation worker输出和续传的流在阻塞的XREAD里一直占着一个Redis连接，再留一些给后台线程
+# （L1缓存的订阅、压缩、指标等）。Redis的连接总数约为 workers * REDIS_POOL_SIZE，注意不要超过maxclients。
+# 浏览器断开后为follower或续传继续读上游的后台线程不占请求线程，池满时等UPSTREAM_POOL_TIMEOUT秒后报错
+os.environ.setdefault("UPSTREAM_POOL_SIZE", str(threads))
+os.environ.setdefault("REDIS_POOL_SIZE", str(threads + 32))
+
+os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), f"minidoubao-metrics-{bind.rsplit(':', 1)[-1]}"))
+
+# master加载应用期间不做GC，fork前把所有存活对象移到永久代：worker里的GC不再遍历和改写
+# 这些对象的GC头，共享的内存页不会因为写时复制被逐页复制
+gc.disable()
+
+
+def on_starting(server):
+    # 上一次运行留下的文件不计入本次的计数
+    from metrics import reset_directory
+    reset_directory(os.environ["METRICS_DIR"])
+
+
+def pre_fork(server, worker):
+    # 冻结后马上重新打开GC：master要一直运行、不断重新fork被回收的worker，不能一直关着GC；
+    # 之后新分配的对象在下一次fork前又会被冻结。worker继承打开的GC
+    gc.freeze()
+    gc.enable()
@@ -0,0 +1,127 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import redis
+
+logger = logging.getLogger('DeepSeekChat')
+
+
+class VersionedCache:
+    """每个worker进程内的有界LRU缓存（L1），条目带版本号。
+
+    写入Redis的一方把版本号加一并在channel上广播 "<key> <版本号>"，各worker收到后淘汰更旧的条目。
+    读取时调用方还要拿同一次往返取回的版本号核对，订阅断开期间漏掉的消息不会导致读到旧数据。
+    clients是存放这些键的所有Redis节点，广播发生在键所在的节点上，所以每个节点各订阅一次。
+    """
+
+    def __init__(self, clients, channel, max_entries=1000):
+        self.clients = list(clients)
+        self.channel = channel
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._threads = []
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.invalidations = 0
+
+    def contains(self, key):
+        """探测时不在缓存里记一次未命中，调用方随后走完整加载"""
+        if key in self._entries:
+            return True
+        with self._lock:
+            self.misses += 1
+        return False
+
+    def get(self, key, version):
+        """版本号一致时返回缓存的值；不一致的条目直接淘汰"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if version is None or int(version) != entry[0]:
+                del self._entries[key]
+                self.stale += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, key):
+        """不核对版本号的读取，只用于Redis不可用时的降级"""
+        entry = self._entries.get(key)
+        return entry[1] if entry is not None else None
+
+    def put(self, key, version, value):
+        self._ensure_subscribed()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= version:
+                return
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _on_message(self, message):
+        key, _, version = message['data'].decode('utf-8').rpartition(' ')
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < int(version):
+                del self._entries[key]
+                self.invalidations += 1
+
+    def _on_error(self, e, pubsub, thread):
+        # 漏掉的失效消息由读取时的版本号核对兜底，条目保留（Redis不可用时还要用作降级的种子），下次写入时重新订阅
+        logger.warning(f"L1缓存失效订阅中断: {str(e)}")
+        thread.stop()
+        pubsub.close()
+        with self._lock:
+            self._pid = None
+
+    def _ensure_subscribed(self):
+        # 订阅线程不会随fork进入子进程，按进程号判断是否需要（重新）订阅
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # fork出来的子进程不沿用父进程的条目
+                self._entries.clear()
+            for thread in self._threads:
+                thread.stop()
+            self._threads = []
+            try:
+                for client in self.clients:
+                    pubsub = client.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(**{self.channel: self._on_message})
+                    self._threads.append(
+                        pubsub.run_in_thread(sleep_time=1.0, daemon=True, exception_handler=self._on_error)
+                    )
+            except redis.RedisError as e:
+                logger.warning(f"L1缓存失效订阅失败: {str(e)}")
+                return
+            self._pid = os.getpid()
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.stale
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'invalidations': self.invalidations,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'subscribed': self._pid == os.getpid(),
+        }
@@ -0,0 +1,329 @@
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from bisect import bisect_left
+
+logger = logging.getLogger('DeepSeekChat')
+
+# 进程内的指标注册表，/metrics 按Prometheus文本格式输出。
+# 每个线程累加自己的一份分片，更新时不加锁；读取时把所有分片相加。线程退出后它的分片并入基数并丢弃，
+# 每个请求一个线程的服务器（开发服务器）里分片数不会随请求数增长。
+# 配置了目录时每个进程定期把自己的累计值写成 <目录>/<pid>.json，输出时合并同一台机器上
+# 所有进程（gunicorn的各个worker、generation worker）的文件；已经退出的进程的值并入archive.json，
+# 计数不会因为worker被回收而倒退。
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+REDIS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+TOKEN_GAP_BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+TOKEN_RATE_BUCKETS = (1, 5, 10, 20, 30, 40, 60, 80, 100, 150, 200)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+ARCHIVE = 'archive.json'
+
+
+class Counter:
+    """只增不减的计数，按标签值分组"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._reset()
+
+    def _reset(self):
+        self._local = threading.local()
+        self._shards = []
+        self._base = {}
+        # 分片可能在任意线程里被回收（见_retire），用可重入锁
+        self._lock = threading.RLock()
+
+    def _shard(self):
+        shard = getattr(self._local, 'values', None)
+        if shard is None:
+            shard = self._local.values = {}
+            # 线程退出时线程局部变量被释放，owner随之回收，触发_retire
+            owner = self._local.owner = _Owner()
+            weakref.finalize(owner, self._retire, shard).atexit = False
+            with self._lock:
+                self._shards.append(shard)
+            self.registry.ensure_flusher()
+        return shard
+
+    def _retire(self, shard):
+        with self._lock:
+            # fork前的分片不在子进程的列表里，不并入
+            if not any(s is shard for s in self._shards):
+                return
+            self._shards = [s for s in self._shards if s is not shard]
+            for labels, value in list(shard.items()):
+                self._base[labels] = self._merge(self._base.get(labels), value)
+
+    def inc(self, *labels, amount=1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def collect(self):
+        """本进程的累计值：{标签值元组: 值}"""
+        with self._lock:
+            shards = list(self._shards)
+            values = {labels: self._merge(None, value) for labels, value in self._base.items()}
+        for shard in shards:
+            for labels, value in list(shard.items()):
+                values[labels] = self._merge(values.get(labels), value)
+        return values
+
+    def _merge(self, total, value):
+        return value if total is None else total + value
+
+    def samples(self, labels, value):
+        yield self.name, labels, value
+
+
+class _Owner:
+    """线程局部的占位对象，只用来感知线程退出"""
+
+
+class Histogram(Counter):
+    """累积分桶的直方图；每组标签的值为 [各桶计数..., 超出最大桶的计数, 总和]"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(float(bound) for bound in buckets)
+
+    def observe(self, value, *labels):
+        shard = self._shard()
+        counts = shard.get(labels)
+        if counts is None:
+            counts = shard[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def _merge(self, total, value):
+        if total is None:
+            return list(value)
+        return [a + b for a, b in zip(total, value)]
+
+    def samples(self, labels, value):
+        cumulative = 0
+        for bound, count in zip(self.buckets, value):
+            cumulative += count
+            yield self.name + '_bucket', labels + (('le', _format(bound)),), cumulative
+        cumulative += value[-2]
+        yield self.name + '_bucket', labels + (('le', '+Inf'),), cumulative
+        yield self.name + '_sum', labels, value[-1]
+        yield self.name + '_count', labels, cumulative
+
+
+class MetricsRegistry:
+
+    def __init__(self, directory=None, flush_interval=5):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 子进程不沿用父进程的分片和写文件的线程
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f'指标重复注册: {metric.name}')
+        metric.registry = self
+        self._metrics[metric.name] = metric
+        return metric
+
+    def _after_fork(self):
+        self._pid = None
+        for metric in self._metrics.values():
+            metric._reset()
+
+    def ensure_flusher(self):
+        """每个进程第一次更新指标时启动写文件的线程"""
+        if not self.directory or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True).start()
+            atexit.register(self.flush)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def snapshot(self):
+        """本进程的全部指标：{指标名: {标签值元组: 值}}"""
+        return {name: metric.collect() for name, metric in self._metrics.items()}
+
+    def flush(self):
+        """把本进程的累计值写进 <目录>/<pid>.json"""
+        if not self.directory:
+            return
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        try:
+            _write_json(path, _encode(self.snapshot()))
+        except OSError as e:
+            logger.warning(f"写入指标文件失败: {str(e)}")
+
+    def collect(self):
+        """合并本进程的实时值、其他进程的文件和已退出进程的归档"""
+        totals = self.snapshot()
+        if not self.directory:
+            return totals
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            archive_path = os.path.join(self.directory, ARCHIVE)
+            archive = _decode(_read_json(archive_path))
+            archived = False
+            for entry in os.listdir(self.directory):
+                pid = entry[:-len('.json')]
+                if not entry.endswith('.json') or not pid.isdigit():
+                    continue
+                pid = int(pid)
+                if pid == os.getpid():
+                    continue
+                values = _decode(_read_json(os.path.join(self.directory, entry)))
+                if _alive(pid):
+                    self._add(totals, values)
+                else:
+                    self._add(archive, values)
+                    os.unlink(os.path.join(self.directory, entry))
+                    archived = True
+            if archived:
+                _write_json(archive_path, _encode(archive))
+        self._add(totals, archive)
+        return totals
+
+    def _add(self, totals, values):
+        for name, series in values.items():
+            metric = self._metrics.get(name)
+            if metric is None:
+                continue
+            merged = totals.setdefault(name, {})
+            for labels, value in series.items():
+                merged[labels] = metric._merge(merged.get(labels), value)
+
+    def render(self):
+        """Prometheus文本格式（text/plain; version=0.0.4）"""
+        totals = self.collect()
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.append(f'# HELP {name} {metric.help}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for labels, value in sorted(totals.get(name, {}).items()):
+                pairs = tuple(zip(metric.labels, labels))
+                for sample, sample_labels, sample_value in metric.samples(pairs, value):
+                    lines.append(f'{sample}{_format_labels(sample_labels)} {_format(sample_value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class StreamTimings:
+    """一次上游流式调用的时间线：从发出请求到首个token、token之间的间隔、首token之后的生成速度"""
+
+    def __init__(self, duration, ttft, gap, rate):
+        self._duration = duration
+        self._ttft = ttft
+        self._gap = gap
+        self._rate = rate
+        self.start = time.perf_counter()
+        self.first = None
+        self.last = None
+
+    def token(self):
+        now = time.perf_counter()
+        if self.last is None:
+            self.first = now
+            self._ttft.observe(now - self.start)
+        else:
+            self._gap.observe(now - self.last)
+        self.last = now
+
+    def finish(self, completion_tokens=None):
+        """流正常结束时调用；completion_tokens取自上游的usage"""
+        self._duration.observe(time.perf_counter() - self.start)
+        if completion_tokens and self.first is not None and self.last > self.first:
+            self._rate.observe(completion_tokens / (self.last - self.first))
+
+
+def reset_directory(directory):
+    """清空上一次运行留下的指标文件（gunicorn master启动时调用）"""
+    if not directory or not os.path.isdir(directory):
+        return
+    for entry in os.listdir(directory):
+        if entry.endswith('.json') or entry.endswith('.tmp'):
+            os.unlink(os.path.join(directory, entry))
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _encode(snapshot):
+    return {
+        name: {json.dumps(labels, ensure_ascii=False): value for labels, value in series.items()}
+        for name, series in snapshot.items()
+    }
+
+
+def _decode(data):
+    return {
+        name: {tuple(json.loads(key)): value for key, value in series.items()}
+        for name, series in data.items()
+    }
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_json(path, data):
+    # 先写临时文件再改名，读取方不会读到写了一半的文件
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _format(value):
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,78 @@
+import json
+import os
+import time
+
+from flask import Flask, Response, jsonify, request
+
+from compaction import SUMMARY_PROMPT
+
+# 模拟DeepSeek聊天接口，用于本地测试和压测，不消耗真实额度：
+#   python mock_upstream.py
+#   DEEPSEEK_API_URL=http://127.0.0.1:5055/v1/chat/completions DEEPSEEK_API_KEY=test python app.py
+# 支持流式和非流式、stream_options.include_usage，以及后台压缩发出的摘要请求。
+app = Flask(__name__)
+
+first_token_delay = float(os.getenv("MOCK_FIRST_TOKEN_MS", "200")) / 1000
+token_delay = float(os.getenv("MOCK_TOKEN_MS", "20")) / 1000
+reply_chars = int(os.getenv("MOCK_REPLY_CHARS", "60"))
+
+
+def prompt_tokens(messages):
+    # 粗略按一个字符一个token计，另加每条消息的模板开销
+    return sum(len(msg.get("content", "")) + 4 for msg in messages)
+
+
+def make_reply(messages):
+    if messages and messages[0].get("content") == SUMMARY_PROMPT:
+        return "（模拟摘要）" + messages[-1]["content"][:40]
+    last = messages[-1].get("content", "") if messages else ""
+    text = f"这是对“{last[:20]}”的模拟回答。"
+    return (text * (reply_chars // len(text) + 1))[:reply_chars]
+
+
+def make_usage(messages, reply):
+    prompt = prompt_tokens(messages)
+    return {
+        "prompt_tokens": prompt,
+        "completion_tokens": len(reply),
+        "total_tokens": prompt + len(reply),
+        "prompt_cache_hit_tokens": 0,
+        "prompt_cache_miss_tokens": prompt,
+    }
+
+
+@app.route('/v1/chat/completions', methods=['POST'])
+def chat_completions():
+    data = request.json
+    messages = data.get("messages", [])
+    reply = make_reply(messages)
+    usage = make_usage(messages, reply)
+
+    if not data.get("stream"):
+        time.sleep(first_token_delay + token_delay * len(reply))
+        return jsonify({
+            "object": "chat.completion",
+            "model": data.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+            "usage": usage
+        })
+
+    include_usage = (data.get("stream_options") or {}).get("include_usage", False)
+
+    def generate():
+        time.sleep(first_token_delay)
+        for char in reply:
+            chunk = {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": char}}]}
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            time.sleep(token_delay)
+        final = {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        if include_usage:
+            final["usage"] = usage
+        yield f"data: {json.dumps(final, ensure_ascii=False)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return Response(generate(), mimetype='text/event-stream')
+
+
+if __name__ == '__main__':
+    app.run(host='127.0.0.1', port=int(os.getenv("MOCK_UPSTREAM_PORT", "5055")), threaded=True)
@@ -0,0 +1,184 @@
+import logging
+import threading
+import time
+
+import redis
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+
+logger = logging.getLogger('DeepSeekChat')
+
+# 每个请求的Redis访问：连接池大小固定并由所有组件共享，请求前的读取和请求后的写入各攒成一次往返，
+# 并按请求统计花在Redis上的时间和往返次数。
+# 连接层带熔断器：连续超时或连不上时打开，之后的命令不再碰网络，直接抛出RedisUnavailable。
+
+# XREAD等阻塞命令一次最多阻塞的毫秒数：要小于客户端的socket_timeout，否则空等也会被当成读超时
+# 计入熔断；需要等更久的调用方按这个间隔循环
+BLOCK_MS = 1000
+
+_local = threading.local()
+
+
+class RedisUnavailable(redis.ConnectionError):
+    """熔断器打开期间的快速失败，不计入连续失败次数"""
+
+
+class TimedConnection(redis.Connection):
+    """记录当前线程在Redis上花的时间；一次send_packed_command就是一次往返（pipeline也只发一次）。
+
+    配置了latency（metrics.Histogram）时按命令记录每次往返从发出到收到第一个回复的时间，pipeline记为PIPELINE。
+    """
+
+    breaker = None
+    latency = None
+    _command = None
+    _sent = None
+
+    def send_command(self, *args, **kwargs):
+        self._command = args[0]
+        super().send_command(*args, **kwargs)
+
+    def connect(self, *args, **kwargs):
+        # 连接池取连接时总会先调用connect()，已连接的也一样，熔断检查放在这里
+        if self.breaker is not None and not self.breaker.allow():
+            raise RedisUnavailable('Redis熔断中')
+        return self._guarded(super().connect, *args, **kwargs)
+
+    def send_packed_command(self, command, check_health=True):
+        start = time.perf_counter()
+        name = self._command or 'PIPELINE'
+        self._command = None
+        try:
+            return self._guarded(super().send_packed_command, command, check_health)
+        finally:
+            _local.seconds = getattr(_local, 'seconds', 0.0) + time.perf_counter() - start
+            _local.round_trips = getattr(_local, 'round_trips', 0) + 1
+            # 健康检查的PING在发送过程中已经完成了一次往返，这里才记下本次命令
+            self._sent = (name, start)
+
+    def read_response(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self._guarded(super().read_response, *args, **kwargs)
+        finally:
+            now = time.perf_counter()
+            _local.seconds = getattr(_local, 'seconds', 0.0) + now - start
+            # 订阅连接上没有先发命令的读取不计入
+            if self._sent is not None:
+                if self.latency is not None:
+                    self.latency.observe(now - self._sent[1], self._sent[0])
+                self._sent = None
+        if self.breaker is not None:
+            self.breaker.record_success()
+        return response
+
+    def _guarded(self, call, *args, **kwargs):
+        try:
+            return call(*args, **kwargs)
+        except RedisUnavailable:
+            raise
+        except (redis.ConnectionError, redis.TimeoutError, OSError):
+            if self.breaker is not None:
+                self.breaker.record_failure()
+            raise
+
+
+def create_client(host, port, max_connections=50, pool_timeout=5, breaker=None, latency=None, **kwargs):
+    """连接数有上限的共享客户端：池满时等待最多pool_timeout秒，而不是无限新建连接。
+
+    传入breaker时所有连接共用这个熔断器；客户端内部不再重试，失败直接交给调用方降级。
+    传入latency时记录每个命令的往返耗时。
+    """
+    connection_class = TimedConnection
+    if breaker is not None or latency is not None:
+        connection_class = type('GuardedConnection', (TimedConnection,), {'breaker': breaker, 'latency': latency})
+    if breaker is not None:
+        kwargs.setdefault('retry', Retry(NoBackoff(), 0))
+    pool = redis.BlockingConnectionPool(
+        host=host,
+        port=port,
+        max_connections=max_connections,
+        timeout=pool_timeout,
+        connection_class=connection_class,
+        **kwargs
+    )
+    return redis.Redis(connection_pool=pool)
+
+
+class RequestTimer:
+    """按请求汇总Redis耗时和往返次数；传入histogram时同时记录每个请求的Redis总耗时分布"""
+
+    def __init__(self, histogram=None):
+        self.histogram = histogram
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.round_trips = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def begin(self):
+        _local.seconds = 0.0
+        _local.round_trips = 0
+
+    def end(self):
+        seconds = getattr(_local, 'seconds', 0.0)
+        round_trips = getattr(_local, 'round_trips', 0)
+        with self._lock:
+            self.requests += 1
+            self.round_trips += round_trips
+            self.seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+        if self.histogram is not None:
+            self.histogram.observe(seconds)
+        return seconds, round_trips
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'round_trips_avg': round(self.round_trips / self.requests, 2) if self.requests else 0.0,
+            'redis_ms_avg': round(self.seconds * 1000 / self.requests, 3) if self.requests else 0.0,
+            'redis_ms_max': round(self.max_seconds * 1000, 3),
+        }
+
+
+class WriteBatch:
+    """一个请求结束时的全部写操作，排进同一个MULTI事务一次发出。
+
+    add()的queue(pipe, *args)把命令排进pipeline，callback收到这几条命令各自的结果（出错的是异常对象）。
+    client指定这组命令写到哪个客户端（比如分片的session存储），不指定时用批次默认的客户端；
+    每个客户端各一个事务，某个客户端失败时其余的照常执行和回调，最后再抛出第一个异常。
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._ops = []
+
+    def add(self, queue, *args, callback=None, client=None):
+        self._ops.append((client or self.client, queue, args, callback))
+
+    def execute(self):
+        if not self._ops:
+            return
+        ops, self._ops = self._ops, []
+        groups = {}
+        for client, queue, args, callback in ops:
+            groups.setdefault(id(client), (client, []))[1].append((queue, args, callback))
+
+        error = None
+        for client, group in groups.values():
+            pipe = client.pipeline(transaction=True)
+            spans = []
+            for queue, args, callback in group:
+                start = len(pipe)
+                queue(pipe, *args)
+                spans.append((start, len(pipe), callback))
+            try:
+                results = pipe.execute(raise_on_error=False)
+            except redis.RedisError as e:
+                error = error or e
+                continue
+            for start, end, callback in spans:
+                if callback is not None:
+                    callback(results[start:end])
+        if error is not None:
+            raise error
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+
+import redis
+
+logger = logging.getLogger('DeepSeekChat')
+
+# 写入并按LRU淘汰：索引zset以最近访问时间为分数，先清理已过期的，再把超出上限的最旧条目删掉
+_SET_SCRIPT = """
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], KEYS[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', tonumber(ARGV[3]) - tonumber(ARGV[2]))
+local excess = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[4])
+if excess > 0 then
+    local old = redis.call('ZRANGE', KEYS[2], 0, excess - 1)
+    for _, key in ipairs(old) do
+        redis.call('DEL', key)
+    end
+    redis.call('ZREMRANGEBYRANK', KEYS[2], 0, excess - 1)
+    return excess
+end
+return 0
+"""
+
+
+def payload_hash(payload):
+    """请求的规范化哈希：只取影响回答的字段，键排序、紧凑分隔符，同样的内容得到同样的哈希"""
+    canonical = json.dumps(
+        {
+            'model': payload['model'],
+            'max_tokens': payload['max_tokens'],
+            'messages': payload['messages'],
+        },
+        ensure_ascii=False, sort_keys=True, separators=(',', ':')
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """完全相同的请求（模型、max_tokens、裁剪后的消息列表）直接返回缓存的回答"""
+
+    def __init__(self, client, ttl=3600, max_entries=10000, prefix='respcache:'):
+        self.client = client
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.prefix = prefix
+        self.index_key = prefix + 'index'
+        self._set_script = client.register_script(_SET_SCRIPT)
+
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+        self.errors = 0
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def make_key(self, payload):
+        return self.prefix + payload_hash(payload)
+
+    def get(self, key):
+        pipe = self.client.pipeline(transaction=False)
+        self.queue_get(pipe, key)
+        try:
+            results = pipe.execute()
+        except redis.RedisError as e:
+            results = [e]
+        return self.get_done(results)
+
+    def queue_get(self, pipe, key):
+        """排进请求前的读取批次，结果交给get_done"""
+        pipe.get(key)
+        pipe.zadd(self.index_key, {key: time.time()}, xx=True)
+
+    def get_done(self, results):
+        cached = results[0]
+        if isinstance(cached, Exception):
+            logger.warning(f"响应缓存读取失败: {str(cached)}")
+            with self._lock:
+                self.errors += 1
+            return None
+
+        with self._lock:
+            if cached is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.bytes_saved += len(cached)
+        return cached.decode('utf-8')
+
+    def set(self, key, text):
+        try:
+            evicted = self._set_script(**self._set_params(key, text))
+        except redis.RedisError as e:
+            evicted = e
+        self.set_done([evicted])
+
+    def queue_set(self, pipe, key, text):
+        """排进请求结束时的写入批次，结果交给set_done。
+
+        直接EVAL脚本：pipeline里用Script对象会先多一次SCRIPT EXISTS往返。
+        """
+        params = self._set_params(key, text)
+        pipe.eval(_SET_SCRIPT, len(params['keys']), *params['keys'], *params['args'])
+
+    def set_done(self, results):
+        evicted = results[0]
+        if isinstance(evicted, Exception):
+            logger.warning(f"响应缓存写入失败: {str(evicted)}")
+            with self._lock:
+                self.errors += 1
+            return
+        if evicted:
+            with self._lock:
+                self.evictions += evicted
+
+    def _set_params(self, key, text):
+        return {
+            'keys': [key, self.index_key],
+            'args': [text.encode('utf-8'), self.ttl, time.time(), self.max_entries],
+        }
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'bytes_saved': self.bytes_saved,
+            'evictions': self.evictions,
+            'errors': self.errors,
+        }
+
+
+def replay_chunks(text, size):
+    """把缓存的回答切成小段，按流式接口的节奏回放"""
+    size = max(size, 1)
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
@@ -0,0 +1,184 @@
+import logging
+import re
+import secrets
+import threading
+import time
+
+import redis
+
+from redis_access import BLOCK_MS
+
+logger = logging.getLogger('DeepSeekChat')
+
+# 可续传的流：每次生成的delta按顺序写进一个短期的Redis Stream，条目id就是SSE的序号（"序号-0"），
+# 发给浏览器的帧带上 "id: 生成id:序号"。连接中断后浏览器带着Last-Event-ID重连，
+# 从这个Stream里补发缺失的帧，再接着读后续的帧，不再重新调用上游。
+# 生成id是随机的，只有收到过这条流的客户端知道。
+
+_EVENT_ID = re.compile(r'^([A-Za-z0-9_-]{8,64}):(\d+)$')
+
+
+class ResumeError(Exception):
+    """续传失败：缓冲已过期、生成出错或长时间没有新输出"""
+
+
+class StreamBuffer:
+    """一次生成的输出缓冲，由调用上游的请求写入"""
+
+    def __init__(self, client, gen_id, key, ttl, live_ttl):
+        self.id = gen_id
+        self._client = client
+        self._key = key
+        self._ttl = ttl
+        self._live_ttl = live_ttl
+        self._seq = 0
+
+    def append(self, content):
+        """写入一段delta，返回这一帧的SSE id；Redis不可用时返回None，之后的帧不再可续传"""
+        if self._client is None:
+            return None
+        self._seq += 1
+        try:
+            if self._seq == 1:
+                # 生成中的缓冲也要有过期时间，worker中途被杀时不会留下垃圾
+                pipe = self._client.pipeline(transaction=False)
+                pipe.xadd(self._key, {'d': content}, id=f'{self._seq}-0')
+                pipe.expire(self._key, self._live_ttl)
+                pipe.execute()
+            else:
+                self._client.xadd(self._key, {'d': content}, id=f'{self._seq}-0')
+        except redis.RedisError as e:
+            logger.warning(f"写入续传缓冲失败: {str(e)}")
+            self._client = None
+            return None
+        return f'{self.id}:{self._seq}'
+
+    def finish(self, error=None):
+        """写入结束标记，缓冲在ttl秒后自动过期"""
+        if self._client is None:
+            return
+        pipe = self._client.pipeline(transaction=False)
+        # 结束标记用自动生成的id（毫秒时间戳，总比序号大），接手崩溃worker的任务时不需要知道写到了第几帧
+        pipe.xadd(self._key, {'error': error} if error else {'done': '1'})
+        pipe.expire(self._key, self._ttl)
+        try:
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"写入续传结束标记失败: {str(e)}")
+
+    def resumed(self):
+        """是否有客户端来续传过这条流"""
+        if self._client is None:
+            return False
+        try:
+            return bool(self._client.exists(self._key + ':resumed'))
+        except redis.RedisError:
+            return False
+
+    def cancelled(self, grace):
+        """转发这条流的浏览器已断开超过grace秒，且之后没有客户端来续传"""
+        if self._client is None:
+            return False
+        try:
+            since = self._client.get(self._key + ':cancel')
+        except redis.RedisError:
+            return False
+        return since is not None and time.time() - float(since) >= grace
+
+
+class ResumableStreams:
+
+    def __init__(self, client, ttl=60, live_ttl=600, grace=10, prefix='resume:'):
+        self.client = client
+        self.ttl = ttl
+        self.live_ttl = live_ttl
+        # 浏览器断开后继续读上游、等它重连的秒数；超时没人续传就关闭上游连接
+        self.grace = grace
+        self.prefix = prefix
+
+        self._lock = threading.Lock()
+        self.started = 0
+        self.resumed = 0
+        self.frames_replayed = 0
+        self.failed = 0
+
+    def start(self, gen_id=None):
+        """开始写一条流的缓冲；gen_id为空时生成新的id"""
+        gen_id = gen_id or secrets.token_urlsafe(12)
+        with self._lock:
+            self.started += 1
+        return StreamBuffer(self.client, gen_id, self.prefix + gen_id, self.ttl, self.live_ttl)
+
+    def cancel(self, gen_id):
+        """转发这条流的浏览器断开了：记下时间，写缓冲的一方等待grace秒没人续传就停止生成"""
+        try:
+            self.client.set(self.prefix + gen_id + ':cancel', str(time.time()), ex=self.live_ttl)
+        except redis.RedisError as e:
+            logger.warning(f"记录流取消失败: {str(e)}")
+
+    def resume(self, last_event_id, timeout=30):
+        """产出Last-Event-ID之后的 (SSE id, delta)，直到生成结束；失败时抛出ResumeError"""
+        match = _EVENT_ID.match(last_event_id or '')
+        if match is None:
+            raise ResumeError('无效的Last-Event-ID')
+        gen_id, seq = match.group(1), int(match.group(2))
+        key = self.prefix + gen_id
+
+        pipe = self.client.pipeline(transaction=False)
+        pipe.set(key + ':resumed', '1', ex=self.live_ttl)
+        pipe.delete(key + ':cancel')
+        pipe.exists(key)
+        try:
+            _, _, exists = pipe.execute()
+        except redis.RedisError as e:
+            self._count_failure()
+            raise ResumeError(f'读取续传缓冲失败: {str(e)}')
+        if not exists:
+            self._count_failure()
+            raise ResumeError('续传缓冲已过期')
+        with self._lock:
+            self.resumed += 1
+        for event_id, content in self.follow(gen_id, seq, timeout):
+            with self._lock:
+                self.frames_replayed += 1
+            yield event_id, content
+
+    def follow(self, gen_id, seq=0, timeout=30):
+        """产出第seq帧之后的 (SSE id, delta)，缓冲还不存在时等它出现；失败时抛出ResumeError"""
+        key = self.prefix + gen_id
+        last_id = f'{seq}-0'
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                result = self.client.xread({key: last_id}, count=100, block=BLOCK_MS)
+            except redis.RedisError as e:
+                self._count_failure()
+                raise ResumeError(f'读取续传缓冲失败: {str(e)}')
+            if not result:
+                if time.monotonic() >= deadline:
+                    self._count_failure()
+                    raise ResumeError('等待上游输出超时')
+                continue
+            deadline = time.monotonic() + timeout
+            for entry_id, fields in result[0][1]:
+                last_id = entry_id
+                if b'd' in fields:
+                    seq = entry_id.split(b'-', 1)[0].decode()
+                    yield f'{gen_id}:{seq}', fields[b'd'].decode('utf-8')
+                elif b'error' in fields:
+                    self._count_failure()
+                    raise ResumeError(fields[b'error'].decode('utf-8'))
+                else:
+                    return
+
+    def _count_failure(self):
+        with self._lock:
+            self.failed += 1
+
+    def stats(self):
+        return {
+            'started': self.started,
+            'resumed': self.resumed,
+            'frames_replayed': self.frames_replayed,
+            'failed': self.failed,
+        }
@@ -0,0 +1,158 @@
+import logging
+import threading
+
+import redis
+from flask_session.redis import RedisSessionInterface
+
+logger = logging.getLogger('DeepSeekChat')
+
+
+class LazySessionInterface(RedisSessionInterface):
+    """按需写入的Redis session。
+
+    - 没有业务数据的session（只有_permanent标记）不落库也不发Cookie，爬虫和健康检查不再产生Redis键
+    - 没有修改的session不写回；剩余有效期低于refresh_threshold时只做一次EXPIRE续期（滑动过期）
+    - prefetch(pipe, sid)可以在读取session的同一次往返里顺带读取其他键，结果放在session.prefetched
+    - 配置了fallback（LocalFallback）时Redis出错不再返回500：读不到的session沿用cookie里的sid、
+      标记session.degraded，写不进的session暂存在本地，Redis恢复后的第一个请求把它们写回
+    - 配置了size_metric（metrics.Histogram）时记录读到的session序列化后（压缩后）的字节数
+    """
+
+    def __init__(self, app, client, refresh_threshold, prefetch=None, **kwargs):
+        # flask_session只接受redis.Redis实例；分片存储（sharding.ShardedRedis）在父类初始化之后换上
+        super().__init__(app, client if isinstance(client, redis.Redis) else client.primary, **kwargs)
+        self.client = client
+        self.refresh_threshold = refresh_threshold
+        self.prefetch = prefetch
+        self.fallback = None
+        self.size_metric = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.writes = 0
+        self.refreshes = 0
+        self.deletes = 0
+        self.skipped = 0
+
+    def _retrieve_session_data(self, store_id):
+        sid = store_id[len(self.key_prefix):]
+        if self.fallback is not None:
+            # 降级期间写在本地、还没写回Redis的session优先
+            data = self.fallback.get_session(sid)
+            if data is not None:
+                return data
+
+        # 数据、剩余有效期和预取的键一次取回
+        pipe = self.client.pipeline(transaction=False)
+        pipe.get(store_id)
+        pipe.ttl(store_id)
+        if self.prefetch is not None:
+            self.prefetch(pipe, sid)
+        try:
+            serialized_session_data, ttl, *prefetched = pipe.execute()
+        except redis.RedisError as e:
+            if self.fallback is None:
+                raise
+            logger.warning(f"读取session失败，进入降级模式: {str(e)}")
+            self._local.degraded = True
+            # 保留原来的sid，Redis恢复后还能接上原来的session
+            return {'_permanent': self.permanent}
+        self._local.ttl = ttl
+        self._local.prefetched = prefetched if self.prefetch is not None else None
+        if serialized_session_data:
+            if self.size_metric is not None:
+                self.size_metric.observe(len(serialized_session_data))
+            return self.serializer.decode(serialized_session_data)
+        return None
+
+    def open_session(self, app, request):
+        if self.fallback is not None:
+            self.fallback.maybe_reconcile()
+        self._local.ttl = None
+        self._local.prefetched = None
+        self._local.degraded = False
+        session = super().open_session(app, request)
+        # 新建的session没有剩余有效期，也没有预取结果
+        if self._local.ttl is not None and self._local.ttl >= 0:
+            session.remaining_ttl = self._local.ttl
+            session.prefetched = self._local.prefetched
+        else:
+            session.remaining_ttl = None
+            session.prefetched = None
+        session.refresh_only = False
+        session.degraded = self._local.degraded
+        return session
+
+    def _needs_refresh(self, session):
+        remaining = getattr(session, 'remaining_ttl', None)
+        return remaining is not None and remaining < self.refresh_threshold
+
+    def should_set_storage(self, app, session):
+        return session.modified or session.refresh_only
+
+    def should_set_cookie(self, app, session):
+        return session.modified or session.refresh_only
+
+    def save_session(self, app, session, response):
+        with self._lock:
+            self.requests += 1
+
+        if not any(key != '_permanent' for key in session):
+            if session.modified and session.remaining_ttl is not None:
+                # 业务数据被清空：交给父类删除存储和Cookie
+                session.clear()
+                super().save_session(app, session, response)
+                self._count('deletes')
+            else:
+                self._count('skipped')
+            return
+
+        if session.modified:
+            super().save_session(app, session, response)
+            self._count('writes')
+        elif self._needs_refresh(session):
+            session.refresh_only = True
+            super().save_session(app, session, response)
+            self._count('refreshes')
+        else:
+            self._count('skipped')
+
+    def _upsert_session(self, session_lifetime, session, store_id):
+        try:
+            if session.refresh_only:
+                self.client.expire(store_id, int(session_lifetime.total_seconds()))
+                return
+            super()._upsert_session(session_lifetime, session, store_id)
+        except redis.RedisError as e:
+            if self.fallback is None:
+                raise
+            if not session.refresh_only:
+                logger.warning(f"写入session失败，暂存在本地: {str(e)}")
+                self.fallback.save_session(session.sid, dict(session), int(session_lifetime.total_seconds()))
+            return
+        if self.fallback is not None:
+            self.fallback.forget_session(session.sid)
+
+    def _delete_session(self, store_id):
+        if self.fallback is not None:
+            self.fallback.forget_session(store_id[len(self.key_prefix):])
+        try:
+            super()._delete_session(store_id)
+        except redis.RedisError as e:
+            if self.fallback is None:
+                raise
+            logger.warning(f"删除session失败: {str(e)}")
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'writes': self.writes,
+            'refreshes': self.refreshes,
+            'deletes': self.deletes,
+            'skipped': self.skipped,
+            'write_ratio': round((self.writes + self.refreshes) / self.requests, 4) if self.requests else 0.0,
+        }
@@ -0,0 +1,197 @@
+import bisect
+import hashlib
+import logging
+
+logger = logging.getLogger('DeepSeekChat')
+
+# session和对话按id分布到多个Redis节点。键的格式是 "前缀:id[:后缀]"，按第二段（session id或对话id）
+# 路由，同一个id的session、消息列表、摘要和版本号总在同一个节点上：读取session时预取对话仍是一次往返，
+# 对话的MULTI写入和Lua脚本也不跨节点。节点名就是 "host:port"，所有进程算出的哈希环相同。
+
+
+def shard_key(key):
+    if isinstance(key, bytes):
+        key = key.decode('utf-8')
+    parts = key.split(':', 2)
+    return parts[1] if len(parts) > 1 else key
+
+
+def _hash(data):
+    return int.from_bytes(hashlib.blake2b(data.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """一致性哈希环：每个节点在环上放vnodes个虚拟点，增加一个节点时只有约1/N的id换到新节点"""
+
+    def __init__(self, nodes=None, vnodes=160):
+        self.vnodes = vnodes
+        self.nodes = {}
+        self._points = []
+        self._owners = []
+        for name, value in (nodes or {}).items():
+            self.add(name, value)
+
+    def add(self, name, value):
+        self.nodes[name] = value
+        self._rebuild()
+
+    def remove(self, name):
+        del self.nodes[name]
+        self._rebuild()
+
+    def _rebuild(self):
+        ring = sorted((_hash(f'{name}#{i}'), name) for name in self.nodes for i in range(self.vnodes))
+        self._points = [point for point, _ in ring]
+        self._owners = [name for _, name in ring]
+
+    def name_for(self, shard_id):
+        index = bisect.bisect(self._points, _hash(shard_id)) % len(self._points)
+        return self._owners[index]
+
+    def get(self, shard_id):
+        return self.nodes[self.name_for(shard_id)]
+
+
+# 直接调用时按第一个参数（键）路由的命令；多键命令的所有键必须属于同一个id
+_KEY_COMMANDS = frozenset((
+    'get', 'set', 'delete', 'expire', 'ttl', 'type', 'lrange', 'ltrim', 'rpush', 'llen',
+    'hincrby', 'hgetall', 'dump', 'pttl', 'restore',
+))
+
+
+class ShardedRedis:
+    """多个Redis节点组成的session/对话存储，接口是这两个存储用到的redis.Redis子集。
+
+    pipeline()按节点拆成多个子pipeline，各执行一次后按原顺序拼回结果；同一个id的命令只需要一次往返。
+    """
+
+    def __init__(self, clients, vnodes=160):
+        self.ring = HashRing(clients, vnodes)
+
+    @property
+    def clients(self):
+        return list(self.ring.nodes.values())
+
+    @property
+    def primary(self):
+        return self.clients[0]
+
+    def node(self, key):
+        return self.ring.get(shard_key(key))
+
+    def add_node(self, name, client):
+        """加入新节点；之后用rebalance()把换了节点的键迁过去"""
+        self.ring.add(name, client)
+
+    def pipeline(self, transaction=True):
+        return ShardedPipeline(self, transaction)
+
+    def eval(self, script, numkeys, *keys_and_args):
+        return self.node(keys_and_args[0]).eval(script, numkeys, *keys_and_args)
+
+    def __getattr__(self, name):
+        if name not in _KEY_COMMANDS:
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            key = args[0] if args else kwargs['name']
+            return getattr(self.node(key), name)(*args, **kwargs)
+        return command
+
+
+class ShardedPipeline:
+
+    def __init__(self, sharded, transaction):
+        self._sharded = sharded
+        self._transaction = transaction
+        self._pipes = {}
+        # 每条命令所在的子pipeline和它在其中的序号
+        self._order = []
+
+    def __len__(self):
+        return len(self._order)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.reset()
+
+    def _pipe(self, key):
+        client = self._sharded.node(key)
+        pipe = self._pipes.get(id(client))
+        if pipe is None:
+            pipe = self._pipes[id(client)] = client.pipeline(transaction=self._transaction)
+        return pipe
+
+    def _queue(self, pipe, name, args, kwargs):
+        getattr(pipe, name)(*args, **kwargs)
+        self._order.append((pipe, len(pipe) - 1))
+        return self
+
+    def eval(self, script, numkeys, *keys_and_args):
+        return self._queue(self._pipe(keys_and_args[0]), 'eval', (script, numkeys) + keys_and_args, {})
+
+    def __getattr__(self, name):
+        if name not in _KEY_COMMANDS:
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            key = args[0] if args else kwargs['name']
+            return self._queue(self._pipe(key), name, args, kwargs)
+        return command
+
+    def execute(self, raise_on_error=True):
+        results = {id(pipe): pipe.execute(raise_on_error=raise_on_error) for pipe in self._pipes.values()}
+        ordered = [results[id(pipe)][index] for pipe, index in self._order]
+        self.reset()
+        return ordered
+
+    def reset(self):
+        for pipe in self._pipes.values():
+            pipe.reset()
+        self._pipes = {}
+        self._order = []
+
+
+def rebalance(sharded, patterns=('session:*', 'conv:*'), batch=500):
+    """把不属于所在节点的键迁到哈希环指定的节点（DUMP/RESTORE保留剩余有效期），返回迁移的键数。
+
+    加入节点后运行一次；迁移完成前，被换到新节点的id读不到原来的数据。
+    """
+    moved = 0
+    for client in sharded.clients:
+        for pattern in patterns:
+            keys = []
+            for key in client.scan_iter(match=pattern, count=batch):
+                if sharded.node(key) is not client:
+                    keys.append(key)
+                if len(keys) >= batch:
+                    moved += _move(sharded, client, keys)
+                    keys = []
+            if keys:
+                moved += _move(sharded, client, keys)
+    if moved:
+        logger.info(f"重新分片完成，迁移了{moved}个键")
+    return moved
+
+
+def _move(sharded, source, keys):
+    pipe = source.pipeline(transaction=False)
+    for key in keys:
+        pipe.dump(key)
+        pipe.pttl(key)
+    dumped = pipe.execute()
+
+    targets = sharded.pipeline(transaction=False)
+    moving = []
+    for key, payload, ttl in zip(keys, dumped[::2], dumped[1::2]):
+        if payload is None:
+            continue
+        targets.restore(key, max(ttl, 0), payload, replace=True)
+        moving.append(key)
+    if not moving:
+        return 0
+    targets.execute()
+    source.delete(*moving)
+    return len(moving)
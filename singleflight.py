@@ -0,0 +1,214 @@
+import logging
+import threading
+import time
+
+import redis
+
+from redis_access import BLOCK_MS
+
+logger = logging.getLogger('DeepSeekChat')
+
+# 相同请求合并：同一时刻完全相同的请求只让一个（leader）调用上游，其余的（follower）共享它的输出。
+# 同一worker内的follower直接读内存里的缓冲；其他worker通过Redis锁发现leader，
+# 再从leader写入的Redis Stream里从头读起，中途加入的follower也能拿到完整的delta序列。
+
+
+# 抢锁成功时顺带清掉上一轮同key留下的输出和follower计数，follower总是从头读；
+# 没抢到的是其他worker上的follower，计数让leader在浏览器断开时知道还有人在等
+_CLAIM_SCRIPT = """
+if redis.call('SET', KEYS[1], '1', 'NX', 'EX', ARGV[1]) then
+    redis.call('DEL', KEYS[2], KEYS[3])
+    return 1
+end
+redis.call('INCR', KEYS[3])
+redis.call('EXPIRE', KEYS[3], ARGV[1])
+return 0
+"""
+
+
+class FlightError(Exception):
+    """leader失败或长时间没有新输出时，follower收到的异常"""
+
+
+class Flight:
+    """一次进行中的上游调用：追加写的delta缓冲，可以被任意多个follower从头读取"""
+
+    def __init__(self, key, stream_key=None, client=None, result_ttl=30):
+        self.key = key
+        self._stream_key = stream_key
+        self._client = client
+        self._result_ttl = result_ttl
+        self._cond = threading.Condition()
+        self._deltas = []
+        self.followers = 0
+        self.done = False
+        self.error = None
+
+    def publish(self, delta):
+        with self._cond:
+            self._deltas.append(delta)
+            self._cond.notify_all()
+        self._xadd({'d': delta})
+
+    def finish(self, pipe, error=None):
+        """通知本worker的follower，并把结束标记排进pipeline（和释放锁一起发出）"""
+        with self._cond:
+            self.done = True
+            self.error = error
+            self._cond.notify_all()
+        if self._client is not None:
+            pipe.xadd(self._stream_key, {'error': error} if error else {'done': '1'})
+            pipe.expire(self._stream_key, self._result_ttl)
+
+    def _xadd(self, fields):
+        if self._client is None:
+            return
+        try:
+            self._client.xadd(self._stream_key, fields)
+        except redis.RedisError as e:
+            # Redis不可用时只影响其他worker的follower，本worker照常
+            logger.warning(f"singleflight发布失败: {str(e)}")
+            self._client = None
+
+    def follow(self, timeout=30):
+        """从头产出全部delta，直到leader结束；leader失败时抛出FlightError"""
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self._deltas) and not self.done:
+                    if not self._cond.wait(timeout):
+                        raise FlightError('等待上游输出超时')
+                batch = self._deltas[index:]
+                index = len(self._deltas)
+                finished = self.done
+                error = self.error
+            yield from batch
+            if finished:
+                if error:
+                    raise FlightError(error)
+                return
+
+
+class RemoteFlight:
+    """leader在其他worker上：从它的Redis Stream里读delta"""
+
+    def __init__(self, key, stream_key, client):
+        self.key = key
+        self._stream_key = stream_key
+        self._client = client
+
+    def follow(self, timeout=30):
+        last_id = '0-0'
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                result = self._client.xread({self._stream_key: last_id}, count=100, block=BLOCK_MS)
+            except redis.RedisError as e:
+                raise FlightError(f'读取共享输出失败: {str(e)}')
+            if not result:
+                if time.monotonic() >= deadline:
+                    raise FlightError('等待上游输出超时')
+                continue
+            deadline = time.monotonic() + timeout
+            for entry_id, fields in result[0][1]:
+                last_id = entry_id
+                if b'd' in fields:
+                    yield fields[b'd'].decode('utf-8')
+                elif b'error' in fields:
+                    raise FlightError(fields[b'error'].decode('utf-8'))
+                else:
+                    return
+
+
+class SingleFlight:
+
+    def __init__(self, client, lock_ttl=120, result_ttl=30, prefix='sf:'):
+        self.client = client
+        self.lock_ttl = lock_ttl
+        self.result_ttl = result_ttl
+        self.prefix = prefix
+
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.leaders = 0
+        self.local_followers = 0
+        self.remote_followers = 0
+
+    def queue_claim(self, pipe, key):
+        """把跨worker抢锁排进调用方的pipeline，结果交给join(key, claimed)"""
+        pipe.eval(_CLAIM_SCRIPT, 3, *self._keys(key), self.lock_ttl)
+
+    def _keys(self, key):
+        return self.prefix + 'lock:' + key, self.prefix + 'stream:' + key, self.prefix + 'followers:' + key
+
+    def release(self, key):
+        """抢到了锁但最终不需要调用上游（比如命中了缓存）"""
+        try:
+            self.client.delete(self.prefix + 'lock:' + key)
+        except redis.RedisError:
+            pass
+
+    def join(self, key, claimed=None):
+        """返回 (is_leader, flight)。leader负责调用上游并在结束时调用 done()。
+
+        claimed是queue_claim的结果；为None时在这里单独抢锁。
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.followers += 1
+                self.local_followers += 1
+                return False, flight
+
+            stream_key = self.prefix + 'stream:' + key
+            if claimed is None:
+                try:
+                    claimed = self.client.eval(_CLAIM_SCRIPT, 3, *self._keys(key), self.lock_ttl)
+                except redis.RedisError as e:
+                    claimed = e
+            client = self.client
+            if isinstance(claimed, Exception):
+                logger.warning(f"singleflight加锁失败，仅在本worker内合并: {str(claimed)}")
+                claimed, client = True, None
+
+            if not claimed:
+                self.remote_followers += 1
+                return False, RemoteFlight(key, stream_key, self.client)
+
+            flight = Flight(key, stream_key, client, self.result_ttl)
+            self._flights[key] = flight
+            self.leaders += 1
+            return True, flight
+
+    def done(self, flight, error=None):
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        pipe = self.client.pipeline(transaction=False)
+        flight.finish(pipe, error)
+        pipe.delete(self.prefix + 'lock:' + flight.key, self.prefix + 'followers:' + flight.key)
+        try:
+            pipe.execute()
+        except redis.RedisError:
+            pass
+
+    def followed(self, flight):
+        """leader的浏览器断开时判断是否还有follower在等它的输出：本worker的看内存计数，其他worker的查Redis"""
+        if flight.followers:
+            return True
+        if flight._client is None:
+            return False
+        try:
+            return int(self.client.get(self.prefix + 'followers:' + flight.key) or 0) > 0
+        except redis.RedisError:
+            return False
+
+    def stats(self):
+        followers = self.local_followers + self.remote_followers
+        return {
+            'leaders': self.leaders,
+            'local_followers': self.local_followers,
+            'remote_followers': self.remote_followers,
+            'upstream_calls_saved': followers,
+            'in_flight': len(self._flights),
+        }
@@ -0,0 +1,270 @@
+import threading
+import time
+from typing import List, Optional
+
+import msgspec
+
+# 上游SSE增量解析：直接在原始字节缓冲区上切帧，delta用带类型的Struct解码，
+# 不再逐行decode成str、也不再对每个token做完整的json.loads和多层dict查找。
+
+
+class Delta(msgspec.Struct):
+    content: Optional[str] = None
+
+
+class Choice(msgspec.Struct):
+    delta: Delta = msgspec.field(default_factory=Delta)
+    finish_reason: Optional[str] = None
+
+
+class Usage(msgspec.Struct):
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    prompt_cache_hit_tokens: int = 0
+    prompt_cache_miss_tokens: int = 0
+
+
+class Chunk(msgspec.Struct):
+    choices: List[Choice] = []
+    usage: Optional[Usage] = None
+
+
+_chunk_decoder = msgspec.json.Decoder(Chunk)
+
+DONE = b'[DONE]'
+
+
+class SSEParser:
+    """增量SSE帧解析器，可处理跨多次read被拆开的帧"""
+
+    def __init__(self):
+        self._tail = b''
+        self.done = False
+        self.usage = None
+        self.finish_reason = None
+        self.frames = 0
+        self.errors = 0
+
+    def feed(self, data):
+        """喂入一段原始字节，返回其中完整帧的data负载（指向原缓冲区的memoryview，不复制）"""
+        if self._tail:
+            # 只有帧被拆开时才拼接（复制残留的半帧和这次的数据）
+            data = self._tail + data
+        if b'\r' in data:
+            # 拼接之后再换：\r\n被拆在两次read之间时，\r留在上次的残留里
+            data = data.replace(b'\r\n', b'\n')
+
+        payloads = []
+        view = memoryview(data)
+        start = 0
+        while True:
+            end = data.find(b'\n\n', start)
+            if end < 0:
+                break
+            payload = self._frame_payload(data, view, start, end)
+            if payload is not None:
+                payloads.append(payload)
+            start = end + 2
+
+        self._tail = data[start:] if start < len(data) else b''
+        return payloads
+
+    def _frame_payload(self, data, view, start, end):
+        # 常见情况：单行 "data: {...}"
+        if data.startswith(b'data:', start) and data.find(b'\n', start, end) < 0:
+            offset = start + 5
+            if offset < end and data[offset] == 0x20:
+                offset += 1
+            return view[offset:end]
+
+        # 一般情况：多行data字段按规范用换行拼接，注释行（":"开头）和其他字段忽略
+        parts = []
+        for line in data[start:end].split(b'\n'):
+            if line.startswith(b'data:'):
+                value = line[5:]
+                parts.append(value[1:] if value.startswith(b' ') else value)
+        if not parts:
+            return None
+        return b'\n'.join(parts)
+
+    def decode(self, payload):
+        """解码一帧负载，返回delta文本；[DONE]、无内容帧或坏帧返回None"""
+        self.frames += 1
+        if payload == DONE:
+            self.done = True
+            return None
+        try:
+            chunk = _chunk_decoder.decode(payload)
+        except msgspec.DecodeError:
+            self.errors += 1
+            return None
+        if chunk.usage is not None:
+            self.usage = chunk.usage
+        if chunk.choices:
+            choice = chunk.choices[0]
+            if choice.finish_reason is not None:
+                self.finish_reason = choice.finish_reason
+            return choice.delta.content
+        return None
+
+    def text(self, data):
+        """解析一段原始字节，返回其中所有delta拼接的文本（透传模式下旁路记录历史用）"""
+        parts = []
+        for payload in self.feed(data):
+            content = self.decode(payload)
+            if content:
+                parts.append(content)
+        return ''.join(parts)
+
+    def deltas(self, chunks):
+        """从原始字节块的迭代器中逐个产出非空delta文本"""
+        for data in chunks:
+            for payload in self.feed(data):
+                content = self.decode(payload)
+                if content:
+                    yield content
+            if self.done:
+                return
+
+
+class CoalesceStats:
+    """各条流合并前后帧数的累计，每条流结束时汇总一次，不在逐token路径上加锁"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.streams = 0
+        self.frames_in = 0
+        self.frames_out = 0
+
+    def record(self, frames_in, frames_out):
+        with self._lock:
+            self.streams += 1
+            self.frames_in += frames_in
+            self.frames_out += frames_out
+
+    def stats(self):
+        return {
+            'streams': self.streams,
+            'frames_in': self.frames_in,
+            'frames_out': self.frames_out,
+            'coalesce_ratio': round(self.frames_in / self.frames_out, 2) if self.frames_out else 0.0,
+        }
+
+
+class DeltaCoalescer:
+    """把零碎的delta攒成较大的帧：缓冲达到max_bytes或距上次发送超过window秒就输出。
+
+    第一块内容总是立即输出，首token延迟不受影响。max_bytes为0时不合并。
+    add()只在新delta到达时检查窗口。线程版的转发（app.py、worker.py）每读到一个上游数据块
+    （包括keep-alive注释、usage等不含内容的块）调用一次poll()，缓冲的内容最多停留
+    "窗口或到下一个上游数据块，以较晚者为准"；上游一个字节都不发时只能等到下一块。
+    能按超时等待的一方（async_app）用remaining()作为读下一块的超时，到时调用expire()，
+    延迟上界就是窗口本身。
+    """
+
+    def __init__(self, max_bytes=256, window=0.02, stats=None):
+        self.max_bytes = max_bytes
+        self.window = window
+        self._stats = stats
+        self._parts = []
+        self._size = 0
+        self._last_flush = None
+        self._closed = False
+        self.frames_in = 0
+        self.frames_out = 0
+
+    def add(self, part, frames=1):
+        """加入一块内容（str或bytes），需要发送时返回合并后的内容，否则返回None"""
+        self.frames_in += frames
+        self._parts.append(part)
+        self._size += len(part)
+
+        now = time.monotonic()
+        if (self._last_flush is None or not self.max_bytes or
+                self._size >= self.max_bytes or now - self._last_flush >= self.window):
+            self._last_flush = now
+            return self._take()
+        return None
+
+    def remaining(self):
+        """缓冲里的内容还能再等多少秒；没有缓冲内容时返回None"""
+        if not self._parts or self._last_flush is None:
+            return None
+        return max(self._last_flush + self.window - time.monotonic(), 0.0)
+
+    def expire(self):
+        """窗口到期、上游还没有新数据：取出缓冲的内容（没有时返回None）"""
+        if not self._parts:
+            return None
+        self._last_flush = time.monotonic()
+        return self._take()
+
+    def poll(self):
+        """窗口已经到期时取出缓冲的内容，否则返回None"""
+        if self.remaining() == 0:
+            return self.expire()
+        return None
+
+    def flush(self):
+        """流结束时取出剩余内容，并把本条流的帧数计入统计（重复调用只统计一次）"""
+        pending = self._take() if self._parts else None
+        if not self._closed:
+            self._closed = True
+            if self._stats is not None:
+                self._stats.record(self.frames_in, self.frames_out)
+        return pending
+
+    def _take(self):
+        parts = self._parts
+        joined = parts[0] if len(parts) == 1 else parts[0][:0].join(parts)
+        self._parts = []
+        self._size = 0
+        self.frames_out += 1
+        return joined
+
+
+class DisconnectStats:
+    """浏览器中途断开的流：关闭的上游调用、断开前已生成的token和估算省下的token。
+
+    省下的token按已完成回答的平均completion_tokens减去断开前已生成的部分估算。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.completion_tokens = 0
+        self.disconnects = 0
+        self.aborted = 0
+        self.drained = 0
+        self.partial_tokens = 0
+        self.tokens_saved = 0
+
+    def record_completion(self, completion_tokens):
+        with self._lock:
+            self.completed += 1
+            self.completion_tokens += completion_tokens
+
+    def record_disconnect(self, aborted=False, partial_tokens=0):
+        """aborted为True表示因此关闭了上游连接（命中缓存或作为follower时没有上游可关）"""
+        with self._lock:
+            self.disconnects += 1
+            if not aborted:
+                return
+            self.aborted += 1
+            self.partial_tokens += partial_tokens
+            if self.completed:
+                self.tokens_saved += max(self.completion_tokens // self.completed - partial_tokens, 0)
+
+    def record_drained(self):
+        """leader断开时还有follower在等，上游照常读完"""
+        with self._lock:
+            self.drained += 1
+
+    def stats(self):
+        return {
+            'disconnects': self.disconnects,
+            'upstream_aborted': self.aborted,
+            'drained_for_followers': self.drained,
+            'partial_tokens': self.partial_tokens,
+            'tokens_saved_estimate': self.tokens_saved,
+        }
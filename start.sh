@@ -8,5 +8,12 @@ cd /Users/Lampard/Desktop/minidoubao
 # 激活虚拟环境
 source venv/bin/activate
 
-# 启动应用
-python app.py
+# 启动应用：默认用gunicorn（配置见gunicorn.conf.py），./start.sh dev 启动开发服务器，
+# ./start.sh worker 启动generation worker（web需设置GENERATION_WORKERS=1）
+if [ "$1" = "dev" ]; then
+    python app.py
+elif [ "$1" = "worker" ]; then
+    exec python worker.py
+else
+    exec gunicorn -c gunicorn.conf.py 'app:create_app()'
+fi
@@ -1,4 +1,7 @@
 
+// 流式响应中断后最多续传的次数（间隔1秒、2秒、3秒）
+const MAX_RESUME_ATTEMPTS = 3;
+
 document.addEventListener('DOMContentLoaded', function() {
     initializeChat();
     setupEventListeners();
@@ -57,51 +60,39 @@ async function sendMessage() {
     // 滚动到底部
     scrollToBottom();
 
-    try {
-        const response = await fetch('/api/stream-chat', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify({ message: message })
-        });
-
-        if (!response.ok) {
-            throw new Error('网络响应不正常');
-        }
-
-        const reader = response.body.getReader();
-        const decoder = new TextDecoder();
-        let fullContent = '';
+    // 连接中断时带着最后收到的帧id重连，服务端从缓冲里补发，不会重新生成
+    let lastEventId = null;
+    let fullContent = '';
+    let resumeAttempts = 0;
 
+    try {
         while (true) {
-            const { done, value } = await reader.read();
-            if (done) break;
-
-            const chunk = decoder.decode(value);
-            const lines = chunk.split('\n\n');
-
-            for (const line of lines) {
-                if (line.startsWith('data: ')) {
-                    try {
-                        const data = JSON.parse(line.substring(6));
-                        if (data.content) {
-                            fullContent += data.content;
-                            renderMarkdown(aiMessageElement, fullContent);
-                        } else if (data.error) {
-                            throw new Error(data.error);
-                        }
-                    } catch (e) {
-                        console.error('解析错误:', e);
-                    }
-                }
+            let finished = false;
+            try {
+                finished = await readStream(message, lastEventId, aiMessageElement, (content, id) => {
+                    if (content) fullContent += content;
+                    if (id) lastEventId = id;
+                    return fullContent;
+                });
+            } catch (error) {
+                if (error.rateLimited || !lastEventId || resumeAttempts >= MAX_RESUME_ATTEMPTS) throw error;
             }
+            // 没收到[DONE]就断了：还有可续传的帧id时重试
+            if (finished || !lastEventId || resumeAttempts >= MAX_RESUME_ATTEMPTS) break;
+            resumeAttempts++;
+            console.warn(`连接中断，第${resumeAttempts}次续传: ${lastEventId}`);
+            await new Promise(resolve => setTimeout(resolve, 1000 * resumeAttempts));
         }
 
         aiMessageElement.classList.remove('streaming');
 
     } catch (error) {
         console.error('Error:', error);
+        if (error.rateLimited) {
+            aiMessageElement.textContent = error.message;
+            aiMessageElement.classList.remove('streaming');
+            return;
+        }
         aiMessageElement.textContent = '网络好像出问题了...';
         aiMessageElement.classList.remove('streaming');
     } finally {
@@ -112,6 +103,91 @@ async function sendMessage() {
     }
 }
 
+// 发起（或续传）一次流式请求并逐帧回调onFrame(content, id)，收到[DONE]时返回true
+async function readStream(message, lastEventId, aiMessageElement, onFrame) {
+    const headers = { 'Content-Type': 'application/json' };
+    if (lastEventId) headers['Last-Event-ID'] = lastEventId;
+    const response = await fetch('/api/stream-chat', {
+        method: 'POST',
+        headers: headers,
+        body: JSON.stringify({ message: message })
+    });
+
+    if (!response.ok) {
+        // 服务端限流时直接提示，不当作网络错误
+        const data = await response.json().catch(() => ({}));
+        if (response.status === 429 && data.error) {
+            const error = new Error(data.error);
+            error.rateLimited = true;
+            throw error;
+        }
+        throw new Error('网络响应不正常');
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) return false;
+
+        // 帧可能被拆在两次read之间，不完整的部分留到下次
+        buffer += decoder.decode(value, { stream: true }).replace(/\r\n/g, '\n');
+        const frames = buffer.split('\n\n');
+        buffer = frames.pop();
+
+        let fullContent = null;
+        for (const frame of frames) {
+            try {
+                const data = parseSSEFrame(frame);
+                if (!data) continue;
+                if (data.done) {
+                    if (fullContent !== null) renderMarkdown(aiMessageElement, fullContent);
+                    return true;
+                }
+                if (data.content) {
+                    fullContent = onFrame(data.content, data.id);
+                } else if (data.error) {
+                    throw new Error(data.error);
+                }
+            } catch (e) {
+                console.error('解析错误:', e);
+            }
+        }
+
+        // 一次read只渲染一次
+        if (fullContent !== null) {
+            renderMarkdown(aiMessageElement, fullContent);
+        }
+    }
+}
+
+// 解析一帧SSE：兼容本服务的 {content} 格式和透传模式下DeepSeek原始的 {choices:[{delta}]} 格式
+function parseSSEFrame(frame) {
+    const dataLines = [];
+    let id = null;
+    for (const line of frame.split('\n')) {
+        if (line.startsWith('data:')) {
+            dataLines.push(line.substring(line.startsWith('data: ') ? 6 : 5));
+        } else if (line.startsWith('id:')) {
+            id = line.substring(line.startsWith('id: ') ? 4 : 3);
+        }
+    }
+    if (dataLines.length === 0) return null;
+
+    const payload = dataLines.join('\n');
+    if (payload === '[DONE]') return { done: true };
+
+    const data = JSON.parse(payload);
+    if (data.choices) {
+        const delta = data.choices.length > 0 ? data.choices[0].delta : null;
+        return { content: delta && delta.content ? delta.content : '' };
+    }
+    if (id) data.id = id;
+    return data;
+}
+
 function appendMessage(role, content) {
     const chatBox = document.getElementById('chat-box');
     const messageDiv = document.createElement('div');
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# worker.py从app导入组件：app在导入时检查API密钥，各组件的Redis连接在用到时才建立
+os.environ.setdefault("DEEPSEEK_API_KEY", "test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
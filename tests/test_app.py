@@ -0,0 +1,35 @@
+import json
+import time
+
+import app
+from sse import DeltaCoalescer, SSEParser
+
+
+def frame(content):
+    return f"data: {json.dumps({'choices': [{'delta': {'content': content}}]})}\n\n".encode()
+
+
+class StalledResponse:
+    """先发两个delta，停顿期间只有keep-alive注释，最后才结束"""
+
+    def iter_chunks(self):
+        yield frame('A')
+        yield frame('B')
+        time.sleep(0.05)
+        yield b': keep-alive\n\n'
+        time.sleep(0.3)
+        yield b'data: [DONE]\n\n'
+
+
+def test_keep_alive_flushes_coalesced_content(monkeypatch):
+    monkeypatch.setattr(app, 'stream_passthrough', False)
+    timings = app.stream_timings()
+    start = time.monotonic()
+    arrivals = []
+    frames = app.upstream_frames(StalledResponse(), SSEParser(), DeltaCoalescer(256, 0.02), [], timings)
+    for data in frames:
+        arrivals.append((json.loads(data.split('data: ', 1)[1])['content'], time.monotonic() - start))
+
+    assert [content for content, _ in arrivals] == ['A', 'B']
+    # B在keep-alive到达时发出，不等到上游停顿结束
+    assert arrivals[1][1] < 0.3
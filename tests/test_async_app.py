@@ -0,0 +1,174 @@
+import asyncio
+import json
+
+import aiohttp
+import fakeredis
+import pytest
+from aiohttp import web
+
+import async_app
+from admission import AsyncAdmissionController
+from sharding import HashRing
+
+
+def upstream_app(deltas, delay):
+    """模拟DeepSeek的流式接口：每隔delay秒发一个delta"""
+
+    async def chat(request):
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        try:
+            for content in deltas:
+                frame = {'choices': [{'delta': {'content': content}}]}
+                await response.write(f"data: {json.dumps(frame)}\n\n".encode('utf-8'))
+                await asyncio.sleep(delay)
+            await response.write(b'data: [DONE]\n\n')
+        except ConnectionResetError:
+            # 应用在浏览器断开后关闭了上游连接
+            pass
+        return response
+
+    app = web.Application()
+    app.router.add_post('/v1/chat/completions', chat)
+    return app
+
+
+async def start(app):
+    """启动应用，返回 (runner, 根地址)；与gunicorn的aiohttp worker一样，浏览器断开时不取消处理函数
+    （aiohttp.test_utils.TestServer会打开handler_cancellation）"""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f'http://{host}:{port}'
+
+
+async def serve(deltas, delay=0.0, admission=None):
+    """启动模拟上游和异步应用，返回 (应用的地址, redis, 要关闭的runner)"""
+    upstream, upstream_url = await start(upstream_app(deltas, delay))
+    async_app.api_url = upstream_url + '/v1/chat/completions'
+
+    redis = fakeredis.FakeAsyncRedis()
+    app = async_app.create_app()
+    app['redis'] = HashRing({'fake:6379': redis})
+    app['admission'] = admission
+    runner, url = await start(app)
+    return url + '/api/stream-chat', redis, (runner, upstream)
+
+
+async def close(runners):
+    for runner in runners:
+        await runner.cleanup()
+
+
+async def saved_messages(redis, sid):
+    shards = HashRing({'fake:6379': redis})
+    _, session_data, _ = await async_app.load_session(shards, sid)
+    _, window, _ = await async_app.load_conversation(shards, sid, session_data)
+    return [(msg['role'], msg['content']) for msg in window.messages()]
+
+
+@pytest.fixture(autouse=True)
+def environment(monkeypatch):
+    monkeypatch.setattr(async_app, 'api_url', async_app.api_url)
+    monkeypatch.setattr(async_app, 'coalesce_bytes', 0)
+
+
+def test_stream_saves_reply():
+    async def run():
+        url, redis, runners = await serve(['你好', '，世界'])
+        try:
+            async with aiohttp.ClientSession() as http:
+                async with http.post(url, json={'message': '问'}) as response:
+                    body = await response.text()
+                    sid = response.cookies['session'].value
+            assert body.endswith('data: [DONE]\n\n')
+            assert await saved_messages(redis, sid) == [('user', '问'), ('assistant', '你好，世界')]
+        finally:
+            await close(runners)
+
+    asyncio.run(run())
+
+
+def test_client_disconnect_saves_partial_reply(caplog):
+    async def run():
+        url, redis, runners = await serve(['字'] * 50, delay=0.02)
+        try:
+            async with aiohttp.ClientSession() as http:
+                response = await http.post(url, json={'message': '问'})
+                sid = response.cookies['session'].value
+                await response.content.readany()
+                # 读到第一帧后断开
+                response.close()
+
+            for _ in range(100):
+                messages = await saved_messages(redis, sid)
+                if len(messages) == 2:
+                    break
+                await asyncio.sleep(0.02)
+            assert messages[0] == ('user', '问')
+            assert messages[1][0] == 'assistant'
+            assert 0 < len(messages[1][1]) < 50
+        finally:
+            await close(runners)
+
+    asyncio.run(run())
+    assert '网络连接失败' not in caplog.text
+    assert 'Error handling request' not in caplog.text
+
+
+def test_admission_lease_released_when_session_store_fails():
+    async def run():
+        url, _, runners = await serve(['你好'])
+        app = runners[0].app
+        admission_redis = fakeredis.FakeAsyncRedis()
+        app['admission'] = AsyncAdmissionController(admission_redis, max_concurrency=1)
+        server = fakeredis.FakeServer()
+        server.connected = False
+        app['redis'] = HashRing({'fake:6379': fakeredis.FakeAsyncRedis(server=server)})
+        try:
+            async with aiohttp.ClientSession() as http:
+                async with http.post(url, json={'message': '问'}) as response:
+                    assert response.status == 500
+            # 名额没有泄漏：下一个请求还能拿到
+            assert await admission_redis.zcard('admission:leases') == 0
+        finally:
+            await close(runners)
+
+    asyncio.run(run())
+
+
+def test_admission_lease_released_after_upstream_error():
+    async def run():
+        admission_redis = fakeredis.FakeAsyncRedis()
+        url, _, runners = await serve(['你好'], admission=AsyncAdmissionController(admission_redis))
+        async_app.api_url += '/missing'
+        try:
+            async with aiohttp.ClientSession() as http:
+                async with http.post(url, json={'message': '问'}) as response:
+                    body = await response.text()
+            assert 'error' in body and body.endswith('data: [DONE]\n\n')
+            assert await admission_redis.zcard('admission:leases') == 0
+        finally:
+            await close(runners)
+
+    asyncio.run(run())
+
+
+def test_new_conversation_matches_flask_session():
+    async def run():
+        url, redis, runners = await serve(['你好'])
+        try:
+            async with aiohttp.ClientSession() as http:
+                async with http.post(url, json={'message': '问'}) as response:
+                    await response.text()
+                    sid = response.cookies['session'].value
+            _, session_data, remaining = await async_app.load_session(HashRing({'fake:6379': redis}), sid)
+            # 与app.open_conversation相同：对话id就是sid，session带_permanent标记
+            assert session_data == {'_permanent': True, 'conv_id': sid}
+            assert remaining > 0
+        finally:
+            await close(runners)
+
+    asyncio.run(run())
@@ -0,0 +1,38 @@
+import threading
+
+from codec import FORMAT_VERSION, PayloadCodec
+
+
+def test_round_trip_and_threshold():
+    codec = PayloadCodec('zlib', threshold=64)
+    small = b'x' * 10
+    large = b'{"content": "' + b'code block ' * 100 + b'"}'
+    assert codec.encode(small) == small
+    encoded = codec.encode(large)
+    assert encoded[0] == FORMAT_VERSION and len(encoded) < len(large)
+    assert codec.decode(encoded) == large
+    # 没有版本字节的旧值原样读取
+    assert codec.decode(large) == large
+
+
+def test_request_time_covers_encode_and_decode():
+    codec = PayloadCodec('zlib', threshold=0)
+    codec.decode(codec.encode(b'abc' * 1000))
+    seconds = codec.end_request()
+    assert seconds > 0
+    assert codec.end_request() == 0.0
+    stats = codec.stats()
+    assert stats['requests'] == 2
+    assert stats['request_us_max'] == round(seconds * 1e6, 1)
+
+
+def test_request_time_is_per_thread():
+    codec = PayloadCodec('zlib', threshold=0)
+    codec.encode(b'abc' * 1000)
+    other = []
+    thread = threading.Thread(target=lambda: other.append(codec.end_request(record=False)))
+    thread.start()
+    thread.join()
+    assert other == [0.0]
+    assert codec.end_request(record=False) > 0
+    assert codec.stats()['requests'] == 0
@@ -0,0 +1,268 @@
+import json
+import threading
+
+import fakeredis
+import pytest
+import redis
+import requests
+
+import app
+import worker
+from generation import GenerationQueue
+from resumable import ResumableStreams
+
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis()
+
+
+@pytest.fixture
+def queue(client):
+    queue = GenerationQueue(client, claim_idle=300)
+    queue.ensure_group()
+    return queue
+
+
+def submit(queue, job_id='job1', conversation_id='conv1'):
+    pipe = queue.client.pipeline(transaction=True)
+    queue.queue_submit(pipe, job_id, conversation_id, {'messages': [{'role': 'user', 'content': '你好'}]})
+    pipe.execute()
+
+
+def test_read_and_ack(queue):
+    submit(queue)
+    entry_id, job = queue.read('w1')
+    assert job['id'] == 'job1'
+    assert job['conversation_id'] == 'conv1'
+    assert job['payload'] == {'messages': [{'role': 'user', 'content': '你好'}]}
+    assert queue.stats()['in_progress'] == 1
+
+    queue.ack(entry_id)
+    stats = queue.stats()
+    assert (stats['queued'], stats['in_progress'], stats['processed']) == (0, 0, 1)
+    # 确认后条目被删除，不会被再次领取或接手
+    assert queue.client.xlen(queue.stream) == 0
+    assert queue.reclaim('w2') == []
+
+
+def test_ensure_group_is_idempotent(queue):
+    queue.ensure_group()
+    submit(queue)
+    assert queue.read('w1') is not None
+
+
+def test_reclaim_waits_for_claim_idle(queue):
+    submit(queue)
+    queue.read('w1')
+    assert queue.reclaim('w2') == []
+    assert queue.reclaimed == 0
+
+
+def test_reclaim_takes_over_pending_job(client, queue):
+    submit(queue)
+    entry_id, _ = queue.read('w1')
+
+    queue.claim_idle = 0
+    jobs = queue.reclaim('w2')
+    assert [(e, job['id']) for e, job in jobs] == [(entry_id, 'job1')]
+    assert queue.reclaimed == 1
+    pending = client.xpending_range(queue.stream, queue.group, '-', '+', 10)
+    assert [p['consumer'] for p in pending] == [b'w2']
+
+    queue.ack(entry_id, failed=True)
+    assert queue.stats()['in_progress'] == 0
+    assert queue.failed == 1
+
+
+class FakeStream:
+
+    def __init__(self, chunks, error=None):
+        self.chunks = chunks
+        self.error = error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def iter_chunks(self):
+        yield from self.chunks
+        if self.error is not None:
+            raise self.error
+
+
+class FakeUpstream:
+
+    def __init__(self, stream=None, error=None):
+        self._stream = stream
+        self._error = error
+
+    def stream(self, payload):
+        if self._error is not None:
+            raise self._error
+        return self._stream
+
+
+def sse(*deltas):
+    frames = [f"data: {json.dumps({'choices': [{'delta': {'content': d}}]})}\n\n" for d in deltas]
+    return [frame.encode() for frame in frames] + [b'data: [DONE]\n\n']
+
+
+@pytest.fixture
+def job(client, queue, monkeypatch):
+    """领到的任务；worker的续传缓冲写到fakeredis，save_reply记下保存时缓冲里是否已经有结束标记"""
+    streams = ResumableStreams(client)
+    monkeypatch.setattr(worker, 'resumable', streams)
+    saved = []
+
+    def save_reply(job, reply, usage, cache=False):
+        saved.append((reply, cache, end_marker(client, streams, job['id'])))
+
+    monkeypatch.setattr(worker, 'save_reply', save_reply)
+    submit(queue)
+    entry_id, job = queue.read('w1')
+    return entry_id, job, streams, saved
+
+
+def end_marker(client, streams, job_id):
+    for _, fields in client.xrange(streams.prefix + job_id):
+        if b'done' in fields or b'error' in fields:
+            return {k.decode(): v.decode() for k, v in fields.items()}
+    return None
+
+
+def test_run_job_saves_reply_before_end_marker(client, queue, job, monkeypatch):
+    entry_id, job, streams, saved = job
+    monkeypatch.setattr(worker, 'upstream', FakeUpstream(FakeStream(sse('你好', '，世界'))))
+
+    worker.run_job(queue, entry_id, job)
+
+    # 浏览器收到[DONE]后马上发下一条消息时，对话里必须已经有这条回答
+    assert saved == [('你好，世界', True, None)]
+    assert end_marker(client, streams, job['id']) == {'done': '1'}
+    assert queue.stats()['in_progress'] == 0
+    assert queue.processed == 1
+
+
+def test_run_job_saves_partial_reply_before_error_marker(client, queue, job, monkeypatch):
+    entry_id, job, streams, saved = job
+    error = requests.exceptions.ChunkedEncodingError('连接中断')
+    monkeypatch.setattr(worker, 'upstream', FakeUpstream(FakeStream(sse('你好')[:1], error)))
+
+    worker.run_job(queue, entry_id, job)
+
+    assert saved == [('你好', False, None)]
+    assert end_marker(client, streams, job['id']) == {'error': 'API请求失败'}
+    assert queue.failed == 1
+
+
+def test_run_job_writes_end_marker_when_save_fails(client, queue, job, monkeypatch):
+    entry_id, job, streams, _ = job
+    monkeypatch.setattr(worker, 'upstream', FakeUpstream(FakeStream(sse('你好'))))
+
+    def save_reply(job, reply, usage, cache=False):
+        raise redis.ConnectionError('Redis不可用')
+
+    monkeypatch.setattr(worker, 'save_reply', save_reply)
+
+    worker.run_job(queue, entry_id, job)
+
+    # 保存失败也要写结束标记，浏览器不会一直等到超时
+    assert end_marker(client, streams, job['id']) == {'done': '1'}
+    assert queue.stats()['in_progress'] == 0
+
+
+def test_run_job_without_reply_skips_save(client, queue, job, monkeypatch):
+    entry_id, job, streams, saved = job
+    monkeypatch.setattr(worker, 'upstream', FakeUpstream(error=requests.exceptions.ConnectionError('连不上')))
+
+    worker.run_job(queue, entry_id, job)
+
+    assert saved == []
+    assert end_marker(client, streams, job['id']) == {'error': 'API请求失败'}
+    assert queue.failed == 1
+
+
+def test_run_job_reclaimed_is_failed_without_calling_upstream(client, queue, job, monkeypatch):
+    entry_id, job, streams, saved = job
+    monkeypatch.setattr(worker, 'upstream', FakeUpstream(error=AssertionError('不应调用上游')))
+
+    worker.run_job(queue, entry_id, job, reclaimed=True)
+
+    assert saved == []
+    assert end_marker(client, streams, job['id']) == {'error': '生成已中断'}
+    assert queue.failed == 1
+
+
+def test_run_job_drops_job_older_than_wait_timeout(client, queue, job, monkeypatch):
+    entry_id, job, streams, saved = job
+    monkeypatch.setattr(worker, 'upstream', FakeUpstream(error=AssertionError('不应调用上游')))
+    job['created'] -= queue.wait_timeout + 1
+
+    worker.run_job(queue, entry_id, job)
+
+    # web已经返回了错误，用户可能又发了消息：不生成也不保存
+    assert saved == []
+    assert end_marker(client, streams, job['id']) == {'error': '生成已取消'}
+    assert queue.stats()['in_progress'] == 0
+    assert queue.failed == 1
+
+
+def test_run_job_drops_cancelled_job(client, queue, job, monkeypatch):
+    entry_id, job, streams, saved = job
+    monkeypatch.setattr(worker, 'upstream', FakeUpstream(error=AssertionError('不应调用上游')))
+    streams.grace = 0
+    streams.cancel(job['id'])
+
+    worker.run_job(queue, entry_id, job)
+
+    assert saved == []
+    assert end_marker(client, streams, job['id']) == {'error': '生成已取消'}
+    assert queue.failed == 1
+
+
+def test_relay_generation_cancels_job_on_timeout(client, monkeypatch):
+    streams = ResumableStreams(client)
+    monkeypatch.setattr(app, 'resumable', streams)
+    monkeypatch.setattr(app, 'generation_queue', GenerationQueue(client, wait_timeout=0))
+
+    with pytest.raises(app.ResumeError):
+        list(app.relay_generation('job1', []))
+
+    # 排队还没被领取的任务，worker领到时会跳过
+    assert client.exists(streams.prefix + 'job1:cancel')
+
+
+def test_consume_survives_unexpected_errors(client, queue, job, monkeypatch):
+    entry_id, job, streams, saved = job
+    monkeypatch.setattr(worker, 'upstream', FakeUpstream(FakeStream(sse('你好'))))
+
+    def save_reply(job, reply, usage, cache=False):
+        if job['id'] == 'job2':
+            raise ValueError('对话解码失败')
+        saved.append(job['id'])
+
+    monkeypatch.setattr(worker, 'save_reply', save_reply)
+    # fixture已经领走了第一个任务；consume依次领取job2（保存时出错）和job3，两个都确认后停止循环
+    submit(queue, job_id='job2')
+    submit(queue, job_id='job3')
+    stopping = threading.Event()
+    acks = []
+
+    def ack(entry_id, failed=False):
+        acks.append(failed)
+        GenerationQueue.ack(queue, entry_id, failed)
+        if len(acks) == 2:
+            stopping.set()
+
+    monkeypatch.setattr(queue, 'ack', ack)
+    thread = threading.Thread(target=worker.consume, args=(queue, 'w1', stopping))
+    thread.start()
+    thread.join(timeout=10)
+
+    assert not thread.is_alive()
+    assert acks == [True, False]
+    assert saved == ['job3']
+    assert end_marker(client, streams, 'job2') == {'done': '1'}
@@ -0,0 +1,34 @@
+import fakeredis
+
+from conversation import PromptCacheStats
+from sse import Usage
+
+
+def test_global_stats_shared_across_processes():
+    client = fakeredis.FakeRedis()
+    # 两个worker进程各自的实例，写同一个Redis
+    first, second = PromptCacheStats(client), PromptCacheStats(client)
+    first.record('conv1', Usage(prompt_cache_hit_tokens=30, prompt_cache_miss_tokens=10))
+    second.record('conv2', {'prompt_cache_hit_tokens': 10, 'prompt_cache_miss_tokens': 50})
+
+    expected = {'hit_tokens': 40, 'miss_tokens': 60, 'hit_ratio': 0.4}
+    assert first.stats() == expected
+    assert second.stats() == expected
+    assert first.conversation_stats('conv1') == {'hit_tokens': 30, 'miss_tokens': 10, 'hit_ratio': 0.75}
+
+
+def test_usage_without_cache_fields_is_ignored():
+    client = fakeredis.FakeRedis()
+    stats = PromptCacheStats(client)
+    stats.record('conv1', Usage(prompt_tokens=10))
+    stats.record('conv1', None)
+    assert stats.stats() == {'hit_tokens': 0, 'miss_tokens': 0, 'hit_ratio': 0.0}
+    assert client.keys() == []
+
+
+def test_falls_back_to_process_counts_without_redis():
+    server = fakeredis.FakeServer()
+    stats = PromptCacheStats(fakeredis.FakeRedis(server=server))
+    stats.record('conv1', Usage(prompt_cache_hit_tokens=1, prompt_cache_miss_tokens=3))
+    server.connected = False
+    assert stats.stats() == {'hit_tokens': 1, 'miss_tokens': 3, 'hit_ratio': 0.25}
@@ -0,0 +1,92 @@
+import json
+import time
+
+import pytest
+
+from sse import DeltaCoalescer, SSEParser
+
+
+def frame(content, newline='\n'):
+    data = json.dumps({'choices': [{'delta': {'content': content}}]})
+    return f'data: {data}{newline}{newline}'.encode()
+
+
+def parse(*reads):
+    parser = SSEParser()
+    deltas = [parser.decode(payload) for data in reads for payload in parser.feed(data)]
+    return [d for d in deltas if d], parser
+
+
+def test_single_read():
+    deltas, parser = parse(frame('A') + frame('B') + b'data: [DONE]\n\n')
+    assert deltas == ['A', 'B']
+    assert parser.done and parser.errors == 0
+
+
+def test_frame_split_across_reads():
+    data = frame('A') + frame('B')
+    for cut in range(1, len(data)):
+        deltas, parser = parse(data[:cut], data[cut:])
+        assert deltas == ['A', 'B'], cut
+        assert parser.errors == 0
+
+
+def test_byte_by_byte():
+    data = frame('你好') + frame('世界')
+    deltas, _ = parse(*(data[i:i + 1] for i in range(len(data))))
+    assert deltas == ['你好', '世界']
+
+
+def test_crlf():
+    deltas, parser = parse(frame('A', '\r\n') + frame('B', '\r\n'))
+    assert deltas == ['A', 'B']
+    assert parser.errors == 0
+
+
+@pytest.mark.parametrize('cut', range(1, 8))
+def test_crlf_split_across_reads(cut):
+    data = frame('A', '\r\n') + frame('B', '\r\n')
+    # 在第一帧结尾的\r\n\r\n附近的每个位置切开，包括\r和\n之间
+    split = len(frame('A', '\r\n')) - 4 + cut - 2
+    deltas, parser = parse(data[:split], data[split:])
+    assert deltas == ['A', 'B']
+    assert parser.errors == 0
+
+
+def test_multiline_data_and_comments():
+    data = b': keep-alive\n\nevent: message\ndata: {"choices": [{"delta":\ndata:  {"content": "A"}}]}\n\n'
+    deltas, parser = parse(data)
+    assert deltas == ['A']
+    assert parser.errors == 0
+
+
+def test_usage_and_finish_reason():
+    usage = {'prompt_tokens': 10, 'completion_tokens': 2}
+    data = json.dumps({'choices': [{'delta': {}, 'finish_reason': 'stop'}], 'usage': usage})
+    _, parser = parse(frame('A') + f'data: {data}\n\n'.encode())
+    assert parser.finish_reason == 'stop'
+    assert (parser.usage.prompt_tokens, parser.usage.completion_tokens) == (10, 2)
+
+
+def test_bad_frame_counted():
+    deltas, parser = parse(b'data: {oops\n\n' + frame('A'))
+    assert deltas == ['A']
+    assert parser.errors == 1
+
+
+def test_text_for_passthrough():
+    parser = SSEParser()
+    data = frame('A', '\r\n') + frame('B', '\r\n')
+    assert parser.text(data[:-3]) + parser.text(data[-3:]) == 'AB'
+
+
+
+def test_coalescer_poll_releases_content_after_window():
+    coalescer = DeltaCoalescer(256, 0.01)
+    # 第一块立即输出，之后的在窗口内攒着
+    assert coalescer.add('A') == 'A'
+    assert coalescer.add('B') is None
+    assert coalescer.poll() is None
+    time.sleep(0.02)
+    assert coalescer.poll() == 'B'
+    assert coalescer.poll() is None
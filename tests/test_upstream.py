@@ -0,0 +1,51 @@
+import threading
+import time
+
+import pytest
+from werkzeug.serving import make_server
+
+from upstream import PoolTimeout, UpstreamClient
+
+
+@pytest.fixture
+def slow_server():
+    """每个请求1秒后才返回"""
+
+    def app(environ, start_response):
+        time.sleep(1)
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [b'{}']
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/'
+    server.shutdown()
+
+
+def test_pool_wait_is_bounded(slow_server):
+    client = UpstreamClient(slow_server, 'key', pool_size=1, pool_timeout=0.2)
+    results = []
+
+    def call():
+        start = time.monotonic()
+        try:
+            client.post({})
+            results.append('ok')
+        except PoolTimeout:
+            results.append(('timeout', time.monotonic() - start))
+
+    threads = [threading.Thread(target=call) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)
+    for thread in threads:
+        thread.join()
+
+    # 第二个请求等不到连接，0.2秒后报错，而不是等第一个请求结束
+    assert results[0][0] == 'timeout' and results[0][1] < 0.8
+    assert results[1] == 'ok'
+    stats = client.stats()
+    assert stats['pool_timeouts'] == 1
+    # 本地容量问题不计入熔断，也不重试
+    assert stats['breaker']['consecutive_failures'] == 0
+    assert stats['retries'] == {}
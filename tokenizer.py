@@ -0,0 +1,141 @@
+import hashlib
+import logging
+import math
+import re
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger('DeepSeekChat')
+
+# 中日韩文字（含全角标点）按字计，其余字符按长度计
+_CJK = re.compile(r'[　-〿぀-ヿ㐀-䶿一-鿿가-힯豈-﫿＀-￯]')
+
+# DeepSeek文档给出的换算：1个中文字符约0.6 token，1个英文字符约0.3 token；实际比例靠上游usage校准
+CJK_TOKENS_PER_CHAR = 0.6
+OTHER_TOKENS_PER_CHAR = 0.3
+
+# 每条消息套上对话模板后额外占用的token数
+MESSAGE_OVERHEAD = 4
+
+
+class ApproxCounter:
+    """按文字种类分别估算的近似计数器，用上游返回的usage.prompt_tokens自校准"""
+
+    name = 'approx'
+
+    def __init__(self, min_scale=0.25, max_scale=4.0, smoothing=0.2):
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.smoothing = smoothing
+        self.scale = 1.0
+        self.calibrations = 0
+
+    def raw(self, content):
+        cjk = len(_CJK.findall(content))
+        return cjk * CJK_TOKENS_PER_CHAR + (len(content) - cjk) * OTHER_TOKENS_PER_CHAR
+
+    def apply(self, raw):
+        return math.ceil(raw * self.scale)
+
+    def calibrate(self, raw, actual):
+        # 指数平滑，单次偏差大的请求（比如长代码块）不会让比例剧烈跳动
+        ratio = min(max(actual / raw, self.min_scale), self.max_scale)
+        self.scale += self.smoothing * (ratio - self.scale)
+        self.calibrations += 1
+
+
+class BPECounter:
+    """用本地词表文件（HuggingFace tokenizer.json）做精确计数（tokenizers在requirements.txt里）。
+
+    词表用DeepSeek官方HuggingFace仓库（如deepseek-ai/DeepSeek-V3）里的tokenizer.json，
+    下载后把TOKENIZER_PATH指向它；没有配置时用ApproxCounter。
+    """
+
+    name = 'bpe'
+
+    def __init__(self, path):
+        from tokenizers import Tokenizer
+        self._tokenizer = Tokenizer.from_file(path)
+        self.scale = 1.0
+        self.calibrations = 0
+
+    def raw(self, content):
+        return len(self._tokenizer.encode(content, add_special_tokens=False).ids)
+
+    def apply(self, raw):
+        return raw
+
+    def calibrate(self, raw, actual):
+        pass
+
+
+class TokenCounter:
+    """统一的token计数入口：按内容哈希缓存未校准的计数，每条消息只分词一次"""
+
+    def __init__(self, backend, cache_size=10000):
+        self.backend = backend
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def count(self, content):
+        # 缓存的是校准前的值，校准比例变化后不需要清缓存
+        return self.backend.apply(self._raw(content))
+
+    def _raw(self, content):
+        if not content:
+            return 0
+        key = hashlib.blake2b(content.encode('utf-8'), digest_size=16).digest()
+        with self._lock:
+            raw = self._cache.get(key)
+            if raw is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+        if raw is None:
+            raw = self.backend.raw(content)
+            with self._lock:
+                self.misses += 1
+                self._cache[key] = raw
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return raw
+
+    def calibrate(self, contents, prompt_tokens):
+        """用上游实际的prompt_tokens校正估算；contents是本次发出的全部消息内容。
+
+        按校准前的原始计数比较（都在缓存里，不会重新分词），持久化的旧计数不影响校准结果。
+        """
+        if not prompt_tokens:
+            return
+        raw = sum(self._raw(content) for content in contents)
+        actual = prompt_tokens - MESSAGE_OVERHEAD * len(contents)
+        if raw <= 0 or actual <= 0:
+            return
+        with self._lock:
+            self.backend.calibrate(raw, actual)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': self.backend.name,
+            'scale': round(self.backend.scale, 4),
+            'calibrations': self.backend.calibrations,
+            'cache_entries': len(self._cache),
+            'cache_hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+def load_counter(vocab_path=None, cache_size=10000):
+    """配置了词表文件且装了tokenizers时用BPE精确计数，否则退回近似计数"""
+    backend = None
+    if vocab_path:
+        try:
+            backend = BPECounter(vocab_path)
+            logger.info(f"已加载BPE词表: {vocab_path}")
+        except ImportError:
+            logger.warning("未安装tokenizers，使用近似token计数")
+        except Exception as e:
+            logger.warning(f"BPE词表加载失败，使用近似token计数: {str(e)}")
+    return TokenCounter(backend or ApproxCounter(), cache_size)
@@ -0,0 +1,333 @@
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import EmptyPoolError
+
+logger = logging.getLogger('DeepSeekChat')
+
+# 可以安全重试的状态码：限流和上游临时故障
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# 这些错误说明请求没有拿到任何回答内容，重试不会造成重复输出
+RETRY_EXCEPTIONS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """熔断器打开期间直接拒绝，不再等上游超时"""
+
+
+class PoolTimeout(requests.exceptions.RequestException):
+    """本进程的上游连接都在用，等待空闲连接超时；是本地的容量问题，不重试也不计入熔断"""
+
+
+class _BoundedWait:
+    """urllib3连接池：池满时最多等pool_wait秒。requests不把pool_timeout传给urllib3，默认会无限等待"""
+
+    pool_wait = None
+
+    def _get_conn(self, timeout=None):
+        return super()._get_conn(self.pool_wait if timeout is None else timeout)
+
+
+class BoundedPoolAdapter(HTTPAdapter):
+    """连接池满时阻塞等待空闲连接，最多等pool_timeout秒，超时抛出PoolTimeout"""
+
+    def __init__(self, pool_timeout, **kwargs):
+        # 父类的__init__里就会创建连接池
+        self.pool_timeout = pool_timeout
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        classes = self.poolmanager.pool_classes_by_scheme
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: type(f'Bounded{cls.__name__}', (_BoundedWait, cls), {'pool_wait': self.pool_timeout})
+            for scheme, cls in classes.items()
+        }
+
+    def send(self, request, **kwargs):
+        try:
+            return super().send(request, **kwargs)
+        except EmptyPoolError as e:
+            raise PoolTimeout(f"等待空闲的上游连接超过{self.pool_timeout}秒", request=request) from e
+
+
+class CircuitBreaker:
+    """连续失败达到阈值后打开；冷却时间过后放行一个试探线程（半开），成功则关闭。
+
+    半开期间试探线程可以连续发起多次调用（一次Redis请求会依次经过建连、发送和读取），其他线程仍被拒绝。
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, name='上游'):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.name = name
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._prober = None
+        self.opens = 0
+        self.rejected = 0
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._prober = None
+            if self.state == self.HALF_OPEN and self._prober in (None, threading.get_ident()):
+                self._prober = threading.get_ident()
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        if self.state == self.CLOSED and not self._failures:
+            return
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info(f"{self.name}恢复，熔断器关闭")
+            self.state = self.CLOSED
+            self._failures = 0
+            self._prober = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.error(f"{self.name}连续失败{self._failures}次，熔断器打开")
+                    self.opens += 1
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._prober = None
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'consecutive_failures': self._failures,
+            'opens': self.opens,
+            'rejected': self.rejected,
+        }
+
+
+class UpstreamStream:
+    """已经收到首个数据块的流式响应；首块之前的失败都已在内部重试过"""
+
+    def __init__(self, response, chunks, first_chunk):
+        self.response = response
+        self._chunks = chunks
+        self._first_chunk = first_chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.response.close()
+
+    def iter_chunks(self):
+        if self._first_chunk:
+            yield self._first_chunk
+        yield from self._chunks
+
+
+class UpstreamClient:
+    """每个worker一个的DeepSeek客户端：持久连接池 + 预构建的请求头 + 重试和熔断"""
+
+    def __init__(self, api_url, api_key, pool_size=10, pool_timeout=5.0, connect_timeout=3.05, read_timeout=30,
+                 max_retries=2, retry_budget=10.0, backoff_base=0.5, backoff_max=8.0, breaker=None,
+                 connect_metric=None):
+        self.api_url = api_url
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        # metrics.Histogram：每次尝试从发出请求到收到响应头的时间（包括新建连接和TLS握手）
+        self.connect_metric = connect_metric
+
+        # 连接池满时阻塞等待而不是新建临时连接，保证连接数有上限；等待也有上限，不会占着准入名额无限等
+        self._adapter = BoundedPoolAdapter(pool_timeout, pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self._session = requests.Session()
+        self._session.mount('https://', self._adapter)
+        self._session.mount('http://', self._adapter)
+
+        # 鉴权和公共请求头只构建一次
+        self._session.headers.update({
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json',
+        })
+        self._headers = {'Accept': 'application/json'}
+        self._stream_headers = {'Accept': 'text/event-stream'}
+
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._retries = {}
+        self._pool_timeouts = 0
+
+    def post(self, payload):
+        """非流式请求，对可重试的失败按退避重试；返回最后一次的响应，状态码由调用方检查"""
+        return self._request(payload, stream=False)
+
+    def stream(self, payload):
+        """流式请求：收到第一个数据块之前的任何失败都可以安全重试（浏览器还什么都没收到）"""
+        return self._request(payload, stream=True)
+
+    def _request(self, payload, stream):
+        deadline = time.monotonic() + self.retry_budget
+        attempt = 0
+        while True:
+            try:
+                response = self._send(payload, stream)
+            except RETRY_EXCEPTIONS as e:
+                self.breaker.record_failure()
+                delay = self._next_delay(attempt, deadline, None)
+                if delay is None:
+                    raise
+                self._count_retry(type(e).__name__)
+                logger.warning(f"上游请求失败，{delay:.2f}秒后重试: {str(e)}")
+            except CircuitOpenError:
+                raise
+            except PoolTimeout:
+                with self._lock:
+                    self._pool_timeouts += 1
+                raise
+            except requests.exceptions.RequestException:
+                self.breaker.record_failure()
+                raise
+            else:
+                if response.status_code in RETRY_STATUSES:
+                    # 429是限流，说明上游可达，不计入熔断
+                    if response.status_code == 429:
+                        self.breaker.record_success()
+                    else:
+                        self.breaker.record_failure()
+                    delay = self._next_delay(attempt, deadline, response.headers.get('Retry-After'))
+                    if delay is None:
+                        if stream:
+                            _raise_for_status(response)
+                        return response
+                    response.close()
+                    self._count_retry(str(response.status_code))
+                    logger.warning(f"上游返回{response.status_code}，{delay:.2f}秒后重试")
+                elif not stream:
+                    self.breaker.record_success()
+                    return response
+                elif response.status_code >= 400:
+                    self.breaker.record_success()
+                    _raise_for_status(response)
+                else:
+                    chunks = response.iter_content(chunk_size=None)
+                    try:
+                        first_chunk = next(chunks, b'')
+                    except RETRY_EXCEPTIONS as e:
+                        response.close()
+                        self.breaker.record_failure()
+                        delay = self._next_delay(attempt, deadline, None)
+                        if delay is None:
+                            raise
+                        self._count_retry('stream_' + type(e).__name__)
+                        logger.warning(f"流在首字节前中断，{delay:.2f}秒后重试: {str(e)}")
+                    else:
+                        self.breaker.record_success()
+                        return UpstreamStream(response, chunks, first_chunk)
+            time.sleep(delay)
+            attempt += 1
+
+    def _send(self, payload, stream):
+        if not self.breaker.allow():
+            raise CircuitOpenError("上游熔断中")
+        with self._lock:
+            self._requests += 1
+        response = self._session.post(
+            self.api_url,
+            json=payload,
+            headers=self._stream_headers if stream else self._headers,
+            stream=stream,
+            timeout=self.timeout
+        )
+        if self.connect_metric is not None:
+            self.connect_metric.observe(response.elapsed.total_seconds())
+        return response
+
+    def _next_delay(self, attempt, deadline, retry_after):
+        """计算下次重试前的等待时间；次数或时间预算用完时返回None"""
+        if attempt >= self.max_retries:
+            return None
+        delay = _parse_retry_after(retry_after)
+        if delay is None:
+            # 全抖动指数退避，避免所有worker同时重试
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+    def _count_retry(self, reason):
+        with self._lock:
+            self._retries[reason] = self._retries.get(reason, 0) + 1
+
+    def stats(self):
+        # urllib3连接池自带计数：num_connections为新建连接数，num_requests为发出的请求数
+        pools = self._adapter.poolmanager.pools
+        connections = 0
+        pooled_requests = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            pooled_requests += pool.num_requests
+
+        reused = max(pooled_requests - connections, 0)
+        return {
+            'requests': self._requests,
+            'connections_opened': connections,
+            'connections_reused': reused,
+            'reuse_ratio': round(reused / pooled_requests, 4) if pooled_requests else 0.0,
+            'pool_size': self.pool_size,
+            'pool_timeouts': self._pool_timeouts,
+            'retries': dict(self._retries),
+            'breaker': self.breaker.stats(),
+        }
+
+    def close(self):
+        self._session.close()
+
+
+def _raise_for_status(response):
+    # 先读完错误响应体（很小），调用方在异常处理里还要读取response.text
+    response.content
+    response.raise_for_status()
+
+
+def _parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,199 @@
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+import redis
+import requests
+
+from app import (
+    MAX_HISTORY_TOKENS, coalesce_bytes, coalesce_window, conversation_store, count_error, history_stable,
+    prompt_cache_stats, redis_client, response_cache, resumable, stream_timings, token_counter, upstream
+)
+from generation import GenerationQueue
+from redis_access import WriteBatch
+from sse import DeltaCoalescer, SSEParser
+from upstream import CircuitOpenError
+
+logger = logging.getLogger('DeepSeekChat')
+
+# generation worker：从任务队列领取聊天任务，调用DeepSeek，把delta写进任务的续传缓冲，结束后保存回答。
+# 和web层（GENERATION_WORKERS=1）共用同一套环境变量，独立部署和扩容：
+#   python worker.py
+# 收到SIGTERM后不再领新任务，处理完手上的任务再退出。
+
+
+def save_reply(job, reply, usage, cache=False):
+    """追加回答并写回对话，一次往返；usage用于上下文缓存统计和token估算校准，cache为True时写响应缓存"""
+    conversation_id = job['conversation_id']
+    window = conversation_store.load(conversation_id)
+    window.append("assistant", reply)
+    window.trim_after_reply(MAX_HISTORY_TOKENS, history_stable)
+
+    writes = WriteBatch(redis_client)
+    writes.add(
+        conversation_store.queue_window, conversation_id, window,
+        callback=lambda results: conversation_store.saved(conversation_id, window, results),
+        client=conversation_store.client
+    )
+    if usage is not None:
+        writes.add(prompt_cache_stats.queue_record, conversation_id, usage)
+        token_counter.calibrate([msg["content"] for msg in job['payload']['messages']], usage.prompt_tokens)
+    if cache and response_cache.enabled:
+        writes.add(
+            response_cache.queue_set, response_cache.make_key(job['payload']), reply, callback=response_cache.set_done
+        )
+    writes.execute()
+
+
+def run_job(queue, entry_id, job, reclaimed=False):
+    buffer = resumable.start(job['id'])
+    if reclaimed:
+        # 崩溃的worker可能已经写了一部分帧，浏览器也早已超时，不再重新生成
+        logger.warning(f"接手中断的生成任务{job['id']}，标记为失败")
+        buffer.finish('生成已中断')
+        queue.ack(entry_id, failed=True)
+        return
+
+    waited = time.time() - job['created']
+    if waited > queue.wait_timeout or buffer.cancelled(resumable.grace):
+        # web已经等不及返回了错误，或者浏览器早已断开：这时再生成，回答可能排在用户后来的消息之后
+        logger.warning(f"任务{job['id']}排队{waited:.2f}秒后已被放弃，不再生成")
+        buffer.finish('生成已取消')
+        queue.ack(entry_id, failed=True)
+        return
+
+    logger.info(f"开始生成任务{job['id']}，排队{waited:.2f}秒")
+    parser = SSEParser()
+    coalescer = DeltaCoalescer(coalesce_bytes, coalesce_window)
+    received = []
+    timings = stream_timings()
+    completed = False
+    error = 'API请求失败'
+    checked = time.monotonic()
+    stopped = False
+    try:
+        with upstream.stream(job['payload']) as response:
+            for chunk in response.iter_chunks():
+                for payload in parser.feed(chunk):
+                    content = parser.decode(payload)
+                    if not content:
+                        continue
+                    received.append(content)
+                    timings.token()
+                    pending = coalescer.add(content)
+                    if pending:
+                        buffer.append(pending)
+                # 不含内容的数据块（比如上游思考时的keep-alive）也要把窗口到期的内容写出去
+                pending = coalescer.poll()
+                if pending:
+                    buffer.append(pending)
+                if parser.done:
+                    break
+                # 每秒检查一次浏览器是否已经断开且没人续传，是的话关闭上游连接
+                now = time.monotonic()
+                if now - checked >= 1:
+                    checked = now
+                    if buffer.cancelled(resumable.grace):
+                        logger.info(f"任务{job['id']}的浏览器已断开，关闭上游连接")
+                        error = '生成已中断'
+                        stopped = True
+                        break
+            if not stopped:
+                pending = coalescer.flush()
+                if pending:
+                    buffer.append(pending)
+                completed = True
+                timings.finish(parser.usage.completion_tokens if parser.usage is not None else None)
+
+    except requests.exceptions.HTTPError as e:
+        logger.error(f"生成任务HTTP错误: {e.response.status_code} - {e.response.text}")
+        count_error('upstream_http', 'generation')
+
+    except CircuitOpenError:
+        logger.error("上游熔断中，生成任务快速失败")
+        count_error('circuit_open', 'generation')
+
+    except requests.exceptions.RequestException as e:
+        logger.error(f"生成任务网络错误: {str(e)}")
+        count_error('network', 'generation')
+
+    except Exception as e:
+        logger.error(f"生成任务未知错误: {str(e)}")
+        count_error('internal', 'generation')
+
+    # 先把回答写进对话再写结束标记：浏览器收到[DONE]后马上发下一条消息时，web读到的对话里已经有这条回答
+    reply = ''.join(received)
+    try:
+        if reply:
+            # 中途停止的也保存已经生成的部分，只缓存完整的回答
+            save_reply(job, reply, parser.usage if completed else None, cache=completed)
+    except redis.RedisError as e:
+        logger.error(f"保存生成结果失败: {str(e)}")
+    finally:
+        buffer.finish(None if completed else error)
+    queue.ack(entry_id, failed=not completed)
+
+
+def consume(queue, consumer, stopping):
+    while not stopping.is_set():
+        job = None
+        try:
+            job = queue.read(consumer)
+            if job is not None:
+                run_job(queue, *job)
+        except redis.RedisError as e:
+            logger.warning(f"读取任务队列失败: {str(e)}")
+            stopping.wait(1)
+        except Exception as e:
+            # 任何错误都不能让消费线程退出，否则worker的并发永久减少；
+            # 结束标记已在run_job里写过，任务直接按失败确认，不用等claim_idle后被接手
+            logger.error(f"处理生成任务失败: {str(e)}")
+            count_error('internal', 'generation')
+            if job is not None:
+                try:
+                    queue.ack(job[0], failed=True)
+                except redis.RedisError as e:
+                    logger.warning(f"确认失败的生成任务失败: {str(e)}")
+
+
+def serve(concurrency):
+    queue = GenerationQueue(
+        redis_client,
+        claim_idle=float(os.getenv("GENERATION_CLAIM_IDLE", "300")),
+        wait_timeout=float(os.getenv("GENERATION_WAIT_TIMEOUT", "60"))
+    )
+    queue.ensure_group()
+    consumer = f'{socket.gethostname()}-{os.getpid()}'
+
+    stopping = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: stopping.set())
+
+    threads = [
+        threading.Thread(target=consume, args=(queue, consumer, stopping), name=f'generation-{i}')
+        for i in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    logger.info(f"generation worker {consumer} 已启动，并发{concurrency}")
+
+    # 主线程定期接手崩溃worker留下的任务
+    while not stopping.wait(min(queue.claim_idle / 2, 30)):
+        try:
+            for entry_id, job in queue.reclaim(consumer):
+                run_job(queue, entry_id, job, reclaimed=True)
+        except redis.RedisError as e:
+            logger.warning(f"接手中断任务失败: {str(e)}")
+
+    logger.info("正在停止，等待进行中的生成任务完成")
+    for thread in threads:
+        thread.join()
+    logger.info(f"generation worker {consumer} 已退出，{queue.stats()}")
+
+
+if __name__ == '__main__':
+    # 并发默认等于上游连接池大小，再多的线程也只是在等连接
+    serve(int(os.getenv("GENERATION_CONCURRENCY", str(upstream.pool_size))))